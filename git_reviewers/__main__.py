@@ -0,0 +1,11 @@
+"""
+Entry point for `python -m git_reviewers` and for running the package
+directory as a script, which unlike running reviewers.py directly reuses
+its compiled bytecode
+"""
+if __package__:
+    from git_reviewers.reviewers import main
+else:
+    from reviewers import main  # type: ignore[no-redef]
+
+main()
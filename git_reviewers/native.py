@@ -0,0 +1,593 @@
+"""
+Reading of history straight from a git directory for the native backend,
+imported only when the backend is used
+"""
+import heapq
+import mmap
+import os
+import re
+import struct
+import typing  # NOQA
+from typing import Any, Dict, Iterator, List, Mapping, Optional, \
+    Tuple, Type  # NOQA: F401
+import zlib
+
+if __package__:
+    from git_reviewers.reviewers import (
+        IdentityResolver, LOG_RECORD_SEPARATOR, OwnershipIndex,
+        TRAILER_KEY_NAMES, TRAILER_SEPARATOR, parse_trailers, quote_path,
+    )
+else:  # pragma: no cover
+    from reviewers import (  # type: ignore[no-redef]
+        IdentityResolver, LOG_RECORD_SEPARATOR, OwnershipIndex,
+        TRAILER_KEY_NAMES, TRAILER_SEPARATOR, parse_trailers, quote_path,
+    )
+
+TREE_ENTRY = re.compile(rb'([0-7]+) ([^\x00]*)\x00(.{20})', re.DOTALL)
+
+
+def native_errors() -> Tuple[Type[Exception], ...]:
+    """ Return the errors which the native backend falls back to git on """
+    return (OSError, ValueError, KeyError, IndexError, zlib.error)
+
+
+class NativeRepository():
+    """
+    Read only access to the refs and objects of a repository straight from
+    its git directory, with pack and pack index files memory mapped, so that
+    the ownership index can be built without running git.  Only what the
+    index needs is supported: loose and packed refs, loose objects, version 2
+    pack indexes and exact rename detection.  Anything else raises
+    ValueError so that callers can fall back to running git.
+    """
+    OBJECT_TYPES = {1: 'commit', 2: 'tree', 3: 'blob', 4: 'tag'}
+    CACHE_SIZE = 4096
+
+    def __init__(self, git_dir: str, common_dir: str, work_tree: str) -> None:
+        self.git_dir = git_dir
+        self.common_dir = common_dir
+        self.work_tree = work_tree
+        self.object_dirs = [os.path.join(common_dir, 'objects')]
+        self.packs: Optional[List[Tuple['mmap.mmap', 'mmap.mmap', Any]]] = None
+        self.cache: Dict[Any, Tuple[str, bytes]] = {}
+        self.trees: Dict[bytes, Dict[bytes, bytes]] = {}
+        self.shallow: typing.Set[str] = set()
+        self.mailmap: Dict[str, Dict[str, Tuple[str, str]]] = {}
+
+    @staticmethod
+    def open(directory: str) -> 'NativeRepository':
+        """
+        Find the git directory of the work tree containing a directory and
+        check that the repository can be read without git
+        """
+        directory = os.path.abspath(directory)
+        while not os.path.exists(os.path.join(directory, '.git')):
+            parent = os.path.dirname(directory)
+            if parent == directory:
+                raise ValueError('Not in a git work tree')
+            directory = parent
+        git_dir = os.path.join(directory, '.git')
+        if os.path.isfile(git_dir):
+            with open(git_dir, 'r') as git_file:
+                content = git_file.read().strip()
+            if not content.startswith('gitdir: '):
+                raise ValueError('Invalid .git file')
+            git_dir = os.path.join(directory, content[len('gitdir: '):])
+        common_dir = git_dir
+        if os.path.isfile(os.path.join(git_dir, 'commondir')):
+            with open(os.path.join(git_dir, 'commondir'), 'r') as handle:
+                common_dir = os.path.join(git_dir, handle.read().strip())
+        repository = NativeRepository(
+            os.path.normpath(git_dir), os.path.normpath(common_dir), directory,
+        )
+        repository.check_supported()
+        return repository
+
+    def read_file(self, *path: str) -> str:
+        """ Read a file in the common git directory, or '' if missing """
+        try:
+            with open(os.path.join(self.common_dir, *path), 'r') as handle:
+                return handle.read()
+        except FileNotFoundError:
+            return ''
+
+    def check_supported(self) -> None:
+        """
+        Raise ValueError for repository features which change what git log
+        would show and which are not read here
+        """
+        config = self.read_file('config')
+        home = os.path.expanduser('~')
+        xdg_config = os.environ.get('XDG_CONFIG_HOME') or \
+            os.path.join(home, '.config')
+        for path in [
+            os.path.join(home, '.gitconfig'),
+            os.path.join(xdg_config, 'git', 'config'),
+        ]:
+            try:
+                with open(path, 'r', errors='replace') as handle:
+                    config += handle.read()
+            except OSError:
+                pass
+        config = config.lower().replace(' ', '').replace('\t', '')
+        for unsupported in [
+            'objectformat=', 'refstorage=', 'showroot=',
+            '[mailmap]', '[include', 'grafts',
+        ]:
+            if unsupported in config:
+                raise ValueError('Unsupported config %s' % unsupported)
+        for path in ['reftable', 'refs/replace', 'info/grafts']:
+            if os.path.exists(os.path.join(self.common_dir, path)):
+                raise ValueError('Unsupported %s' % path)
+        if 'refs/replace/' in self.read_file('packed-refs'):
+            raise ValueError('Unsupported replace refs')
+        alternates = self.read_file('objects', 'info', 'alternates')
+        for alternate in alternates.splitlines():
+            if alternate and not alternate.startswith('#'):
+                self.object_dirs.append(os.path.join(
+                    self.common_dir, 'objects', alternate,
+                ))
+        self.shallow = set(self.read_file('shallow').split())
+        try:
+            mailmap_path = os.path.join(self.work_tree, '.mailmap')
+            with open(mailmap_path, 'r', errors='replace') as handle:
+                self.mailmap = IdentityResolver.parse_mailmap_entries(handle)
+        except FileNotFoundError:
+            pass
+
+    def read_refs(self) -> Dict[str, str]:
+        """ Return the object names of all refs, like git for-each-ref """
+        refs = {}  # type: Dict[str, str]
+        for line in self.read_file('packed-refs').splitlines():
+            if line and line[0] not in '#^':
+                sha, _, name = line.partition(' ')
+                refs[name] = sha
+        refs_dir = os.path.join(self.common_dir, 'refs')
+        for directory, _, files in os.walk(refs_dir):
+            for name in files:
+                path = os.path.join(directory, name)
+                ref = os.path.relpath(path, self.common_dir)
+                with open(path, 'r') as handle:
+                    refs[ref.replace(os.sep, '/')] = handle.read().strip()
+        resolved = {}  # type: Dict[str, str]
+        for name in refs:
+            target = self.resolve_ref(refs, name)
+            if target:
+                resolved[name] = target
+        return resolved
+
+    @staticmethod
+    def resolve_ref(refs: Dict[str, str], name: str) -> str:
+        """ Follow symbolic refs, returning '' for dangling ones """
+        for _ in range(10):
+            value = refs.get(name, '')
+            if not value.startswith('ref: '):
+                return value
+            name = value[len('ref: '):]
+        return ''
+
+    def head_and_tips(self) -> Tuple[str, List[str]]:
+        """
+        Return HEAD and the commits which the ownership index records as
+        tips: HEAD and every ref, with annotated tags peeled once
+        """
+        refs = self.read_refs()
+        with open(os.path.join(self.git_dir, 'HEAD'), 'r') as handle:
+            refs['HEAD'] = handle.read().strip()
+        head = self.resolve_ref(refs, 'HEAD')
+        if len(head) != 40:
+            raise ValueError('HEAD does not point to a commit')
+        tips = set([head])
+        for name, sha in refs.items():
+            if name == 'HEAD':
+                continue
+            object_type, data = self.read_object(sha)
+            if object_type == 'tag':
+                tips.add(data[7:data.index(b'\n')].decode('ascii'))
+            else:
+                tips.add(sha)
+        return head, sorted(tips)
+
+    def worktree_heads(self) -> List[str]:
+        """ Return the HEADs of all work trees, which git log --all walks """
+        heads = []
+        worktrees = os.path.join(self.common_dir, 'worktrees')
+        names = os.listdir(worktrees) if os.path.isdir(worktrees) else []
+        refs = self.read_refs()
+        for name in sorted(names):
+            try:
+                with open(os.path.join(worktrees, name, 'HEAD'), 'r') as head:
+                    refs['HEAD'] = head.read().strip()
+            except FileNotFoundError:
+                continue
+            sha = self.resolve_ref(refs, 'HEAD')
+            if sha:
+                heads.append(sha)
+        return heads
+
+    def load_packs(self) -> List[Tuple['mmap.mmap', 'mmap.mmap', Any]]:
+        """
+        Memory map the index and data of every pack, along with the fan-out
+        table of the index counting the objects up to each first byte
+        """
+        if self.packs is not None:
+            return self.packs
+        self.packs = []
+        for object_dir in self.object_dirs:
+            pack_dir = os.path.join(object_dir, 'pack')
+            if not os.path.isdir(pack_dir):
+                continue
+            for name in sorted(os.listdir(pack_dir)):
+                if not name.endswith('.idx'):
+                    continue
+                maps = []
+                for path in [name, name[:-len('.idx')] + '.pack']:
+                    with open(os.path.join(pack_dir, path), 'rb') as handle:
+                        maps.append(mmap.mmap(
+                            handle.fileno(), 0, access=mmap.ACCESS_READ,
+                        ))
+                index, pack = maps
+                if index[:8] != b'\xfftOc\x00\x00\x00\x02':
+                    raise ValueError('Unsupported pack index %s' % name)
+                fanout = struct.unpack('>256I', index[8:1032])
+                self.packs.append((index, pack, fanout))
+        return self.packs
+
+    def find_packed(self, sha: bytes) -> Optional[Tuple[int, int]]:
+        """ Return the pack number and offset of an object, if packed """
+        for number, (index, _, fanout) in enumerate(self.load_packs()):
+            count = fanout[255]
+            low = fanout[sha[0] - 1] if sha[0] else 0
+            high = fanout[sha[0]]
+            while low < high:
+                middle = (low + high) // 2
+                position = 1032 + middle * 20
+                found = index[position:position + 20]
+                if found == sha:
+                    table = 1032 + count * 24 + middle * 4
+                    offset = struct.unpack('>I', index[table:table + 4])[0]
+                    if offset & 0x80000000:
+                        large = 1032 + count * 28 + \
+                            (offset & 0x7fffffff) * 8
+                        offset = struct.unpack(
+                            '>Q', index[large:large + 8],
+                        )[0]
+                    return number, offset
+                if found < sha:
+                    low = middle + 1
+                else:
+                    high = middle
+        return None
+
+    def read_object(self, sha: str) -> Tuple[str, bytes]:
+        """ Return the type and content of an object """
+        cached = self.cache.get(sha)
+        if cached is not None:
+            return cached
+        packed = self.find_packed(bytes.fromhex(sha))
+        if packed is not None:
+            result = self.read_packed(*packed)
+        else:
+            result = self.read_loose(sha)
+        self.cache_object(sha, result)
+        return result
+
+    def cache_object(self, key: Any, result: Tuple[str, bytes]) -> None:
+        """ Keep recently read objects, such as delta bases """
+        if len(self.cache) >= self.CACHE_SIZE:
+            del self.cache[next(iter(self.cache))]
+        self.cache[key] = result
+
+    def read_loose(self, sha: str) -> Tuple[str, bytes]:
+        """ Read an unpacked object from the object directories """
+        for object_dir in self.object_dirs:
+            path = os.path.join(object_dir, sha[:2], sha[2:])
+            try:
+                with open(path, 'rb') as handle:
+                    data = zlib.decompress(handle.read())
+            except FileNotFoundError:
+                continue
+            header, _, content = data.partition(b'\x00')
+            return header.split(b' ')[0].decode('ascii'), content
+        raise ValueError('Missing object %s' % sha)
+
+    def read_packed(self, number: int, offset: int) -> Tuple[str, bytes]:
+        """ Read an object from a pack, applying deltas to their bases """
+        cached = self.cache.get((number, offset))
+        if cached is not None:
+            return cached
+        pack = self.load_packs()[number][1]
+        byte = pack[offset]
+        object_type = (byte >> 4) & 7
+        size = byte & 15
+        shift = 4
+        position = offset + 1
+        while byte & 0x80:
+            byte = pack[position]
+            position += 1
+            size |= (byte & 0x7f) << shift
+            shift += 7
+        base = None
+        if object_type == 6:
+            byte = pack[position]
+            position += 1
+            distance = byte & 0x7f
+            while byte & 0x80:
+                byte = pack[position]
+                position += 1
+                distance = ((distance + 1) << 7) | (byte & 0x7f)
+            base = self.read_packed(number, offset - distance)
+        elif object_type == 7:
+            base = self.read_object(pack[position:position + 20].hex())
+            position += 20
+        elif object_type not in self.OBJECT_TYPES:
+            raise ValueError('Unknown pack object type %d' % object_type)
+        data = self.inflate(pack, position, size)
+        if base is None:
+            result = (self.OBJECT_TYPES[object_type], data)
+        else:
+            result = (base[0], self.apply_delta(base[1], data))
+        self.cache_object((number, offset), result)
+        return result
+
+    @staticmethod
+    def inflate(pack: 'mmap.mmap', position: int, size: int) -> bytes:
+        """ Decompress size bytes of zlib data at a position in a pack """
+        decompressor = zlib.decompressobj()
+        data = b''
+        block = size + 64
+        while not decompressor.eof:
+            chunk = pack[position:position + block]
+            if not chunk:
+                raise ValueError('Truncated pack')
+            data += decompressor.decompress(chunk)
+            position += len(chunk)
+            block = max(block, 65536)
+        if len(data) != size:
+            raise ValueError('Corrupt pack object')
+        return data
+
+    @staticmethod
+    def apply_delta(base: bytes, delta: bytes) -> bytes:
+        """ Rebuild an object from its base and a git delta """
+        position = 0
+        sizes = []
+        for _ in range(2):
+            size = 0
+            shift = 0
+            while True:
+                byte = delta[position]
+                position += 1
+                size |= (byte & 0x7f) << shift
+                shift += 7
+                if not byte & 0x80:
+                    break
+            sizes.append(size)
+        if sizes[0] != len(base):
+            raise ValueError('Delta base size mismatch')
+        result = bytearray()
+        while position < len(delta):
+            instruction = delta[position]
+            position += 1
+            if instruction & 0x80:
+                offset = 0
+                size = 0
+                for i in range(4):
+                    if instruction & (1 << i):
+                        offset |= delta[position] << (8 * i)
+                        position += 1
+                for i in range(3):
+                    if instruction & (0x10 << i):
+                        size |= delta[position] << (8 * i)
+                        position += 1
+                result += base[offset:offset + (size or 0x10000)]
+            elif instruction:
+                result += delta[position:position + instruction]
+                position += instruction
+            else:
+                raise ValueError('Invalid delta instruction')
+        if len(result) != sizes[1]:
+            raise ValueError('Delta result size mismatch')
+        return bytes(result)
+
+    def read_tree(self, sha: bytes) -> Dict[bytes, bytes]:
+        """ Map the names of the entries of a tree to their mode and id """
+        entries = self.trees.get(sha)
+        if entries is not None:
+            return entries
+        object_type, data = self.read_object(sha.hex())
+        if object_type != 'tree':
+            raise ValueError('Expected a tree')
+        entries = {
+            name: mode + b' ' + entry_id
+            for mode, name, entry_id in TREE_ENTRY.findall(data)
+        }
+        if len(self.trees) >= self.CACHE_SIZE:
+            del self.trees[next(iter(self.trees))]
+        self.trees[sha] = entries
+        return entries
+
+    def diff_trees(
+        self, old: Optional[bytes], new: Optional[bytes], prefix: bytes = b'',
+    ) -> Iterator[Tuple[bytes, Optional[bytes], Optional[bytes]]]:
+        """
+        Yield the path, old id and new id of every file which differs
+        between two trees, where an id is the mode and object name
+        """
+        old_entries = {} if old is None else self.read_tree(old)
+        new_entries = {} if new is None else self.read_tree(new)
+        for name in old_entries.keys() | new_entries.keys():
+            old_id = old_entries.get(name)
+            new_id = new_entries.get(name)
+            if old_id == new_id:
+                continue
+            old_tree = old_id is not None and old_id.startswith(b'40000 ')
+            new_tree = new_id is not None and new_id.startswith(b'40000 ')
+            path = prefix + name
+            if old_tree or new_tree:
+                yield from self.diff_trees(
+                    old_id[-20:] if old_tree and old_id else None,
+                    new_id[-20:] if new_tree and new_id else None,
+                    path + b'/',
+                )
+            if not old_tree and old_id is not None or \
+                    not new_tree and new_id is not None:
+                yield (
+                    path,
+                    None if old_tree else old_id,
+                    None if new_tree else new_id,
+                )
+
+    def changed_paths(self, old: Optional[bytes], new: bytes) -> List[str]:
+        """
+        Return the lines git log --name-status shows for a change between
+        two trees, where a file deleted and added with the same content
+        elsewhere is an exact rename
+        """
+        changes = list(self.diff_trees(old, new))
+        deleted = {}  # type: Dict[bytes, List[bytes]]
+        for path, old_id, new_id in changes:
+            if new_id is None and old_id is not None:
+                deleted.setdefault(old_id[-20:], []).append(path)
+        renamed = {}  # type: Dict[bytes, bytes]
+        for path, old_id, new_id in sorted(changes):
+            if old_id is None and new_id is not None and \
+                    deleted.get(new_id[-20:]):
+                renamed[path] = deleted[new_id[-20:]].pop(0)
+        renamed_from = set(renamed.values())
+        lines = []
+        for path, old_id, new_id in changes:
+            if path in renamed:
+                lines.append('R100\t%s\t%s' % (
+                    quote_path(renamed[path]), quote_path(path),
+                ))
+            elif path not in renamed_from:
+                status = 'M' if old_id and new_id else 'D' if old_id else 'A'
+                lines.append('%s\t%s' % (status, quote_path(path)))
+        return lines
+
+    def read_commit(self, sha):
+        # type: (str) -> Tuple[bytes, List[str], str, int, int, str]
+        """
+        Return the tree, parents, author identity after .mailmap, author
+        time, commit time and message of a commit
+        """
+        object_type, data = self.read_object(sha)
+        if object_type != 'commit':
+            raise ValueError('Expected a commit')
+        headers, _, message = data.partition(b'\n\n')
+        tree = b''
+        parents = []  # type: List[str]
+        author = ''
+        commit_time = 0
+        for line in headers.split(b'\n'):
+            key, _, value = line.partition(b' ')
+            if key == b'tree':
+                tree = bytes.fromhex(value.decode('ascii'))
+            elif key == b'parent':
+                parents.append(value.decode('ascii'))
+            elif key == b'author':
+                author = value.decode('utf-8', 'replace')
+            elif key == b'committer':
+                commit_time = int(value.rsplit(b' ', 2)[1])
+            elif key == b'encoding' and value.lower() not in [
+                    b'utf-8', b'utf8']:
+                raise ValueError('Unsupported commit encoding')
+        if sha in self.shallow:
+            parents = []
+        identity, _, date = author.rpartition('> ')
+        name, _, email = identity.partition(' <')
+        name, email = self.map_author(name, email)
+        author_time = int(date.split()[0])
+        return (
+            tree, parents, '%s <%s>' % (name, email), author_time,
+            commit_time, message.decode('utf-8', 'replace'),
+        )
+
+    def map_author(self, name: str, email: str) -> Tuple[str, str]:
+        """ Map an author through .mailmap like %aN and %aE """
+        names = self.mailmap.get(email.lower())
+        if names is None:
+            return name, email
+        proper = names.get(name.lower(), names.get(''))
+        if proper is None:
+            return name, email
+        return proper[0] or name, proper[1] or email
+
+    def log_lines(self, tips, known, reviews):
+        # type: (List[str], Mapping[str, int], List[str]) -> Iterator[str]
+        """
+        Yield what git log would print with OwnershipIndex.LOG_FORMAT,
+        --name-status, -M, --cc and --all for commits reachable from tips
+        and not in known, most recent commit time first.  The messages of
+        commits with "Reviewed By:" lines are added to reviews as
+        OwnershipIndex.REVIEW_FORMAT would print them.
+        """
+        queue = []  # type: List[Tuple[int, int, str]]
+        commits: Dict[str, Tuple[bytes, List[str], str, int, int, str]] = {}
+        pushed = 0
+
+        def push(sha: str) -> None:
+            nonlocal pushed
+            commits[sha] = self.read_commit(sha)
+            pushed += 1
+            heapq.heappush(queue, (-commits[sha][4], pushed, sha))
+
+        for tip in tips + self.worktree_heads():
+            if tip in commits or tip in known:
+                continue
+            if self.read_object(tip)[0] == 'commit':
+                push(tip)
+        while queue:
+            _, _, sha = heapq.heappop(queue)
+            tree, parents, identity, author_time, commit_time, message = \
+                commits.pop(sha)
+            trailers = [
+                value for key, value in parse_trailers(message)
+                if key.lower() in TRAILER_KEY_NAMES
+            ]
+            yield '%s%s %s%s%d %d%s%s%s%s' % (
+                LOG_RECORD_SEPARATOR, sha, ' '.join(parents),
+                LOG_RECORD_SEPARATOR, author_time, commit_time,
+                LOG_RECORD_SEPARATOR, identity, LOG_RECORD_SEPARATOR,
+                TRAILER_SEPARATOR.join(trailers),
+            )
+            if OwnershipIndex.REVIEWERS_IDENTIFIER in message:
+                reviews.append(LOG_RECORD_SEPARATOR + sha)
+                reviews.extend(message.split('\n'))
+            for parent in parents:
+                if parent not in known and parent not in commits:
+                    push(parent)
+            yield from self.commit_paths(tree, parents)
+
+    def commit_paths(self, tree: bytes, parents: List[str]) -> List[str]:
+        """
+        Return the lines shown for a commit, where merges only show the new
+        paths which differ from every parent like --cc
+        """
+        if not parents:
+            return self.changed_paths(None, tree)
+        if len(parents) == 1:
+            parent_tree = self.read_object(parents[0])[1][5:45]
+            return self.changed_paths(bytes.fromhex(
+                parent_tree.decode('ascii'),
+            ), tree)
+        paths = None  # type: Optional[List[str]]
+        for parent in parents:
+            parent_tree = self.read_object(parent)[1][5:45]
+            changed = [line.split('\t')[-1] for line in self.changed_paths(
+                bytes.fromhex(parent_tree.decode('ascii')), tree,
+            )]
+            if paths is None:
+                paths = changed
+            else:
+                changed_set = set(changed)
+                paths = [x for x in paths if x in changed_set]
+        return ['%s\t%s' % ('M' * len(parents), x) for x in paths or []]
+
+    def ingest(self, index: OwnershipIndex, tips: List[str]) -> None:
+        """ Add the commits reachable from tips to an ownership index """
+        first_commit = len(index.shas)
+        reviews = []  # type: List[str]
+        index.ingest(self.log_lines(tips, dict(index.sha_ids), reviews))
+        index.ingest_reviews(reviews, first_commit)
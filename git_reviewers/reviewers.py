@@ -1,15 +1,29 @@
 #!/usr/bin/env python3
 
-import argparse
-from collections import Counter
+from array import array
+from collections import Counter, deque
+import copy
+import heapq
 import json
+import math
 import os
-import pathlib
 import subprocess
 import sys
+import time
 
 import typing  # NOQA
-from typing import List, Tuple
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Mapping, \
+    Optional, Tuple, Type, TypeVar
+
+# Modules such as argparse, asyncio, concurrent.futures, hashlib, queue,
+# socket, threading and the native backend are imported where they are
+# used, so that --version and answers from a daemon start quickly
+if typing.TYPE_CHECKING:  # pragma: no cover
+    import argparse  # NOQA: F401
+    import types
+    from concurrent.futures import Future
+
+    from git_reviewers.native import NativeRepository  # NOQA: F401
 
 if sys.version_info < (3, 0): # NOQA pragma: no cover
     raise SystemError("Must be using Python 3")
@@ -17,11 +31,1038 @@ if sys.version_info < (3, 0): # NOQA pragma: no cover
 __version__ = '0.13.8'
 STRIP_DOMAIN_USERNAMES = ['uber.com']
 REVIEWERS_LIMIT = 7
+CACHE_DIRECTORY = 'reviewers-cache'
+LOG_RECORD_SEPARATOR = '\x00'
+DAEMON_SOCKET = 'daemon.sock'
+DAEMON_TIMEOUT = 30
+SNAPSHOT_FILENAME = 'snapshot.json'
+REFRESH_LOCK = 'refresh.lock'
+REFRESH_PENDING = 'refresh.pending'
+PATHSPEC_ARGV_LIMIT = 1000
+PARTIAL_CLONE_CONFIG = \
+    r'^(extensions\.partialclone|remote\..*\.(promisor|partialclonefilter))$'
+# Only pairs renamed files with the same object id, so that no file contents
+# are read
+EXACT_RENAMES = '-M100%'
+FINDER_ENTRY_POINT_GROUP = 'git_reviewers.finders'
+ADAPTIVE_WINDOW_START = 50
+# Commit weights are decayed to the start of each period of this many
+# seconds, so that they are shared within a period and move on with time
+WEIGHTS_PERIOD = 24 * 60 * 60
+HISTORY_WINDOW_OPTIONS = [
+    'max_commits', 'since', 'revision_range', 'adaptive_window',
+    'window_threshold',
+]
+# Options which change the ranking besides those sent to a daemon one by
+# one, which a daemon only answers for if its own match the client's
+RANKING_CONFIG_OPTIONS = [
+    'half_life_days', 'finder_weights', 'finders', 'directory_threshold',
+    'directory_depth', 'finder_timeout', 'aliases', 'index', 'backend',
+]
+TRAILER_KEYS = ['Reviewed-by', 'Approved-by', 'Co-authored-by']
+TRAILER_SEPARATOR = '\x1f'
+TRAILER_FORMAT = '%%(trailers:%s,valueonly,unfold,separator=%%x1f)' % (
+    ','.join('key=%s' % key for key in TRAILER_KEYS)
+)
+TRAILER_KEY_NAMES = set(key.lower() for key in TRAILER_KEYS)
+PATH_ESCAPES = {
+    0x07: 'a', 0x08: 'b', 0x09: 't', 0x0a: 'n', 0x0b: 'v', 0x0c: 'f',
+    0x0d: 'r', 0x22: '"', 0x5c: '\\',
+}
 
+T = TypeVar('T')
+
+
+def import_native() -> 'types.ModuleType':
+    """ Import the native backend, which is only loaded when it is used """
+    if __package__:
+        from git_reviewers import native  # NOQA: PLC0415
+    else:  # pragma: no cover
+        import native  # type: ignore[no-redef]  # NOQA: PLC0415
+    return native
+
+
+def trailer_identity(value: str) -> str:
+    """ Return the email of a "Name <email>" trailer value, or the value """
+    value = value.strip()
+    if value.endswith('>') and '<' in value:
+        return value[value.rfind('<') + 1:-1]
+    return value
+
+
+def parse_reviewed_by(line: str) -> List[str]:
+    """ Return the reviewers listed on a "Reviewed By:" line of a message """
+    if OwnershipIndex.REVIEWERS_IDENTIFIER not in line:
+        return []
+    line = line.replace(OwnershipIndex.REVIEWERS_IDENTIFIER, '')
+    return [x.strip() for x in line.split(', ')]
+
+
+def quote_path(path: bytes) -> str:
+    """
+    Quote a path the way git prints it by default, in double quotes with C
+    style escapes if it has control characters, quotes, backslashes or
+    bytes outside of ASCII
+    """
+    if all(0x20 <= byte < 0x7f and byte not in PATH_ESCAPES for byte in path):
+        return path.decode('ascii')
+    quoted = ''
+    for byte in path:
+        if byte in PATH_ESCAPES:
+            quoted += '\\' + PATH_ESCAPES[byte]
+        elif 0x20 <= byte < 0x7f:
+            quoted += chr(byte)
+        else:
+            quoted += '\\%03o' % byte
+    return '"%s"' % quoted
+
+
+def unquote_path(path: str) -> str:
+    """
+    Undo the double quotes and C style escapes of a path printed by git,
+    returning paths which are not quoted as they are
+    """
+    if len(path) < 2 or path[0] != '"' or path[-1] != '"':
+        return path
+    escapes = {y: x for x, y in PATH_ESCAPES.items()}
+    unquoted = bytearray()
+    position = 1
+    while position < len(path) - 1:
+        character = path[position]
+        position += 1
+        if character != '\\':
+            unquoted += character.encode('utf-8')
+        elif path[position] in escapes:
+            unquoted.append(escapes[path[position]])
+            position += 1
+        else:
+            unquoted.append(int(path[position:position + 3], 8))
+            position += 3
+    return unquoted.decode('utf-8', 'surrogateescape')
+
+
+def find_separator(line: str) -> int:
+    """
+    Return the position of the ":" of a "Key: value" trailer line, or -1,
+    allowing only letters, digits and "-" in the key as git does
+    """
+    whitespace_found = False
+    for position, character in enumerate(line):
+        if character == ':':
+            return position
+        if not whitespace_found and (character.isalnum() or character == '-'):
+            continue
+        if position and character in ' \t':
+            whitespace_found = True
+            continue
+        break
+    return -1
+
+
+def parse_trailers(message: str) -> List[Tuple[str, str]]:
+    """
+    Return the unfolded keys and values of the trailers of a commit message,
+    found the way `git log --format=%(trailers)` finds them: in the last
+    paragraph after the subject when it only has trailers, or when at least a
+    quarter of it is trailers and one is a git generated Signed-off-by line
+    """
+    lines = message.split('\n')
+    for position, line in enumerate(lines):
+        if line.startswith('---') and (len(line) == 3 or line[3].isspace()):
+            lines = lines[:position]
+            break
+    while lines and (not lines[-1].strip() or lines[-1].startswith('#')):
+        lines.pop()
+    title_end = 0
+    while title_end < len(lines) and lines[title_end].strip():
+        title_end += 1
+    trailer_lines = 0
+    non_trailer_lines = 0
+    continuation_lines = 0
+    recognized_prefix = False
+    start = len(lines)
+    for position in range(len(lines) - 1, title_end - 1, -1):
+        line = lines[position]
+        if line.startswith('#'):
+            non_trailer_lines += continuation_lines
+            continuation_lines = 0
+        elif not line.strip():
+            non_trailer_lines += continuation_lines
+            if (recognized_prefix and
+                    trailer_lines * 3 >= non_trailer_lines) or \
+                    (trailer_lines and not non_trailer_lines):
+                start = position + 1
+            break
+        elif line.startswith('Signed-off-by: ') or \
+                line.startswith('(cherry picked from commit '):
+            trailer_lines += 1
+            continuation_lines = 0
+            recognized_prefix = True
+        elif find_separator(line) >= 1 and not line[0].isspace():
+            trailer_lines += 1
+            continuation_lines = 0
+        elif line[0].isspace():
+            continuation_lines += 1
+        else:
+            non_trailer_lines += 1 + continuation_lines
+            continuation_lines = 0
+    trailers = []  # type: List[Tuple[str, str]]
+    for line in lines[start:]:
+        if line.startswith('#'):
+            continue
+        if line[:1].isspace() and trailers:
+            key, value = trailers[-1]
+            trailers[-1] = (key, (value + ' ' + line.strip()).strip())
+            continue
+        separator = find_separator(line)
+        if separator >= 1 and not line[0].isspace():
+            trailers.append(
+                (line[:separator].strip(), line[separator + 1:].strip()),
+            )
+        else:
+            trailers.append(('', line.strip()))
+    return [x for x in trailers if x[0]]
+
+
+class DirectoryTrie():
+    """
+    Prefix trie of the directories touched in an ownership index, down to a
+    fixed depth.  Each node holds the ids of the commits touching any path
+    below it, so that a directory is answered without visiting its files.
+    """
+    def __init__(self, depth: int = 0) -> None:
+        self.depth = depth
+        self.children: Dict[str, 'DirectoryTrie'] = {}
+        self.commits: typing.Set[int] = set()
+
+    @staticmethod
+    def build(paths, depth):
+        # type: (Mapping[str, List[int]], int) -> DirectoryTrie
+        """ Build a trie from the touched paths of an index """
+        root = DirectoryTrie(depth)
+        for path, commits in paths.items():
+            node = root
+            for part in path.split('/')[:-1][:depth]:
+                child = node.children.get(part)
+                if child is None:
+                    child = node.children[part] = DirectoryTrie()
+                child.commits.update(commits)
+                node = child
+        return root
+
+    def find(self, directory: str) -> Optional['DirectoryTrie']:
+        """ Return the node of a directory such as "a/b/" if known """
+        node = self
+        for part in directory.rstrip('/').split('/'):
+            child = node.children.get(part)
+            if child is None:
+                return None
+            node = child
+        return node
+
+
+class HistoryWindow():
+    """
+    Bounds on the history considered for a query: commits in a revision
+    range, commits committed since a time, and at most the max_commits most
+    recent of the commits which match the query.  Like git log --since and
+    --max-count, recency is by commit time rather than author time.
+    """
+    def __init__(self, max_commits=0, since=0, included=None):
+        # type: (int, int, Optional[bytearray]) -> None
+        self.max_commits = max_commits
+        self.since = since
+        self.included = included
+
+    def select(self, index, commits):
+        # type: (OwnershipIndex, Iterable[int]) -> Iterable[int]
+        """ Filter the commits matching a query to those in the window """
+        if self.included is not None:
+            included = self.included
+            commits = [x for x in commits if included[x]]
+        if self.since:
+            commit_times = index.commit_times
+            commits = [x for x in commits if commit_times[x] >= self.since]
+        if self.max_commits:
+            commits = heapq.nlargest(
+                self.max_commits, commits,
+                key=lambda x: (index.commit_times[x], x),
+            )
+        return commits
+
+
+class OwnershipIndex():
+    """
+    Persistent model of repository history built from a git log traversal
+    of every ref.  It records the author, parents, touched paths and
+    reviewers of every commit reachable from any ref, so that all finders
+    can be answered from it.  Reviewers are read from the TRAILER_KEYS
+    trailers of each commit, and kept apart from the phabricator usernames
+    of "Reviewed By:" lines found by a second git log pass limited to the
+    commits which have them.  Renames detected in the first traversal are
+    kept with the commit which made them as the lineage of each path.  It
+    is stored under the repository's git directory and updated
+    incrementally as refs move.
+    """
+    VERSION = 8
+    FILENAME = 'index.json'
+    LOG_FORMAT = '--format=%x00%H %P%x00%at %ct%x00%aN <%aE>%x00' + \
+        TRAILER_FORMAT
+    REVIEW_FORMAT = '--format=%x00%H%n%B'
+    REVIEWERS_IDENTIFIER = 'Reviewed By: '
+    REVIEWERS_PATTERN = '--grep=Reviewed By: '
+
+    def __init__(self) -> None:
+        self.head = ''
+        self.tips: List[str] = []
+        self.shas: List[str] = []
+        self.sha_ids: Dict[str, int] = {}
+        self.parents: List[List[int]] = []
+        self.identities: List[str] = []
+        self.identity_ids: Dict[str, int] = {}
+        self.authors = array('l')
+        # Author times, for decaying scores with age
+        self.times = array('q')
+        # Commit times, for history windows as git log applies them
+        self.commit_times = array('q')
+        self.reviews: Dict[int, List[str]] = {}
+        self.trailers: Dict[int, List[str]] = {}
+        self.paths: Dict[str, List[int]] = {}
+        # Each path's earlier names with the commits which renamed them
+        self.renames: Dict[str, List[Tuple[str, int]]] = {}
+        self.lineages: Dict[str, typing.Set[int]] = {}
+        self.outside_head: List[int] = []
+        self.outside_refs: List[int] = []
+        self.weights: Dict[Tuple[float, int], 'array[float]'] = {}
+        self.trie: Optional[DirectoryTrie] = None
+        self.windows: Dict[Tuple[int, str, str], HistoryWindow] = {}
+
+    @staticmethod
+    def index_path(git_dir: str) -> str:
+        """ Return the location of the index for a git directory """
+        return os.path.join(git_dir, CACHE_DIRECTORY, OwnershipIndex.FILENAME)
+
+    @staticmethod
+    def load(path: str) -> Optional['OwnershipIndex']:
+        """ Read an index from disk, returning None if it is unusable """
+        try:
+            with open(path, 'r') as index_handle:
+                data = json.load(index_handle)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(data, dict) or \
+                data.get('version') != OwnershipIndex.VERSION:
+            return None
+        index = OwnershipIndex()
+        index.head = data['head']
+        index.tips = data['tips']
+        index.shas = data['shas']
+        index.sha_ids = {sha: i for i, sha in enumerate(index.shas)}
+        index.parents = data['parents']
+        index.identities = data['identities']
+        index.identity_ids = {
+            identity: i for i, identity in enumerate(index.identities)
+        }
+        index.authors = array('l', data['authors'])
+        index.times = array('q', data['times'])
+        index.commit_times = array('q', data['commit_times'])
+        index.reviews = {
+            int(commit): reviewers
+            for commit, reviewers in data['reviews'].items()
+        }
+        index.trailers = {
+            int(commit): reviewers
+            for commit, reviewers in data['trailers'].items()
+        }
+        index.paths = data['paths']
+        index.renames = {
+            path: [(previous, commit) for previous, commit in renamed_from]
+            for path, renamed_from in data['renames'].items()
+        }
+        index.outside_head = data['outside_head']
+        index.outside_refs = data['outside_refs']
+        return index
+
+    def save(self, path: str) -> None:
+        """ Atomically write the index to disk """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = {
+            'version': OwnershipIndex.VERSION,
+            'head': self.head,
+            'tips': self.tips,
+            'shas': self.shas,
+            'parents': self.parents,
+            'identities': self.identities,
+            'authors': self.authors.tolist(),
+            'times': self.times.tolist(),
+            'commit_times': self.commit_times.tolist(),
+            'reviews': self.reviews,
+            'trailers': self.trailers,
+            'paths': self.paths,
+            'renames': self.renames,
+            'outside_head': self.outside_head,
+            'outside_refs': self.outside_refs,
+        }
+        temp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(temp_path, 'w') as index_handle:
+            json.dump(data, index_handle, separators=(',', ':'))
+        os.replace(temp_path, path)
+
+    def ingest(self, log_lines: Iterable[str]) -> None:
+        """
+        Add commits from the output of git log run with LOG_FORMAT and
+        --name-status to the index, with the reviewers in their trailers.
+        A rename touches both of its paths and is added to the lineage of
+        its new path.  Commits already in the index are skipped.
+        """
+        self.weights = {}
+        self.trie = None
+        self.lineages = {}
+        parent_shas = {}  # type: Dict[int, List[str]]
+        commit = -1
+        for line in log_lines:
+            if line.startswith(LOG_RECORD_SEPARATOR):
+                header, timestamps, identity, trailers = \
+                    line[1:].split(LOG_RECORD_SEPARATOR, 3)
+                shas = header.split()
+                if shas[0] in self.sha_ids:
+                    commit = -1
+                    continue
+                commit = len(self.shas)
+                self.shas.append(shas[0])
+                self.sha_ids[shas[0]] = commit
+                parent_shas[commit] = shas[1:]
+                self.parents.append([])
+                if identity not in self.identity_ids:
+                    self.identity_ids[identity] = len(self.identities)
+                    self.identities.append(identity)
+                self.authors.append(self.identity_ids[identity])
+                author_time, commit_time = timestamps.split()
+                self.times.append(int(author_time))
+                self.commit_times.append(int(commit_time))
+                reviewers = [
+                    trailer_identity(value)
+                    for value in trailers.split(TRAILER_SEPARATOR)
+                    if value.strip()
+                ]
+                if reviewers:
+                    self.trailers[commit] = reviewers
+            elif line and commit >= 0:
+                fields = line.split('\t')
+                if len(fields) == 3 and fields[0].startswith('R'):
+                    renamed_from = self.renames.setdefault(fields[2], [])
+                    if (fields[1], commit) not in renamed_from:
+                        renamed_from.append((fields[1], commit))
+                for path in fields[1:]:
+                    commits = self.paths.setdefault(path, [])
+                    if not commits or commits[-1] != commit:
+                        commits.append(commit)
+        for commit, parents in parent_shas.items():
+            self.parents[commit] = [
+                self.sha_ids[parent] for parent in parents
+                if parent in self.sha_ids
+            ]
+
+    def ingest_reviews(self, log_lines, first_commit):
+        # type: (Iterable[str], int) -> None
+        """
+        Add the "Reviewed By:" lines from the output of git log run with
+        REVIEW_FORMAT, for commits ingested from first_commit onwards
+        """
+        commit = -1
+        for line in log_lines:
+            if line.startswith(LOG_RECORD_SEPARATOR):
+                commit = self.sha_ids.get(line[1:], -1)
+                if commit < first_commit:
+                    commit = -1
+            elif commit >= 0:
+                reviewers = parse_reviewed_by(line)
+                if reviewers:
+                    self.reviews.setdefault(commit, []).extend(reviewers)
+
+    def reachable(self, shas: List[str]) -> bytearray:
+        """ Flag every indexed commit reachable from a list of commits """
+        flags = bytearray(len(self.shas))
+        stack = [self.sha_ids[sha] for sha in shas if sha in self.sha_ids]
+        while stack:
+            commit = stack.pop()
+            if flags[commit]:
+                continue
+            flags[commit] = 1
+            stack.extend(self.parents[commit])
+        return flags
+
+    def update_reachability(self, head: str, tips: List[str]) -> None:
+        """ Record which commits are reachable from HEAD and from any ref """
+        self.head = head
+        self.tips = tips
+        self.windows = {}
+        head_flags = self.reachable([head])
+        refs_flags = self.reachable(tips)
+        self.outside_head = [i for i, x in enumerate(head_flags) if not x]
+        self.outside_refs = [i for i, x in enumerate(refs_flags) if not x]
+
+    def at_head(self, head: str) -> 'OwnershipIndex':
+        """
+        Return a copy of the index sharing its history, with the commits
+        reachable from another HEAD commit treated as HEAD
+        """
+        index = copy.copy(self)
+        index.head = head
+        index.windows = {}
+        head_flags = self.reachable([head])
+        index.outside_head = [i for i, x in enumerate(head_flags) if not x]
+        return index
+
+    def lineage(self, file_path: str) -> List[str]:
+        """
+        Return a path followed by every name it has been renamed from,
+        following renames back through history
+        """
+        names = [file_path]
+        seen = {file_path}
+        for name in names:
+            for previous, _ in self.renames.get(name, []):
+                if previous not in seen:
+                    seen.add(previous)
+                    names.append(previous)
+        return names
+
+    def lineage_commits(self, file_path: str) -> typing.Set[int]:
+        """
+        Return the commits touching a path or, before it was renamed, any
+        of its earlier names.  Commits to an earlier name only count if they
+        are ancestors of the rename, so that an unrelated file later created
+        under an old name is not mistaken for the renamed file's history.
+        """
+        lineage = self.lineages.get(file_path)
+        if lineage is not None:
+            return lineage
+        lineage = set(self.paths.get(file_path, []))
+        # Names to follow, with the commits that may count for each
+        names = [
+            (file_path, None),
+        ]  # type: List[Tuple[str, Optional[bytearray]]]
+        seen = set()  # type: typing.Set[Tuple[str, int]]
+        for name, allowed in names:
+            for previous, rename in self.renames.get(name, []):
+                if (previous, rename) in seen or \
+                        (allowed is not None and not allowed[rename]):
+                    continue
+                seen.add((previous, rename))
+                ancestors = self.reachable(
+                    [self.shas[x] for x in self.parents[rename]],
+                )
+                lineage.update(
+                    x for x in self.paths.get(previous, []) if ancestors[x]
+                )
+                names.append((previous, ancestors))
+        self.lineages[file_path] = lineage
+        return lineage
+
+    def directory_trie(self, depth: int) -> DirectoryTrie:
+        """ Return a trie of the indexed directories at least depth deep """
+        if self.trie is None or self.trie.depth < depth:
+            self.trie = DirectoryTrie.build(self.paths, depth)
+        return self.trie
+
+    def select_commits(
+        self, file_paths: List[str], excluded: List[int],
+        window: Optional[HistoryWindow] = None, follow: bool = False,
+    ) -> Iterable[int]:
+        """
+        Find the commits touching any of a list of paths, where paths ending
+        in "/" match everything in a directory.  With follow, commits to the
+        earlier names of files are included.  Commits in the excluded list
+        are left out unless a window's revision range replaces them.
+        """
+        if file_paths:
+            commits = set()  # type: typing.Set[int]
+            for file_path in file_paths:
+                if not file_path.endswith('/'):
+                    if follow:
+                        commits.update(self.lineage_commits(file_path))
+                    else:
+                        commits.update(self.paths.get(file_path, []))
+                    continue
+                trie = self.directory_trie(file_path.count('/'))
+                node = trie.find(file_path)
+                if node is not None:
+                    commits.update(node.commits)
+        else:
+            commits = set(range(len(self.shas)))
+        if window is None:
+            return commits.difference(excluded)
+        if window.included is None:
+            commits.difference_update(excluded)
+        return window.select(self, commits)
+
+    def shortlog(self, file_paths, window=None, follow=False):
+        # type: (List[str], Optional[HistoryWindow], bool) -> List[str]
+        """
+        Return the lines `git shortlog -sne HEAD -- <file_paths>` would print
+        for the indexed history, following renames if asked
+        """
+        commits = self.select_commits(
+            file_paths, self.outside_head, window, follow,
+        )
+        counts = Counter(
+            self.identities[self.authors[commit]] for commit in commits
+        )
+        ordered = sorted(counts.items(), key=lambda x: (-x[1], x[0]))
+        return ['%6d\t%s' % (count, name) for name, count in ordered]
+
+    def commit_weights(self, half_life_days, now):
+        # type: (float, float) -> array[float]
+        """
+        Weight every commit by its age at the start of the WEIGHTS_PERIOD
+        containing now, halving the weight of a commit for every half life
+        that has passed since it was authored.  Weights of earlier periods
+        are dropped.
+        """
+        period = int(now // WEIGHTS_PERIOD)
+        key = (half_life_days, period)
+        if key not in self.weights:
+            self.weights = {
+                x: y for x, y in self.weights.items() if x[1] == period
+            }
+            decay = math.log(2) / (half_life_days * 24 * 60 * 60)
+            start = period * WEIGHTS_PERIOD
+            self.weights[key] = array('d', [
+                math.exp(-decay * max(start - commit_time, 0))
+                for commit_time in self.times
+            ])
+        return self.weights[key]
+
+    def author_scores(
+        self, file_paths: List[str], weights: 'array[float]',
+        window: Optional[HistoryWindow] = None, follow: bool = False,
+    ) -> Dict[str, float]:
+        """
+        Sum the weights of the commits in HEAD touching any of a list of
+        paths for each author, following renames if asked
+        """
+        commits = self.select_commits(
+            file_paths, self.outside_head, window, follow,
+        )
+        scores = {}  # type: Dict[str, float]
+        for commit in commits:
+            identity = self.identities[self.authors[commit]]
+            scores[identity] = scores.get(identity, 0) + weights[commit]
+        return scores
+
+    def reviews_from(self, trailers: bool) -> Dict[int, List[str]]:
+        """
+        Return the reviewers of each commit from its trailers, or from its
+        "Reviewed By:" lines
+        """
+        return self.trailers if trailers else self.reviews
+
+    def reviewer_scores(
+        self, file_paths: List[str], weights: 'array[float]',
+        window: Optional[HistoryWindow] = None, trailers: bool = False,
+        follow: bool = False,
+    ) -> Dict[str, float]:
+        """
+        Sum the weights of the reviews of commits touching any of a list of
+        paths for each reviewer, from trailers instead of "Reviewed By:"
+        lines and following renames if asked
+        """
+        reviews = self.reviews_from(trailers)
+        commits = self.select_commits(
+            file_paths, self.outside_refs, window, follow,
+        )
+        scores = {}  # type: Dict[str, float]
+        for commit in commits:
+            for reviewer in reviews.get(commit, []):
+                scores[reviewer] = scores.get(reviewer, 0) + weights[commit]
+        return scores
+
+    def reviewers(
+        self, file_paths: List[str], window: Optional[HistoryWindow] = None,
+        trailers: bool = False, follow: bool = False,
+    ) -> typing.Counter[str]:
+        """
+        Count the reviews of `git log --all -- <file_paths>` for the indexed
+        history, from trailers instead of "Reviewed By:" lines and following
+        renames if asked
+        """
+        reviews = self.reviews_from(trailers)
+        commits = self.select_commits(
+            file_paths, self.outside_refs, window, follow,
+        )
+        reviewers = Counter()  # type: typing.Counter[str]
+        for commit in commits:
+            reviewers.update(reviews.get(commit, []))
+        return reviewers
+
+    def matched_files(
+        self, file_paths: List[str], resolve: Callable[[str], str],
+        window: Optional[HistoryWindow] = None, follow: bool = False,
+    ) -> typing.Counter[str]:
+        """
+        Count the paths in a list which each person has authored commits to
+        on HEAD or reviewed, with identities merged by a resolve function.
+        With follow, commits to the earlier names of each path count too.
+        """
+        counts = Counter()  # type: typing.Counter[str]
+        for file_path in file_paths:
+            people = set()  # type: typing.Set[str]
+            names = [file_path]
+            commits = self.select_commits(
+                names, self.outside_head, window, follow,
+            )
+            for commit in commits:
+                identity = self.identities[self.authors[commit]]
+                email = identity[identity.rfind('<')+1:identity.rfind('>')]
+                people.add(resolve(email))
+            commits = self.select_commits(
+                names, self.outside_refs, window, follow,
+            )
+            for commit in commits:
+                people.update(resolve(x) for x in self.reviews.get(commit, []))
+                people.update(
+                    resolve(x) for x in self.trailers.get(commit, [])
+                )
+            counts.update(people)
+        return counts
+
+
+class IdentityResolver():
+    """
+    Memoized mapping of the raw identities found in history, such as
+    emails and phabricator usernames, to one canonical identity per person.
+    Emails are mapped with the repository's .mailmap and then with the
+    configured aliases, and usernames are stripped from the domains in
+    STRIP_DOMAIN_USERNAMES.
+    """
+    FILENAME = '.mailmap'
+
+    def __init__(
+        self, aliases: Optional[Dict[str, List[str]]] = None,
+        mailmap: Optional[Dict[str, str]] = None,
+    ) -> None:
+        self.mailmap = mailmap or {}
+        self.aliases: Dict[str, str] = {}
+        for canonical, identities in (aliases or {}).items():
+            for identity in identities:
+                self.aliases[identity] = canonical
+        self.resolved: Dict[str, str] = {}
+
+    @staticmethod
+    def mailmap_path(directory: str) -> str:
+        """
+        Return the location of the .mailmap of the work tree containing a
+        directory, or an empty string outside of a work tree
+        """
+        directory = os.path.abspath(directory)
+        while not os.path.exists(os.path.join(directory, '.git')):
+            parent = os.path.dirname(directory)
+            if parent == directory:
+                return ''
+            directory = parent
+        return os.path.join(directory, IdentityResolver.FILENAME)
+
+    @staticmethod
+    def parse_mailmap_entries(lines):
+        # type: (Iterable[str]) -> Dict[str, Dict[str, Tuple[str, str]]]
+        """
+        Parse .mailmap entries the way git does, mapping lower cased commit
+        emails and then lower cased commit names, or an empty string for any
+        name, to a proper name and email.  Empty proper names and emails are
+        left unchanged.
+        """
+        entries = {}  # type: Dict[str, Dict[str, Tuple[str, str]]]
+        for line in lines:
+            if line.startswith('#'):
+                continue
+            people = []  # type: List[Tuple[str, str]]
+            rest = line
+            while len(people) < 2 and '<' in rest and '>' in rest:
+                name, _, rest = rest.partition('<')
+                email, _, rest = rest.partition('>')
+                people.append((name.strip(), email.strip()))
+            if not people:
+                continue
+            proper_name, proper_email = people[0]
+            if len(people) == 1:
+                commit_name, commit_email = '', proper_email
+                proper_email = ''
+            else:
+                commit_name, commit_email = people[1]
+            names = entries.setdefault(commit_email.lower(), {})
+            names[commit_name.lower()] = (proper_name, proper_email)
+        return entries
+
+    @staticmethod
+    def parse_mailmap(lines: Iterable[str]) -> Dict[str, str]:
+        """
+        Map the lower cased commit emails of .mailmap entries to their proper
+        emails.  Commit names are ignored since the finders only see emails,
+        and authors read from git have already been mapped by git itself.
+        """
+        mailmap = {}  # type: Dict[str, str]
+        entries = IdentityResolver.parse_mailmap_entries(lines)
+        for email, names in entries.items():
+            for _, proper_email in names.values():
+                if proper_email:
+                    mailmap[email] = proper_email
+        return mailmap
+
+    @staticmethod
+    def load(config, directory='.'):
+        # type: (Config, str) -> IdentityResolver
+        """ Read the .mailmap of the repository if there is one """
+        mailmap = {}  # type: Dict[str, str]
+        path = IdentityResolver.mailmap_path(directory)
+        try:
+            with open(path, 'r', errors='replace') as mailmap_handle:
+                mailmap = IdentityResolver.parse_mailmap(mailmap_handle)
+        except OSError:
+            pass
+        return IdentityResolver(config.aliases, mailmap)
+
+    def resolve(self, identity: str) -> str:
+        """ Return the canonical identity, resolving each identity once """
+        canonical = self.resolved.get(identity)
+        if canonical is None:
+            canonical = self.canonicalize(identity)
+            self.resolved[identity] = canonical
+        return canonical
+
+    def canonicalize(self, identity: str) -> str:
+        """ Map an identity through the aliases, .mailmap and domains """
+        if identity in self.aliases:
+            identity = self.aliases[identity]
+        else:
+            identity = self.mailmap.get(identity.lower(), identity)
+            identity = self.aliases.get(identity, identity)
+        domain = identity[identity.find('@')+1:]
+        if domain in STRIP_DOMAIN_USERNAMES:
+            return identity[:identity.find('@')]
+        return identity
+
+
+class UserCache():
+    """
+    Cache of whether phabricator users are usable as reviewers, stored
+    under the repository's git directory
+    """
+    VERSION = 1
+    FILENAME = 'users.json'
 
-class FindReviewers():
     def __init__(self, config):  # type: (Config) -> None
         self.config = config
+        self.users: Dict[str, Tuple[bool, float]] = {}
+
+    @staticmethod
+    def cache_path(git_dir: str) -> str:
+        """ Return the location of the user cache for a git directory """
+        return os.path.join(git_dir, CACHE_DIRECTORY, UserCache.FILENAME)
+
+    @staticmethod
+    def load(path, config):
+        # type: (str, Config) -> UserCache
+        """ Read a user cache from disk, or an empty cache on failure """
+        cache = UserCache(config)
+        try:
+            with open(path, 'r') as cache_handle:
+                data = json.load(cache_handle)
+            if data.get('version') == UserCache.VERSION:
+                cache.users = {
+                    username: (bool(status[0]), float(status[1]))
+                    for username, status in data['users'].items()
+                }
+        except (OSError, ValueError, AttributeError, KeyError, TypeError):
+            pass
+        return cache
+
+    def save(self, path: str) -> None:
+        """ Evict the oldest entries over the size limit and write to disk """
+        limit = max(0, self.config.user_cache_size)
+        if len(self.users) > limit:
+            ordered = sorted(self.users.items(), key=lambda x: -x[1][1])
+            self.users = dict(ordered[:limit])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = {'version': UserCache.VERSION, 'users': self.users}
+        temp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(temp_path, 'w') as cache_handle:
+            json.dump(data, cache_handle)
+        os.replace(temp_path, path)
+
+    def get(self, username: str, now: float) -> Optional[bool]:
+        """ Return whether a user is usable, or None if unknown or expired """
+        if username not in self.users:
+            return None
+        active, checked = self.users[username]
+        ttl = self.config.user_cache_ttl
+        if not active:
+            ttl = self.config.user_cache_negative_ttl
+        if now - checked >= ttl:
+            return None
+        return active
+
+    def set(self, username: str, active: bool, now: float) -> None:
+        """ Record whether a user is usable """
+        self.users[username] = (active, now)
+
+
+class BlameCache():
+    """
+    Content addressed cache of parsed git blame results, keyed by the blob
+    SHA and path of a file, and evicted least recently used first once the
+    cache directory grows beyond a size limit
+    """
+    DIRECTORY = 'blame'
+
+    def __init__(self, directory: str, size_limit: int) -> None:
+        self.directory = directory
+        self.size_limit = size_limit
+        self.hits = 0
+        self.misses = 0
+        import threading  # NOQA: PLC0415
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def cache_directory(git_dir: str) -> str:
+        """ Return the location of the blame cache for a git directory """
+        return os.path.join(git_dir, CACHE_DIRECTORY, BlameCache.DIRECTORY)
+
+    def entry_path(self, blob: str, file_path: str) -> str:
+        import hashlib  # NOQA: PLC0415
+        path_hash = hashlib.sha1(file_path.encode('utf-8')).hexdigest()
+        return os.path.join(
+            self.directory, '%s-%s.json' % (blob, path_hash[:16]),
+        )
+
+    def load(self, blob: str, file_path: str) -> Dict[int, str]:
+        """ Read the blamed lines of a file, marking the entry as used """
+        path = self.entry_path(blob, file_path)
+        try:
+            with open(path, 'r') as cache_handle:
+                data = json.load(cache_handle)
+            os.utime(path)
+        except (OSError, ValueError):
+            return {}
+        if not isinstance(data, dict):
+            return {}
+        return {int(line): email for line, email in data.items()}
+
+    def save(self, blob, file_path, lines):
+        # type: (str, str, Dict[int, str]) -> None
+        """ Write the blamed lines of a file """
+        import threading  # NOQA: PLC0415
+        path = self.entry_path(blob, file_path)
+        os.makedirs(self.directory, exist_ok=True)
+        temp_path = '%s.%d.%d.tmp' % (
+            path, os.getpid(), threading.get_ident(),
+        )
+        with open(temp_path, 'w') as cache_handle:
+            json.dump(lines, cache_handle, separators=(',', ':'))
+        os.replace(temp_path, path)
+
+    def record(self, hit: bool) -> None:
+        """ Count a cache lookup """
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def evict(self) -> None:
+        """ Remove least recently used entries beyond the size limit """
+        entries = []
+        try:
+            for entry in os.scandir(self.directory):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        except OSError:
+            return
+        total = sum(entry[1] for entry in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.size_limit:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+class Profiler():
+    """
+    Collects timings of finders and of the subprocesses they run.  Sinks
+    added with add_sink are called with each record as it is made.
+    """
+    def __init__(self) -> None:
+        self.records: List[Dict[str, Any]] = []
+        self.sinks: List[Callable[[Dict[str, Any]], None]] = []
+        import threading  # NOQA: PLC0415
+        self.lock = threading.Lock()
+
+    def add_sink(self, sink: Callable[[Dict[str, Any]], None]) -> None:
+        """ Call a function with every future record """
+        self.sinks.append(sink)
+
+    def record(self, kind, finder, wall_time, **fields):
+        # type: (str, str, float, Any) -> None
+        """ Record the wall time of a finder or command """
+        record = {'kind': kind, 'finder': finder, 'wall_time': wall_time}
+        record.update(fields)
+        with self.lock:
+            self.records.append(record)
+            for sink in self.sinks:
+                sink(record)
+
+    def format_table(self) -> str:
+        """ Format the records as a table """
+        lines = ['%-8s %-24s %9s %11s %9s %9s  %s' % (
+            'kind', 'finder', 'wall (s)', 'bytes', 'lines', 'parse (s)',
+            'command',
+        )]
+        for record in self.records:
+            command = record.get('command', '')
+            if len(command) > 60:
+                command = command[:57] + '...'
+            lines.append('%-8s %-24s %9.3f %11s %9s %9s  %s' % (
+                record['kind'], record['finder'], record['wall_time'],
+                record.get('bytes_read', ''), record.get('lines', ''),
+                '%.3f' % record['parse_time'] if 'parse_time' in record
+                else '',
+                command,
+            ))
+        return '\n'.join(lines)
+
+    def write_json(self, path: str) -> None:
+        """ Write the records to a json file """
+        with open(path, 'w') as profile_handle:
+            json.dump(self.records, profile_handle, indent=4)
+
+
+class FindReviewers():
+    # Whether reviewers are phabricator usernames to be checked for disabled
+    # users before they are suggested
+    PHABRICATOR_USERS = False
+    # Whether scores are read from history bounded by the history window
+    HISTORY_WINDOW = False
+    # Whether file contents are read, which partial clones may leave out
+    READS_BLOBS = False
+    # Whether the finder runs unless turned off in the finders config
+    DEFAULT_ENABLED = True
+
+    def __init__(self, config, index=None):
+        # type: (Config, Optional[OwnershipIndex]) -> None
+        self.config = config
+        self.index = index
+        # time.monotonic() after which the finder's commands are killed
+        self.deadline = None  # type: Optional[float]
+
+    def has_source(self) -> bool:
+        """
+        Cheaply check whether there is anything for this finder to look at,
+        so that it can be skipped otherwise
+        """
+        return True
 
     def get_reviewers(self):  # type: () -> typing.Counter[str]
         """
@@ -30,27 +1071,353 @@ class FindReviewers():
         """
         raise NotImplementedError()
 
-    def run_command(self, command: List[str]) -> List[str]:
+    def get_scores(self) -> Mapping[str, float]:
+        """
+        Return a score for each reviewer.  By default this is the reviewer's
+        count from get_reviewers.
+        """
+        return self.get_reviewers()
+
+    def get_source_scores(self) -> Mapping[str, float]:
+        """ Score reviewers, skipping the finder if it has no source """
+        if not self.has_source():
+            return {}
+        return self.get_scores()
+
+    async def get_scores_async(self) -> Mapping[str, float]:
+        """
+        Awaitable version of get_source_scores, which runs it in a thread so
+        that neither the source check nor the scoring blocks the event loop
+        """
+        return await run_in_thread(self.get_source_scores)
+
+    def run_command(
+        self, command: List[str], input_data: Optional[str] = None,
+    ) -> List[str]:
         """ Wrapper for running external subprocesses """
-        process = subprocess.run(command, stdout=subprocess.PIPE, check=False)
-        data = process.stdout.decode("utf-8").strip()
-        if data:
-            return data.split('\n')
-        return []
+        start = time.perf_counter()
+        process = subprocess.run(
+            command,
+            input=None if input_data is None else input_data.encode('utf-8'),
+            stdout=subprocess.PIPE,
+            env=self.get_environment(),
+            timeout=self.remaining_time(command),
+            check=False,
+        )
+        return self.split_output(command, process.stdout, start)
+
+    def remaining_time(self, command: List[str]) -> Optional[float]:
+        """
+        Return the seconds left for a command before the finder's deadline,
+        if it has one, raising subprocess.TimeoutExpired once it has passed
+        """
+        if self.deadline is None:
+            return None
+        remaining = self.deadline - time.monotonic()
+        if remaining <= 0:
+            raise subprocess.TimeoutExpired(command, 0)
+        return remaining
+
+    async def run_command_async(
+        self, command: List[str], input_data: Optional[str] = None,
+    ) -> List[str]:
+        """
+        Wrapper for running external subprocesses from an event loop.  The
+        subprocess is killed if the caller is cancelled.
+        """
+        import asyncio  # NOQA: PLC0415
+        start = time.perf_counter()
+        process = await asyncio.create_subprocess_exec(
+            *command,
+            stdin=None if input_data is None else subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            env=self.get_environment(),
+        )
+        try:
+            stdout, _ = await process.communicate(
+                None if input_data is None else input_data.encode('utf-8'),
+            )
+        except asyncio.CancelledError:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            raise
+        return self.split_output(command, stdout, start)
+
+    def get_environment(self) -> Optional[Dict[str, str]]:
+        """
+        Return the environment for subprocesses, which stops git from
+        fetching missing objects when blobs are skipped so that reading
+        anything left out of a partial clone fails instead of going to the
+        network
+        """
+        if self.config.blobs != 'skip':
+            return None
+        environment = dict(os.environ)
+        environment['GIT_NO_LAZY_FETCH'] = '1'
+        return environment
+
+    def split_output(self, command, output, start):
+        # type: (List[str], bytes, float) -> List[str]
+        """ Split the output of a finished subprocess into lines """
+        parse_start = time.perf_counter()
+        data = output.decode("utf-8").strip()
+        lines = data.split('\n') if data else []
+        if self.config.profiler is not None:
+            end = time.perf_counter()
+            self.config.profiler.record(
+                'command', type(self).__name__, end - start,
+                command=' '.join(command), bytes_read=len(output),
+                lines=len(lines), parse_time=end - parse_start,
+            )
+        return lines
+
+    def stream_command(
+        self, command: List[str], input_data: Optional[str] = None,
+    ) -> Iterator[str]:
+        """
+        Run an external subprocess, yielding lines of its output as they are
+        produced so that large outputs are never held in memory.  The
+        subprocess is killed at the finder's deadline.
+        """
+        import threading  # NOQA: PLC0415
+        timeout = self.remaining_time(command)
+        process = subprocess.Popen(
+            command,
+            stdin=None if input_data is None else subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            env=self.get_environment(),
+        )
+        assert process.stdout is not None
+        timer = None
+        if timeout is not None:
+            timer = threading.Timer(timeout, process.kill)
+            timer.daemon = True
+            timer.start()
+        writer = None
+        if input_data is not None:
+            writer = threading.Thread(
+                target=self._write_input, args=(process, input_data),
+            )
+            writer.start()
+        profiler = self.config.profiler
+        start = time.perf_counter()
+        read_time = 0.0
+        bytes_read = 0
+        lines = 0
+        completed = False
+        try:
+            if profiler is None:
+                for raw_line in process.stdout:
+                    yield raw_line.decode('utf-8').rstrip('\n')
+            else:
+                while True:
+                    read_start = time.perf_counter()
+                    raw_line = process.stdout.readline()
+                    read_time += time.perf_counter() - read_start
+                    if not raw_line:
+                        break
+                    bytes_read += len(raw_line)
+                    lines += 1
+                    yield raw_line.decode('utf-8').rstrip('\n')
+            self.remaining_time(command)
+            completed = True
+        finally:
+            if timer is not None:
+                timer.cancel()
+            if not completed:
+                process.kill()
+            process.stdout.close()
+            process.wait()
+            if writer is not None:
+                writer.join()
+            if profiler is not None:
+                wall_time = time.perf_counter() - start
+                profiler.record(
+                    'command', type(self).__name__, wall_time,
+                    command=' '.join(command), bytes_read=bytes_read,
+                    lines=lines, parse_time=wall_time - read_time,
+                )
+
+    @staticmethod
+    def _write_input(
+        process: 'subprocess.Popen[bytes]', input_data: str,
+    ) -> None:
+        assert process.stdin is not None
+        try:
+            process.stdin.write(input_data.encode('utf-8'))
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
 
     def extract_username_from_email(self, email: str) -> str:
-        """ Given an email, extract the username for that email """
-        domain = email[email.find('@')+1:]
-        if domain in STRIP_DOMAIN_USERNAMES:
-            return email[:email.find('@')]
-        return email
+        """ Given an email, extract the canonical username for that email """
+        identities = self.config.identities
+        if identities is None:
+            identities = IdentityResolver.load(self.config)
+            self.config.identities = identities
+        return identities.resolve(email)
+
+    def get_index(self) -> Optional[OwnershipIndex]:
+        """
+        Return the ownership index shared with other finders, falling back
+        to the on-disk index if enabled
+        """
+        if self.index is None and self.config.index:
+            self.index = self.build_index()
+        return self.index
+
+    def build_index(self, index=None):
+        # type: (Optional[OwnershipIndex]) -> Optional[OwnershipIndex]
+        """
+        Bring the ownership index up to date with the refs of the current
+        repository with a git log traversal of new commits, followed by a
+        git log --grep pass for their "Reviewed By:" lines.  The index is
+        read from and written to disk if enabled, unless an in-memory index
+        is given to be updated.  With the native backend, history is read
+        from the git directory without running git where possible.  Returns
+        None outside of a repository.
+        """
+        resolve_blobs(self.config)
+        native = None  # type: Optional[NativeRepository]
+        if self.config.backend == 'native':
+            backend = import_native()
+            try:
+                native = backend.NativeRepository.open('.')
+                git_dir = native.git_dir
+                head, tips = native.head_and_tips()
+            except backend.native_errors():
+                native = None
+        if native is None:
+            rev_parse = self.run_command(
+                ['git', 'rev-parse', '--git-dir', 'HEAD'],
+            )
+            if len(rev_parse) != 2 or not os.path.isdir(rev_parse[0]):
+                return None
+            git_dir, head = rev_parse
+            refs = self.run_command([
+                'git', 'for-each-ref', '--format=%(objectname) %(*objectname)',
+            ])
+            tips = sorted(set([head] + [ref.split()[-1] for ref in refs]))
+        index_path = OwnershipIndex.index_path(git_dir)
+        if index is None and self.config.index and \
+                not self.config.rebuild_index:
+            index = OwnershipIndex.load(index_path)
+        if index is not None and index.head == head and index.tips == tips:
+            return index
+        if index is None:
+            index = OwnershipIndex()
+        if native is not None:
+            try:
+                native.ingest(index, tips)
+            except backend.native_errors():
+                index = OwnershipIndex()
+                native = None
+        if native is None:
+            self.ingest_log(index)
+        index.update_reachability(head, tips)
+        if self.config.index:
+            try:
+                index.save(index_path)
+            except OSError:
+                pass
+        return index
+
+    def ingest_log(self, index: OwnershipIndex) -> None:
+        """
+        Add the commits of all refs to an index with git log, leaving out
+        commits reachable from the refs the index was built at.  When blobs
+        are skipped, only renames of unchanged files are detected.
+        """
+        renames = EXACT_RENAMES if self.config.blobs == 'skip' else '-M'
+        log_command = ['git', 'log', OwnershipIndex.LOG_FORMAT]
+        log_command += ['--name-status', renames, '--cc']
+        review_command = ['git', 'log', OwnershipIndex.REVIEW_FORMAT]
+        review_command += [OwnershipIndex.REVIEWERS_PATTERN]
+        revisions = ['--all']
+        exclude = None
+        if index.tips:
+            revisions += ['--ignore-missing', '--stdin']
+            exclude = ''.join('^%s\n' % tip for tip in index.tips)
+        first_commit = len(index.shas)
+        index.ingest(self.stream_command(log_command + revisions, exclude))
+        index.ingest_reviews(
+            self.stream_command(review_command + revisions, exclude),
+            first_commit,
+        )
+
+    def get_window(self) -> Optional[HistoryWindow]:
+        """
+        Resolve the configured history window against the ownership index.
+        Windows are kept in the index to be shared with other finders.
+        """
+        config = self.config
+        index = self.get_index()
+        if index is None or not (
+            config.max_commits or config.since or config.revision_range
+        ):
+            return None
+        key = (config.max_commits, config.since, config.revision_range)
+        window = index.windows.get(key)
+        if window is not None:
+            return window
+        since = 0
+        if config.since:
+            max_age = self.run_command(
+                ['git', 'rev-parse', '--since=%s' % config.since],
+            )
+            if max_age and max_age[0].startswith('--max-age='):
+                since = int(max_age[0][len('--max-age='):])
+        included = None
+        if config.revision_range:
+            revisions = self.run_command(
+                ['git', 'rev-parse', config.revision_range],
+            )
+            positive = index.reachable(
+                [x for x in revisions if not x.startswith('^')],
+            )
+            negative = index.reachable(
+                [x[1:] for x in revisions if x.startswith('^')],
+            )
+            included = bytearray(
+                x & (1 - y) for x, y in zip(positive, negative)
+            )
+        window = HistoryWindow(config.max_commits, since, included)
+        index.windows[key] = window
+        return window
+
+    def get_window_arguments(self, revision: str) -> List[str]:
+        """
+        Return git log arguments bounding history to the configured window,
+        walking from a revision unless a revision range is configured
+        """
+        arguments = []
+        if self.config.max_commits:
+            arguments.append('--max-count=%d' % self.config.max_commits)
+        if self.config.since:
+            arguments.append('--since=%s' % self.config.since)
+        arguments.append(self.config.revision_range or revision)
+        return arguments
+
+    def get_diff_revisions(self) -> List[str]:
+        """
+        Return the git diff arguments comparing the base branch against the
+        head revision, or against the working tree if no head is configured
+        """
+        revisions = [self.config.base_branch]
+        if self.config.head:
+            revisions.append(self.config.head)
+        return revisions
 
     def check_phabricator_activated(
-        self, username: str,
+        self, usernames: List[str],
     ) -> subprocess.Popen[bytes]:
-        """ Check whether a phabricator user has been activated by """
+        """ Check whether a batch of phabricator users have been activated """
         phab_command = ['arc', 'call-conduit', 'user.search']
-        request = '{"constraints": {"usernames": ["%s"]}}' % username
+        request = json.dumps({
+            'constraints': {'usernames': usernames},
+            'limit': len(usernames),
+        })
         process = subprocess.Popen(
             phab_command,
             stdin=subprocess.PIPE,
@@ -58,8 +1425,12 @@ class FindReviewers():
         process.communicate(input=request.encode("utf-8"))
         return process
 
-    def parse_phabricator(self, username, process):
-        # type: (str, subprocess.Popen[bytes]) -> str
+    def parse_phabricator(self, usernames, process):
+        # type: (List[str], subprocess.Popen[bytes]) -> List[str]
+        """
+        Read the roles of a batch of users from a conduit response and
+        return the users which have not been disabled, in order
+        """
         stdout, stderr = process.communicate()
         if process.returncode != 0:
             print("stdout: %s" % stdout.decode("utf-8"))
@@ -68,32 +1439,187 @@ class FindReviewers():
         output_str = stdout.decode("utf-8").strip()
         phab_output = json.loads(output_str)
         data = phab_output['response']['data']
-        if not data:
-            return username
-        roles = data[0]['fields']['roles']
-        if 'disabled' in roles:
+        disabled = set(
+            user['fields']['username'].lower() for user in data
+            if 'disabled' in user['fields']['roles']
+        )
+        return [x for x in usernames if x.lower() not in disabled]
+
+    def check_phabricator_users(self, usernames: List[str]) -> List[str]:
+        """ Return the usable users from a batch of phabricator users """
+        start = time.perf_counter()
+        process = self.check_phabricator_activated(usernames)
+        parse_start = time.perf_counter()
+        usable_users = self.parse_phabricator(usernames, process)
+        if self.config.profiler is not None:
+            end = time.perf_counter()
+            self.config.profiler.record(
+                'command', type(self).__name__, end - start,
+                command='arc call-conduit user.search',
+                lines=len(usernames), parse_time=end - parse_start,
+            )
+        return usable_users
+
+    def get_user_cache_path(self) -> str:
+        """ Return where to cache phabricator users, or '' if disabled """
+        if self.config.user_cache_ttl <= 0:
             return ''
-        return username
+        git_dir = self.run_command(['git', 'rev-parse', '--git-dir'])
+        if not git_dir or not os.path.isdir(git_dir[0]):
+            return ''
+        return UserCache.cache_path(git_dir[0])
 
     def filter_phabricator_activated(self, all_users: List[str]) -> List[str]:
-        limited_users = all_users[:REVIEWERS_LIMIT]
-        username_processes = [
-            (x, self.check_phabricator_activated(x)) for x in limited_users
-        ]
-        usernames = [self.parse_phabricator(*x) for x in username_processes]
-        usernames = [x for x in usernames if x]
-        if len(usernames) < REVIEWERS_LIMIT:
-            for username in all_users[REVIEWERS_LIMIT:]:
-                check_proc = self.check_phabricator_activated(username)
-                parsed_username = self.parse_phabricator(username, check_proc)
-                if parsed_username:
-                    usernames.append(parsed_username)
-                    if len(usernames) >= REVIEWERS_LIMIT:
-                        break
+        """
+        Filter out disabled phabricator users, keeping the first limit
+        usable users in rank order.  Users not in the user
+        cache are checked in batches of phabricator_batch_size by a pool that
+        keeps up to phabricator_concurrency batches in flight.
+        """
+        from concurrent.futures import ThreadPoolExecutor  # NOQA: PLC0415
+        now = time.time()
+        cache_path = self.get_user_cache_path()
+        cache = UserCache.load(cache_path, self.config)
+        statuses = {}  # type: Dict[str, bool]
+        if cache_path and not self.config.refresh_users:
+            for username in all_users:
+                status = cache.get(username, now)
+                if status is not None:
+                    statuses[username] = status
+        unknown_users = [x for x in all_users if x not in statuses]
+        batch_size = max(1, self.config.phabricator_batch_size)
+        batches = iter([
+            unknown_users[i:i + batch_size]
+            for i in range(0, len(unknown_users), batch_size)
+        ])  # type: Iterator[List[str]]
+        usernames = []  # type: List[str]
+        pending: typing.Deque[
+            Tuple[List[str], 'Future[List[str]]']
+        ] = deque()
+        concurrency = max(1, self.config.phabricator_concurrency)
+        executor = ThreadPoolExecutor(max_workers=concurrency)
+        try:
+            for username in all_users:
+                while username not in statuses:
+                    while len(pending) < concurrency:
+                        next_batch = next(batches, None)
+                        if next_batch is None:
+                            break
+                        future = executor.submit(
+                            self.check_phabricator_users, next_batch,
+                        )
+                        pending.append((next_batch, future))
+                    batch, future = pending.popleft()
+                    active_users = set(future.result())
+                    for checked_user in batch:
+                        active = checked_user in active_users
+                        statuses[checked_user] = active
+                        cache.set(checked_user, active, now)
+                if statuses[username]:
+                    usernames.append(username)
+                if len(usernames) >= self.config.reviewers_limit():
+                    break
+        finally:
+            for _, future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+        if cache_path:
+            try:
+                cache.save(cache_path)
+            except OSError:
+                pass
         return usernames
 
 
+FINDERS = []  # type: List[Type[FindReviewers]]
+
+
+def register_finder(finder: Type[FindReviewers]) -> Type[FindReviewers]:
+    """ Class decorator adding a finder to those run by get_reviewers """
+    FINDERS.append(finder)
+    return finder
+
+
+def finder_enabled(config, name, default=True):
+    # type: (Config, str, bool) -> bool
+    """ Check whether a finder is enabled and has a nonzero weight """
+    if not config.finders.get(name, default):
+        return False
+    return config.finder_weights.get(name, 1) != 0
+
+
+def finder_entry_points() -> List[Any]:
+    """ List the finders other packages register as entry points """
+    try:
+        # Imported lazily as importlib.metadata is slow to import
+        from importlib import metadata  # NOQA: PLC0415
+    except ImportError:  # Python 3.7
+        return []
+    entry_points = typing.cast(Any, metadata.entry_points())
+    if hasattr(entry_points, 'select'):
+        return list(entry_points.select(group=FINDER_ENTRY_POINT_GROUP))
+    return list(entry_points.get(FINDER_ENTRY_POINT_GROUP, []))
+
+
+def get_finders(config):  # type: (Config) -> List[Type[FindReviewers]]
+    """
+    Return the enabled finders in the order they are run, the registered
+    finders followed by entry point finders.  Entry points are named after
+    their finder and are only loaded if enabled.
+    """
+    finders = [
+        x for x in FINDERS
+        if finder_enabled(config, x.__name__, x.DEFAULT_ENABLED)
+    ]
+    names = set(x.__name__ for x in FINDERS)
+    for entry_point in finder_entry_points():
+        if entry_point.name in names or \
+                not finder_enabled(config, entry_point.name):
+            continue
+        names.add(entry_point.name)
+        finders.append(entry_point.load())
+    if config.blobs == 'skip':
+        finders = [x for x in finders if not x.READS_BLOBS]
+    return finders
+
+
+def resolve_blobs(config):  # type: (Config) -> None
+    """
+    Decide up front whether finders may read file contents.  With blobs set
+    to auto, they are skipped in partial clones which only leave out blobs,
+    as reading a missing blob would fetch it from the promisor remote.
+    Partial clones which also leave out trees still read blobs, since their
+    history cannot be read without fetching.
+    """
+    if config.blobs != 'auto':
+        return
+    settings = FindReviewers(config).run_command(
+        ['git', 'config', '--get-regexp', PARTIAL_CLONE_CONFIG],
+    )
+    partial_clone = False
+    filters = []
+    for setting in settings:
+        key, _, value = setting.partition(' ')
+        if key.endswith('.partialclonefilter'):
+            filters.append(value)
+        elif key == 'extensions.partialclone' or value == 'true':
+            partial_clone = True
+    blob_filters = all(x.startswith('blob:') for x in filters)
+    config.blobs = 'skip' if partial_clone and blob_filters else 'read'
+
+
 class FindFileLogReviewers(FindReviewers):
+    HISTORY_WINDOW = True
+
+    def has_source(self) -> bool:
+        """
+        Skip repositories without any commits if there is an index to tell.
+        Without one, an empty history is left to git, which finds nothing.
+        """
+        if self.index is not None:
+            return bool(self.index.shas)
+        return True
+
     def extract_username_from_shortlog(self, shortlog: str) -> Tuple[str, int]:
         """ Given a line from a git shortlog, extract the username """
         shortlog = shortlog.strip()
@@ -106,66 +1632,466 @@ class FindFileLogReviewers(FindReviewers):
     def get_log_reviewers_from_file(self, file_paths):
         # type: (List[str]) -> typing.Counter[str]
         """ Find the reviewers based on the git log for a file """
-        git_shortlog_command = ['git', 'shortlog', '-sne']
+        index = self.get_index()
+        if index is not None:
+            git_shortlog = index.shortlog(
+                file_paths, self.get_window(), self.config.follow_renames,
+            )
+        else:
+            git_shortlog = self.get_shortlog(file_paths)
+        users = Counter()  # type: typing.Counter[str]
+        for shortlog in git_shortlog:
+            reviewer, count = self.extract_username_from_shortlog(shortlog)
+            if reviewer:
+                users[reviewer] += count
+        return users
+
+    def get_shortlog(self, file_paths: List[str]) -> List[str]:
+        """
+        Run git shortlog for a set of files without using the index.  Long
+        lists of paths are passed to git log on stdin instead of argv.
+        """
+        window = self.get_window_arguments('HEAD')
+        if len(file_paths) > PATHSPEC_ARGV_LIMIT:
+            command = ['git', 'log', '--format=%aN <%aE>', '--stdin'] + window
+            pathspecs = '--\n' + ''.join('%s\n' % x for x in file_paths)
+            counts = Counter(self.stream_command(command, pathspecs))
+            ordered = sorted(counts.items(), key=lambda x: (-x[1], x[0]))
+            return ['%6d\t%s' % (count, name) for name, count in ordered]
+        git_shortlog_command = ['git', 'shortlog', '-sne'] + window
         if file_paths:
             git_shortlog_command += ['--'] + file_paths
-        git_shortlog = self.run_command(git_shortlog_command)
-        users = dict(
-            self.extract_username_from_shortlog(shortlog)
-            for shortlog
-            in git_shortlog
-        )
-        users = {
-            reviewer: count for (reviewer, count)
-            in users.items() if reviewer
+        return self.run_command(git_shortlog_command)
+
+    def get_changed_files(self) -> List[str]:
+        raise NotImplementedError()
+
+    def get_file_paths(self) -> List[str]:
+        """
+        Return the paths to look up history for.  Diffs of more than
+        directory_threshold files are rolled up into their directories down
+        to directory_depth, given as paths ending in "/".
+        """
+        return self.roll_up(self.get_changed_files())
+
+    def roll_up(self, changed_files: List[str]) -> List[str]:
+        """ Roll up a long list of files into their directories """
+        if len(changed_files) <= self.config.directory_threshold:
+            return changed_files
+        depth = max(1, self.config.directory_depth)
+        file_paths = []  # type: List[str]
+        seen = set()  # type: typing.Set[str]
+        for changed_file in changed_files:
+            parts = changed_file.split('/')
+            file_path = changed_file
+            if len(parts) > 1:
+                file_path = '/'.join(parts[:min(depth, len(parts) - 1)]) + '/'
+            if file_path not in seen:
+                seen.add(file_path)
+                file_paths.append(file_path)
+        return file_paths
+
+    def get_reviewers(self):  # type: () -> typing.Counter[str]
+        """ Find the reviewers based on the git log of the diffed files """
+        file_paths = self.get_file_paths()
+        reviewers = self.get_log_reviewers_from_file(file_paths)
+        return reviewers
+
+    def get_scores(self) -> Mapping[str, float]:
+        """
+        Score reviewers by their commits with each commit decaying in
+        weight with age if half_life_days is configured
+        """
+        index = self.get_index()
+        if not self.config.half_life_days or index is None:
+            return super().get_scores()
+        weights = index.commit_weights(self.config.half_life_days, time.time())
+        return self.get_decayed_scores(index, weights)
+
+    def get_decayed_scores(self, index, weights):
+        # type: (OwnershipIndex, array[float]) -> Dict[str, float]
+        """ Score authors of the diffed files by their weighted commits """
+        scores = {}  # type: Dict[str, float]
+        author_scores = index.author_scores(
+            self.get_file_paths(), weights, self.get_window(),
+            self.config.follow_renames,
+        )
+        for identity, score in author_scores.items():
+            email = identity[identity.rfind('<')+1:identity.rfind('>')]
+            username = self.extract_username_from_email(email)
+            if username:
+                scores[username] = scores.get(username, 0) + score
+        return scores
+
+
+@register_finder
+class FindLogReviewers(FindFileLogReviewers):
+    def __init__(self, config, index=None):
+        # type: (Config, Optional[OwnershipIndex]) -> None
+        super().__init__(config, index)
+        self.changed_files = None  # type: Optional[List[str]]
+
+    def get_changed_files_command(self) -> List[str]:
+        resolve_blobs(self.config)
+        revisions = self.get_diff_revisions()
+        command = ['git', 'diff'] + revisions + ['--name-only']
+        if self.config.blobs == 'skip':
+            command.append(EXACT_RENAMES)
+        return command
+
+    def get_changed_files(self) -> List[str]:
+        """ Find the changed files between current status and master """
+        if self.config.changed_files is not None:
+            return self.config.changed_files
+        if self.changed_files is None:
+            command = self.get_changed_files_command()
+            self.changed_files = self.run_command(command)
+        return self.changed_files
+
+    def get_matched_files(self) -> typing.Counter[str]:
+        """ Count the diffed files each reviewer has authored or reviewed """
+        index = self.get_index()
+        if index is None:
+            return self.get_log_matched_files(self.get_file_paths())
+        return index.matched_files(
+            self.get_file_paths(),
+            self.extract_username_from_email, self.get_window(),
+            self.config.follow_renames,
+        )
+
+    def get_log_matched_files(self, file_paths):
+        # type: (List[str]) -> typing.Counter[str]
+        """
+        Count the diffed files each person has authored commits to on HEAD
+        or reviewed in a trailer, with git log instead of the index
+        """
+        if not file_paths:
+            return Counter()
+        people = {
+            x: set() for x in file_paths
+        }  # type: Dict[str, typing.Set[str]]
+        directories = [x for x in file_paths if x.endswith('/')]
+        command = ['git', 'log', '--name-only']
+        command.append('--format=%x00%aE%x00' + TRAILER_FORMAT)
+        window = self.get_window_arguments('HEAD')
+        if len(file_paths) > PATHSPEC_ARGV_LIMIT:
+            pathspecs = '--\n' + ''.join('%s\n' % x for x in file_paths)
+            lines = self.stream_command(
+                command + ['--stdin'] + window, pathspecs,
+            )
+        else:
+            lines = self.stream_command(command + window + ['--'] + file_paths)
+        identities = []  # type: List[str]
+        for line in lines:
+            if line.startswith(LOG_RECORD_SEPARATOR):
+                email, trailers = line[1:].split(LOG_RECORD_SEPARATOR, 1)
+                identities = [self.extract_username_from_email(email)]
+                identities += [
+                    self.extract_username_from_email(trailer_identity(x))
+                    for x in trailers.split(TRAILER_SEPARATOR) if x.strip()
+                ]
+            elif line:
+                if line in people:
+                    people[line].update(identities)
+                for directory in directories:
+                    if line.startswith(directory):
+                        people[directory].update(identities)
+        counts = Counter()  # type: typing.Counter[str]
+        for file_people in people.values():
+            counts.update(file_people)
+        return counts
+
+    async def get_scores_async(self) -> Mapping[str, float]:
+        """
+        Check for a source and find the changed files without blocking the
+        event loop, then score reviewers in a thread
+        """
+        if not await run_in_thread(self.has_source):
+            return {}
+        if self.config.changed_files is None and self.changed_files is None:
+            command = self.get_changed_files_command()
+            self.changed_files = await self.run_command_async(command)
+        return await run_in_thread(self.get_scores)
+
+
+@register_finder
+class FindHistoricalReviewers(FindFileLogReviewers):
+    def get_changed_files(self) -> List[str]:
+        """ Consider the history of the whole repository """
+        return []
+
+    def get_reviewers(self):  # type: () -> typing.Counter[str]
+        reviewers = self.get_log_reviewers_from_file([])
+        return reviewers
+
+
+@register_finder
+class FindBlameReviewers(FindReviewers):
+    """
+    Get reviewers based on who last changed the lines of the base branch
+    which are modified on your branch
+    """
+    DEFAULT_ENABLED = False
+    READS_BLOBS = True
+    ZERO_SHA = '0' * 40
+
+    def __init__(self, config, index=None):
+        # type: (Config, Optional[OwnershipIndex]) -> None
+        super().__init__(config, index)
+        self.blame_cache = None  # type: Optional[BlameCache]
+
+    def get_changed_hunks(self) -> Dict[str, List[Tuple[int, int]]]:
+        """
+        Find the line ranges of files on the base branch which are changed
+        between the current status and the base branch
+        """
+        git_diff_command = [
+            'git', 'diff', '-U0', '--no-color', '--no-ext-diff',
+            '--src-prefix=a/', '--dst-prefix=b/',
+        ] + self.get_diff_revisions()
+        hunks = {}  # type: Dict[str, List[Tuple[int, int]]]
+        file_path = ''
+        for line in self.stream_command(git_diff_command):
+            if line.startswith('--- '):
+                # Paths with spaces are followed by a tab, and paths with
+                # special characters are quoted along with their prefix
+                file_path = unquote_path(line[4:].rstrip('\t'))
+                if file_path.startswith('a/'):
+                    file_path = file_path[2:]
+                else:
+                    file_path = ''
+            elif line.startswith('@@ ') and file_path:
+                old_range = line.split()[1][1:]
+                start_text, _, count_text = old_range.partition(',')
+                start = int(start_text)
+                count = int(count_text) if count_text else 1
+                if count == 0:
+                    start, count = max(start, 1), 1
+                hunks.setdefault(file_path, []).append(
+                    (start, start + count - 1),
+                )
+        return hunks
+
+    def parse_blame(self, blame_lines):
+        # type: (Iterable[str]) -> Dict[int, str]
+        """
+        Map line numbers to author emails in git blame --porcelain output.
+        Lines which have not been committed map to ''.
+        """
+        lines = {}  # type: Dict[int, str]
+        emails = {}  # type: Dict[str, str]
+        sha = ''
+        line_number = 0
+        header = True
+        for line in blame_lines:
+            if line.startswith('\t'):
+                lines[line_number] = sha
+                header = True
+            elif header:
+                fields = line.split(' ')
+                sha, line_number = fields[0], int(fields[2])
+                header = False
+            elif line.startswith('author-mail '):
+                emails[sha] = line[len('author-mail '):].strip('<>')
+        emails[self.ZERO_SHA] = ''
+        return {
+            line_number: emails.get(sha, '')
+            for line_number, sha in lines.items()
         }
-        return Counter(users)
-
-    def get_changed_files(self) -> List[str]:
-        raise NotImplementedError()
 
-    def get_reviewers(self):  # type: () -> typing.Counter[str]
-        """ Find the reviewers based on the git log of the diffed files """
-        changed_files = self.get_changed_files()
-        reviewers = self.get_log_reviewers_from_file(changed_files)
-        return reviewers
+    def get_blob_shas(self, file_paths: List[str]) -> Dict[str, str]:
+        """ Find the blob SHAs of files on the base branch """
+        command = ['git', 'ls-tree', self.config.base_branch, '--']
+        blobs = {}
+        for line in self.run_command(command + file_paths):
+            info, _, file_path = line.partition('\t')
+            fields = info.split()
+            if len(fields) == 3 and fields[1] == 'blob':
+                blobs[unquote_path(file_path)] = fields[2]
+        return blobs
 
+    def get_blame_cache(self) -> Optional[BlameCache]:
+        """ Return the blame cache for the repository, if enabled """
+        if self.config.blame_cache_size <= 0:
+            return None
+        git_dir = self.run_command(['git', 'rev-parse', '--git-dir'])
+        if not git_dir or not os.path.isdir(git_dir[0]):
+            return None
+        directory = BlameCache.cache_directory(git_dir[0])
+        return BlameCache(directory, self.config.blame_cache_size)
 
-class FindLogReviewers(FindFileLogReviewers):
-    def get_changed_files(self) -> List[str]:
-        """ Find the changed files between current status and master """
-        branch = self.config.base_branch
-        git_diff_files_command = ['git', 'diff', branch, '--name-only']
-        git_diff_files = self.run_command(git_diff_files_command)
-        return git_diff_files
+    def blame_lines(self, file_path, line_ranges):
+        # type: (str, List[Tuple[int, int]]) -> Dict[int, str]
+        """ Blame line ranges of a file on the base branch """
+        command = ['git', 'blame', '--porcelain']
+        for start, end in line_ranges:
+            command += ['-L', '%d,%d' % (start, end)]
+        command += [self.config.base_branch, '--', file_path]
+        return self.parse_blame(self.stream_command(command))
 
+    def get_blame_reviewers(
+        self, file_path: str, line_ranges: List[Tuple[int, int]],
+        blob: str, cache: Optional[BlameCache],
+    ) -> 'typing.Counter[str]':
+        """
+        Count the lines owned by each author in line ranges of a file,
+        only blaming lines which are not in the blame cache
+        """
+        wanted = set()  # type: typing.Set[int]
+        for start, end in line_ranges:
+            wanted.update(range(start, end + 1))
+        lines = {}  # type: Dict[int, str]
+        if cache is not None and blob:
+            lines = cache.load(blob, file_path)
+        missing = sorted(wanted.difference(lines))
+        if missing:
+            missing_ranges = []  # type: List[Tuple[int, int]]
+            for line in missing:
+                if missing_ranges and missing_ranges[-1][1] == line - 1:
+                    missing_ranges[-1] = (missing_ranges[-1][0], line)
+                else:
+                    missing_ranges.append((line, line))
+            lines.update(self.blame_lines(file_path, missing_ranges))
+            if cache is not None and blob:
+                cache.save(blob, file_path, lines)
+        if cache is not None:
+            cache.record(not missing)
+        reviewers = Counter()  # type: typing.Counter[str]
+        for line in wanted:
+            if lines.get(line):
+                username = self.extract_username_from_email(lines[line])
+                reviewers[username] += 1
+        return reviewers
 
-class FindHistoricalReviewers(FindFileLogReviewers):
     def get_reviewers(self):  # type: () -> typing.Counter[str]
-        reviewers = self.get_log_reviewers_from_file([])
+        """
+        Find the reviewers weighted by how many changed lines they own,
+        running up to blame_concurrency git blame processes at once
+        """
+        from concurrent.futures import ThreadPoolExecutor  # NOQA: PLC0415
+        hunks = self.get_changed_hunks()
+        reviewers = Counter()  # type: typing.Counter[str]
+        if not hunks:
+            return reviewers
+        self.blame_cache = self.get_blame_cache()
+        blobs = {}  # type: Dict[str, str]
+        if self.blame_cache is not None:
+            blobs = self.get_blob_shas(sorted(hunks))
+        concurrency = max(1, self.config.blame_concurrency)
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = executor.map(
+                lambda x: self.get_blame_reviewers(
+                    x[0], x[1], blobs.get(x[0], ''), self.blame_cache,
+                ),
+                sorted(hunks.items()),
+            )
+            for file_reviewers in results:
+                reviewers.update(file_reviewers)
+        if self.blame_cache is not None:
+            self.blame_cache.evict()
         return reviewers
 
 
+@register_finder
 class FindArcCommitReviewers(FindLogReviewers):
     """
     Get reviewers based on arc commit messages, which list which users
     have approved past diffs
     """
+    PHABRICATOR_USERS = True
+    # Whether reviewers are read from TRAILER_KEYS trailers instead of
+    # "Reviewed By:" lines
+    TRAILERS = False
+    # git log arguments selecting commits with reviewers
+    REVIEWER_GREPS = [OwnershipIndex.REVIEWERS_PATTERN]
+
+    def has_source(self) -> bool:
+        """
+        Skip repositories without any reviews, checking the index if there
+        is one or else asking git log for a single commit with reviewers
+        """
+        if self.index is not None:
+            return bool(self.index.reviews_from(self.TRAILERS))
+        command = ['git', 'log', '--all', '-1', '--format=%H']
+        return bool(self.run_command(command + self.REVIEWER_GREPS))
+
     def get_log_reviewers_from_file(self, file_paths):
         # type: (List[str]) -> typing.Counter[str]
-        command = ['git', 'log', '--all', '--'] + file_paths
-        git_commit_messages = self.run_command(command)
-        reviewers_identifier = 'Reviewed By: '
+        index = self.get_index()
+        if index is not None:
+            reviews = index.reviewers(
+                file_paths, self.get_window(), self.TRAILERS,
+                self.config.follow_renames,
+            )
+        else:
+            reviews = self.get_message_reviewers(file_paths)
         reviewers = Counter()  # type: typing.Counter[str]
-        for raw_line in git_commit_messages:
-            if reviewers_identifier not in raw_line:
-                continue
-            line = raw_line.replace(reviewers_identifier, '')
-            line_reviewers = line.split(', ')
-            line_reviewers = [r.strip() for r in line_reviewers]
-            reviewers.update(line_reviewers)
+        for reviewer, count in reviews.items():
+            reviewers[self.extract_username_from_email(reviewer)] += count
+        return reviewers
+
+    def get_decayed_scores(self, index, weights):
+        # type: (OwnershipIndex, array[float]) -> Dict[str, float]
+        """ Score reviewers of the diffed files by their weighted reviews """
+        scores = {}  # type: Dict[str, float]
+        reviews = index.reviewer_scores(
+            self.get_file_paths(), weights, self.get_window(), self.TRAILERS,
+            self.config.follow_renames,
+        )
+        for reviewer, score in reviews.items():
+            username = self.extract_username_from_email(reviewer)
+            scores[username] = scores.get(username, 0) + score
+        return scores
+
+    def get_message_reviewers(self, file_paths):
+        # type: (List[str]) -> typing.Counter[str]
+        """
+        Scan commit messages for "Reviewed By:" lines, or for reviewer
+        trailers, without using the index in a single git log limited to
+        the commits whose messages mention them
+        """
+        message_format = TRAILER_FORMAT if self.TRAILERS else '%B'
+        arguments = ['--format=' + message_format] + self.REVIEWER_GREPS
+        reviewers = Counter()  # type: typing.Counter[str]
+        for line in self.stream_log(arguments, file_paths):
+            if self.TRAILERS:
+                reviewers.update(
+                    trailer_identity(x)
+                    for x in line.split(TRAILER_SEPARATOR) if x.strip()
+                )
+            else:
+                reviewers.update(parse_reviewed_by(line))
         return reviewers
 
+    def stream_log(self, arguments, file_paths):
+        # type: (List[str], List[str]) -> Iterator[str]
+        """
+        Stream `git log --all <arguments> -- <file_paths>` within the
+        history window, passing long path lists on stdin
+        """
+        command = ['git', 'log'] + arguments
+        window = self.get_window_arguments('--all')
+        if len(file_paths) > PATHSPEC_ARGV_LIMIT:
+            pathspecs = '--\n' + ''.join('%s\n' % x for x in file_paths)
+            return self.stream_command(
+                command + ['--stdin'] + window, pathspecs,
+            )
+        return self.stream_command(command + window + ['--'] + file_paths)
+
+
+@register_finder
+class FindTrailerReviewers(FindArcCommitReviewers):
+    """
+    Get reviewers based on the Reviewed-by, Approved-by and Co-authored-by
+    trailers of commit messages, which name people by email rather than by
+    phabricator username
+    """
+    PHABRICATOR_USERS = False
+    TRAILERS = True
+    REVIEWER_GREPS = ['--regexp-ignore-case'] + [
+        '--grep=^%s[[:blank:]]*:' % key for key in TRAILER_KEYS
+    ]
+
 
 def show_reviewers(reviewer_list, copy_clipboard):
     # type: (List[str], bool) -> None
@@ -185,33 +2111,749 @@ def show_reviewers(reviewer_list, copy_clipboard):
         pass
 
 
-def get_reviewers(config):  # type: (Config) -> List[str]
-    """ Main function to get reviewers for a repository """
+def format_ranking(ranking, output_format):
+    # type: (List[Dict[str, Any]], str) -> str
+    """
+    Format ranked reviewers with their scores as a json object, json lines
+    or tab separated values with a column for each finder
+    """
+    if output_format == 'json':
+        return json.dumps({'reviewers': ranking})
+    if output_format == 'jsonl':
+        return '\n'.join(json.dumps(x) for x in ranking)
+    finder_names = []  # type: List[str]
+    for reviewer in ranking:
+        for finder_name in reviewer['finders']:
+            if finder_name not in finder_names:
+                finder_names.append(finder_name)
+    rows = [['reviewer', 'score', 'files'] + finder_names]
+    for reviewer in ranking:
+        rows.append([
+            reviewer['reviewer'], repr(reviewer['score']),
+            str(reviewer['files']),
+        ] + [
+            repr(reviewer['finders'].get(x, 0)) for x in finder_names
+        ])
+    return '\n'.join('\t'.join(row) for row in rows)
+
+
+async def run_in_thread(function: Callable[[], T]) -> T:
+    """
+    Await a blocking function run in a daemon thread.  Unlike an executor,
+    a thread which is no longer awaited, such as after a timeout, does not
+    hold up the event loop or the interpreter from exiting.
+    """
+    import asyncio  # NOQA: PLC0415
+    import threading  # NOQA: PLC0415
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()  # type: asyncio.Future[T]
+
+    def set_result(result: Any, exception: Optional[BaseException]) -> None:
+        if future.done():
+            return
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    def run() -> None:
+        result = None
+        exception = None
+        try:
+            result = function()
+        except Exception as function_exception:
+            exception = function_exception
+        try:
+            loop.call_soon_threadsafe(set_result, result, exception)
+        except RuntimeError:
+            pass
+
+    threading.Thread(target=run, daemon=True).start()
+    return await future
+
+
+async def get_finder_scores(config, finder_instance):
+    # type: (Config, FindReviewers) -> Optional[Mapping[str, float]]
+    """
+    Await the scores of a finder, or None if it took longer than
+    finder_timeout seconds.  The finder's commands are killed once it has
+    timed out, so that they do not keep running or hold up exiting.
+    """
+    import asyncio  # NOQA: PLC0415
+    start = time.perf_counter()
+    if config.finder_timeout:
+        finder_instance.deadline = time.monotonic() + config.finder_timeout
+    try:
+        finder_scores = await asyncio.wait_for(
+            finder_instance.get_scores_async(),
+            config.finder_timeout or None,
+        )  # type: Optional[Mapping[str, float]]
+    except asyncio.TimeoutError:
+        finder_scores = None
+    else:
+        finder_instance.deadline = None
+    if config.profiler is not None:
+        config.profiler.record(
+            'finder', type(finder_instance).__name__,
+            time.perf_counter() - start,
+        )
+    return finder_scores
+
+
+FinderResult = Tuple[FindReviewers, Optional[Mapping[str, float]]]
+
+
+async def run_finders(
+    config: 'Config', finders: List[Type[FindReviewers]],
+    index: Optional[OwnershipIndex],
+) -> List[FinderResult]:
+    """ Run finders concurrently, returning their scores in order """
+    import asyncio  # NOQA: PLC0415
+    finder_instances = [finder(config, index) for finder in finders]
+    results = await asyncio.gather(*[
+        get_finder_scores(config, finder_instance)
+        for finder_instance in finder_instances
+    ])
+    return list(zip(finder_instances, results))
+
+
+def merge_scores(config, results):
+    # type: (Config, List[FinderResult]) -> Dict[str, float]
+    """ Sum the scores from each finder, scaled by the finder's weight """
+    scores = {}  # type: Dict[str, float]
+    for finder_instance, finder_scores in results:
+        if finder_scores is None:
+            continue
+        weight = config.finder_weights.get(type(finder_instance).__name__, 1)
+        for reviewer, score in finder_scores.items():
+            scores[reviewer] = scores.get(reviewer, 0) + weight * score
+    return scores
+
+
+async def run_window_finders(
+    config: 'Config', finders: List[Type[FindReviewers]],
+    index: Optional[OwnershipIndex],
+) -> List[FinderResult]:
+    """
+    Run finders, and with an adaptive window keep doubling max_commits
+    until there are limit candidates scoring at least
+    window_threshold or widening the window no longer changes any score.
+    Finders which do not read history are only run once.
+    """
+    if not config.adaptive_window:
+        return await run_finders(config, finders, index)
+    window_config = copy.copy(config)
+    window_config.max_commits = config.max_commits or ADAPTIVE_WINDOW_START
+    results = await run_finders(window_config, finders, index)
+    previous = None  # type: Optional[Dict[str, float]]
+    while True:
+        scores = merge_scores(window_config, results)
+        candidates = [
+            reviewer for reviewer, score in scores.items()
+            if score >= config.window_threshold and
+            reviewer not in config.ignores
+        ]
+        if len(candidates) >= config.reviewers_limit() or \
+                scores == previous:
+            return results
+        previous = scores
+        window_config.max_commits *= 2
+        windowed = [
+            i for i, finder in enumerate(finders) if finder.HISTORY_WINDOW
+        ]
+        widened = await run_finders(
+            window_config, [finders[i] for i in windowed], index,
+        )
+        for i, result in zip(windowed, widened):
+            results[i] = result
+
+
+async def rank_reviewers_async(config, index=None, files=True):
+    # type: (Config, Optional[OwnershipIndex], bool) -> List[Dict[str, Any]]
+    """
+    Rank reviewers for a repository, running all finders concurrently,
+    optionally answered from an ownership index which is already up to date.
+    Otherwise the index is only brought up to date if enabled.  Each
+    reviewer is described by their total score, their weighted score from
+    each finder and, with files, the number of diffed files they have
+    authored or reviewed.
+    """
+    resolve_blobs(config)
+    finders = get_finders(config)
+    if index is None and config.index:
+        start = time.perf_counter()
+        index = await run_in_thread(FindReviewers(config).build_index)
+        if config.profiler is not None:
+            config.profiler.record(
+                'index', 'FindReviewers', time.perf_counter() - start,
+            )
+    results = await run_window_finders(config, finders, index)
     phabricator = False
-    finders = [
-        FindLogReviewers,
-        FindHistoricalReviewers,
-        FindArcCommitReviewers,
-    ]
-    reviewers = Counter()  # type: typing.Counter[str]
-    for finder in finders:
-        finder_reviewers = finder(config).get_reviewers()
+    for finder_instance, finder_scores in results:
+        finder_name = type(finder_instance).__name__
+        if finder_scores is None:
+            if config.verbose:
+                print("Timed out waiting for %s" % finder_name)
+            continue
         if config.verbose:
             print(
                 "Reviewers from %s: %s" %
-                (finder.__name__, dict(finder_reviewers)),
+                (finder_name, dict(finder_scores)),
             )
-        reviewers.update(finder_reviewers)
-        if finder == FindArcCommitReviewers and finder_reviewers:
+            blame_cache = getattr(finder_instance, 'blame_cache', None)
+            if blame_cache is not None:
+                print(
+                    "Blame cache for %s: %d hits, %d misses" %
+                    (finder_name, blame_cache.hits, blame_cache.misses),
+                )
+        if finder_instance.PHABRICATOR_USERS and finder_scores:
             phabricator = True
+    scores = merge_scores(config, results)
 
-    most_common = [x[0] for x in reviewers.most_common()]
+    ranked = sorted(scores.items(), key=lambda x: -x[1])
+    most_common = [x[0] for x in ranked]
     most_common = [x for x in most_common if x not in config.ignores]
     if phabricator:
-        most_common = FindArcCommitReviewers(config) \
-                .filter_phabricator_activated(most_common)
-    reviewers_list = most_common[:REVIEWERS_LIMIT]
-    return reviewers_list
+        phabricator_finder = FindReviewers(config)
+        most_common = await run_in_thread(
+            lambda: phabricator_finder.filter_phabricator_activated(
+                most_common,
+            ),
+        )
+    reviewers_list = most_common[:config.reviewers_limit()]
+    if not reviewers_list:
+        return []
+    matched_files = None  # type: Optional[typing.Counter[str]]
+    if files:
+        log_finder = FindLogReviewers(config, index)
+        for finder_instance, _ in results:
+            if type(finder_instance) is FindLogReviewers:
+                log_finder = finder_instance
+        matched_files = await run_in_thread(log_finder.get_matched_files)
+    ranking = []
+    for reviewer in reviewers_list:
+        breakdown = {}  # type: Dict[str, float]
+        for finder_instance, result in results:
+            if result is not None and reviewer in result:
+                finder_name = type(finder_instance).__name__
+                weight = config.finder_weights.get(finder_name, 1)
+                breakdown[finder_name] = weight * result[reviewer]
+        described = {
+            'reviewer': reviewer,
+            'score': scores[reviewer],
+            'finders': breakdown,
+        }  # type: Dict[str, Any]
+        if matched_files is not None:
+            described['files'] = matched_files[reviewer]
+        ranking.append(described)
+    return ranking
+
+
+async def get_reviewers_async(config, index=None):
+    # type: (Config, Optional[OwnershipIndex]) -> List[str]
+    """
+    Get reviewers for a repository, running all finders concurrently,
+    optionally answered from an ownership index which is already up to date
+    """
+    ranking = await rank_reviewers_async(config, index, files=False)
+    return [x['reviewer'] for x in ranking]
+
+
+def rank_reviewers(config, index=None, files=True):
+    # type: (Config, Optional[OwnershipIndex], bool) -> List[Dict[str, Any]]
+    """
+    Rank reviewers for a repository with their scores and, with files, the
+    number of diffed files each has authored or reviewed
+    """
+    import asyncio  # NOQA: PLC0415
+    return asyncio.run(rank_reviewers_async(config, index, files))
+
+
+def get_reviewers(config, index=None):
+    # type: (Config, Optional[OwnershipIndex]) -> List[str]
+    """
+    Main function to get reviewers for a repository, optionally answered
+    from an ownership index which is already up to date
+    """
+    import asyncio  # NOQA: PLC0415
+    return asyncio.run(get_reviewers_async(config, index))
+
+
+def daemon_socket_path(git_dir: str) -> str:
+    """ Return where the daemon listens for a git directory """
+    return os.path.join(git_dir, CACHE_DIRECTORY, DAEMON_SOCKET)
+
+
+def unix_sockets_available() -> bool:
+    """ Whether the platform has unix sockets for the daemon to listen on """
+    import socket  # NOQA: PLC0415
+    return hasattr(socket, 'AF_UNIX')
+
+
+class ReviewersDaemon():
+    """
+    Long-lived state of the daemon, which keeps the ownership index in
+    memory if enabled and answers reviewer requests from clients over a unix
+    socket in the git directory.  Requests are handled one at a time and the
+    index is brought up to date with the repository's refs before each
+    answer.
+    """
+    def __init__(self, config: 'Config') -> None:
+        self.config = config
+        self.index: Optional[OwnershipIndex] = None
+        self.stopped = False
+
+    def answer(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        """ Answer a request for the reviewers of a set of changed files """
+        command = request.get('command', 'reviewers')
+        if command == 'ping':
+            return {}
+        if command == 'stop':
+            self.stopped = True
+            return {}
+        if request.get('config') != ranking_config(self.config):
+            return {'error': 'Config does not match the daemon'}
+        config = copy.copy(self.config)
+        config.base_branch = request.get('base_branch', config.base_branch)
+        config.ignores = request.get('ignores', config.ignores)
+        config.changed_files = request.get('files')
+        for option in HISTORY_WINDOW_OPTIONS:
+            if option in request:
+                setattr(config, option, request[option])
+        config.limit = request.get('limit', config.limit)
+        config.follow_renames = request.get(
+            'follow_renames', config.follow_renames,
+        )
+        config.blobs = request.get('blobs', config.blobs)
+        if config.index:
+            self.index = FindReviewers(config).build_index(self.index)
+        ranking = rank_reviewers(config, self.index)
+        return {
+            'reviewers': [x['reviewer'] for x in ranking],
+            'ranking': ranking,
+        }
+
+
+def daemon_socket(config):  # type: (Config) -> Optional[str]
+    """
+    Return the socket of the daemon for the current repository, or None if
+    no daemon is listening or the platform has no unix sockets
+    """
+    if not unix_sockets_available():
+        return None
+    finder = FindReviewers(config)
+    git_dir = finder.run_command(['git', 'rev-parse', '--git-dir'])
+    if not git_dir:
+        return None
+    socket_path = daemon_socket_path(git_dir[0])
+    if not os.path.exists(socket_path):
+        return None
+    return socket_path
+
+
+def query_daemon(config, request):
+    # type: (Config, Dict[str, Any]) -> Optional[Dict[str, Any]]
+    """
+    Send a request to the daemon for the current repository, returning
+    None if no daemon is listening or the platform has no unix sockets
+    """
+    socket_path = daemon_socket(config)
+    if socket_path is None:
+        return None
+    return send_daemon_request(socket_path, request)
+
+
+def send_daemon_request(socket_path, request):
+    # type: (str, Dict[str, Any]) -> Optional[Dict[str, Any]]
+    """
+    Send a request to the daemon listening on a socket, returning None if
+    it could not answer
+    """
+    import socket  # NOQA: PLC0415
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.settimeout(DAEMON_TIMEOUT)
+            client.connect(socket_path)
+            client.sendall(json.dumps(request).encode('utf-8') + b'\n')
+            with client.makefile('rb') as response_handle:
+                response = json.loads(response_handle.readline())
+    except (OSError, ValueError):
+        return None
+    if not isinstance(response, dict):
+        return None
+    return response
+
+
+def ranking_config(config):  # type: (Config) -> Dict[str, Any]
+    """ Return the RANKING_CONFIG_OPTIONS of a config """
+    return {x: getattr(config, x) for x in RANKING_CONFIG_OPTIONS}
+
+
+def ranking_request(config):  # type: (Config) -> Dict[str, Any]
+    """
+    Describe the ranking a config asks for, with the changed files, the
+    options that a daemon answers with and the options it must match, which
+    also key a snapshot
+    """
+    request = {
+        'files': FindLogReviewers(config).get_changed_files(),
+        'base_branch': config.base_branch,
+        'ignores': config.ignores,
+        'limit': config.limit,
+        'follow_renames': config.follow_renames,
+        'blobs': config.blobs,
+        'config': ranking_config(config),
+    }  # type: Dict[str, Any]
+    for option in HISTORY_WINDOW_OPTIONS:
+        request[option] = getattr(config, option)
+    return request
+
+
+def precomputed_allowed(config):  # type: (Config) -> bool
+    """ Whether a daemon or snapshot may answer for a config """
+    return not config.rebuild_index and not config.verbose and \
+        config.profiler is None
+
+
+def get_daemon_ranking(config):
+    # type: (Config) -> Optional[List[Dict[str, Any]]]
+    """
+    Rank reviewers with a running daemon, sending it the changed files.
+    Returns None if there is no daemon or it could not answer, keeping the
+    changed files in the config for reviewers to be found in-process.
+    """
+    if not config.daemon or not precomputed_allowed(config):
+        return None
+    socket_path = daemon_socket(config)
+    if socket_path is None:
+        return None
+    request = ranking_request(config)
+    response = send_daemon_request(socket_path, request)
+    if response is None or 'ranking' not in response:
+        config.changed_files = request['files']
+        return None
+    return list(response['ranking'])
+
+
+def get_daemon_reviewers(config):  # type: (Config) -> Optional[List[str]]
+    """
+    Get reviewers from a running daemon, sending it the changed files.
+    Returns None if there is no daemon or it could not answer.
+    """
+    ranking = get_daemon_ranking(config)
+    if ranking is None:
+        return None
+    return [x['reviewer'] for x in ranking]
+
+
+def run_daemon(config):  # type: (Config) -> bool
+    """
+    Serve reviewers for the current repository from a unix socket until
+    stopped.  Returns False if a daemon could not be started.
+    """
+    if not unix_sockets_available():
+        print("The daemon needs unix sockets, which this platform lacks")
+        return False
+    import socketserver  # NOQA: PLC0415
+    finder = FindReviewers(config)
+    git_dir = finder.run_command(['git', 'rev-parse', '--git-dir'])
+    if not git_dir or not os.path.isdir(git_dir[0]):
+        print("Not in a git repository")
+        return False
+    socket_path = daemon_socket_path(git_dir[0])
+    if query_daemon(config, {'command': 'ping'}) is not None:
+        print("Daemon is already running at %s" % socket_path)
+        return False
+    os.makedirs(os.path.dirname(socket_path), exist_ok=True)
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    daemon = ReviewersDaemon(config)
+
+    class RequestHandler(socketserver.StreamRequestHandler):
+        """ Read one json request line and write back one json response """
+        def handle(self) -> None:
+            try:
+                request = json.loads(self.rfile.readline().decode('utf-8'))
+                response = daemon.answer(request)
+            except Exception as exception:
+                response = {'error': str(exception)}
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+
+    server = socketserver.UnixStreamServer(socket_path, RequestHandler)
+    try:
+        if config.index:
+            daemon.index = finder.build_index()
+        while not daemon.stopped:
+            server.handle_request()
+    finally:
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+    return True
+
+
+def snapshot_path(git_dir: str) -> str:
+    """ Return the location of the reviewer snapshot for a git directory """
+    return os.path.join(git_dir, CACHE_DIRECTORY, SNAPSHOT_FILENAME)
+
+
+def get_snapshot_ranking(config):
+    # type: (Config) -> Optional[List[Dict[str, Any]]]
+    """
+    Return the ranking saved by the last refresh if it was made for the
+    same HEAD, changed files and options, or None
+    """
+    if not precomputed_allowed(config):
+        return None
+    finder = FindReviewers(config)
+    rev_parse = finder.run_command(['git', 'rev-parse', '--git-dir', 'HEAD'])
+    if len(rev_parse) != 2:
+        return None
+    try:
+        with open(snapshot_path(rev_parse[0]), 'r') as snapshot_handle:
+            snapshot = json.load(snapshot_handle)
+    except (OSError, ValueError):
+        return None
+    request = ranking_request(config)
+    request['head'] = rev_parse[1]
+    if not isinstance(snapshot, dict) or snapshot.get('request') != request:
+        return None
+    return list(snapshot['ranking'])
+
+
+def save_snapshot(config):  # type: (Config) -> None
+    """
+    Save the ranking for the current HEAD and changed files, bringing the
+    ownership index up to date if enabled
+    """
+    config = copy.copy(config)
+    config.verbose = False
+    config.profiler = None
+    finder = FindReviewers(config)
+    rev_parse = finder.run_command(['git', 'rev-parse', '--git-dir', 'HEAD'])
+    if len(rev_parse) != 2:
+        return
+    request = ranking_request(config)
+    request['head'] = rev_parse[1]
+    config.changed_files = request['files']
+    ranking = rank_reviewers(config)
+    path = snapshot_path(rev_parse[0])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(temp_path, 'w') as snapshot_handle:
+        json.dump({'request': request, 'ranking': ranking}, snapshot_handle)
+    os.replace(temp_path, path)
+
+
+def refresh_snapshot(config):  # type: (Config) -> bool
+    """
+    Save a snapshot of reviewers for the current diff, as run in the
+    background by git hooks.  Each run records a request for a refresh and
+    only one run refreshes at a time, waiting refresh_delay seconds first
+    so that a burst of hook runs is answered by one refresh.  Runs which
+    find another refreshing leave their request to it.  Returns False
+    outside of a git repository.
+    """
+    import fcntl  # NOQA: PLC0415
+    finder = FindReviewers(config)
+    git_dir = finder.run_command(['git', 'rev-parse', '--git-dir'])
+    if not git_dir or not os.path.isdir(git_dir[0]):
+        return False
+    cache_directory = os.path.join(git_dir[0], CACHE_DIRECTORY)
+    os.makedirs(cache_directory, exist_ok=True)
+    pending_path = os.path.join(cache_directory, REFRESH_PENDING)
+    open(pending_path, 'w').close()
+    # A run which fails to take the lock has already left its request, and
+    # the holder checks for requests again after releasing the lock
+    while os.path.exists(pending_path):
+        with open(os.path.join(cache_directory, REFRESH_LOCK), 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return True
+            while os.path.exists(pending_path):
+                time.sleep(config.refresh_delay)
+                os.remove(pending_path)
+                save_snapshot(config)
+    return True
+
+
+BATCH_WORKER: Dict[str, Any] = {}
+
+
+def init_batch_worker(config, index):
+    # type: (Config, Optional[OwnershipIndex]) -> None
+    """ Keep the config and shared ownership index of a batch worker """
+    BATCH_WORKER['config'] = config
+    BATCH_WORKER['index'] = index
+
+
+def batch_head_index(config, index):
+    # type: (Config, OwnershipIndex) -> OwnershipIndex
+    """
+    Return the shared ownership index of a batch worker with history scored
+    from the head revision of a request
+    """
+    sha = FindReviewers(config).run_command(
+        ['git', 'rev-parse', '--verify', '--quiet', config.head + '^{commit}'],
+    )
+    if not sha:
+        raise ValueError('Unknown head %s' % config.head)
+    if sha[0] not in index.sha_ids:
+        raise ValueError('Head %s is not in the ownership index' % config.head)
+    return index.at_head(sha[0])
+
+
+def batch_error(line: str, exception: BaseException) -> str:
+    """ Return the json response line for a batch request which failed """
+    response = {}  # type: Dict[str, Any]
+    try:
+        request = json.loads(line)
+    except ValueError:
+        request = None
+    if isinstance(request, dict):
+        for key in ['id', 'base', 'head']:
+            if key in request:
+                response[key] = request[key]
+    response['error'] = str(exception) or type(exception).__name__
+    return json.dumps(response)
+
+
+def answer_batch_request(line: str) -> str:
+    """
+    Answer a json request line for the reviewers of a head revision against
+    a base branch in a batch worker, returning a json response line
+    """
+    response = {}  # type: Dict[str, Any]
+    try:
+        request = json.loads(line)
+        if not isinstance(request, dict):
+            raise ValueError('Request is not an object')
+        for key in ['id', 'base', 'head']:
+            if key in request:
+                response[key] = request[key]
+        config = copy.copy(BATCH_WORKER['config'])
+        config.base_branch = request.get('base', config.base_branch)
+        config.head = request.get('head', '')
+        config.ignores = config.ignores + request.get('ignores', [])
+        config.limit = request.get('limit', config.limit)
+        index = BATCH_WORKER['index']
+        if index is not None and config.head:
+            index = batch_head_index(config, index)
+        ranking = rank_reviewers(
+            config, index, files=config.output_format != 'text',
+        )
+        response['reviewers'] = [x['reviewer'] for x in ranking]
+        if config.output_format != 'text':
+            response['ranking'] = ranking
+    except Exception as exception:
+        return batch_error(line, exception)
+    return json.dumps(response)
+
+
+def run_batch(config, requests, output):
+    # type: (Config, Iterable[str], typing.TextIO) -> None
+    """
+    Answer json request lines for many base and head revision pairs, such as
+    from a merge queue, writing each response line in order as soon as it is
+    ready.  Reviewers are scored from the history of each request's head,
+    which only the ownership index can do, so the index is always enabled.
+    It is built once and shared by a pool of batch_concurrency worker
+    processes.  A request which fails, including
+    when a worker dies, is answered with an error line.
+    """
+    import queue  # NOQA: PLC0415
+    import threading  # NOQA: PLC0415
+    from concurrent.futures import (  # NOQA: PLC0415
+        Future, ProcessPoolExecutor,
+    )
+    config = copy.copy(config)
+    config.verbose = False
+    config.profiler = None
+    config.index = True
+    index = FindReviewers(config).build_index()
+    workers = config.batch_concurrency or os.cpu_count() or 1
+    responses: 'queue.Queue[Optional[Tuple[str, Future[str]]]]' = \
+        queue.Queue(2 * workers)
+
+    def write_responses() -> None:
+        while True:
+            response = responses.get()
+            if response is None:
+                return
+            line, future = response
+            try:
+                result = future.result()
+            except Exception as exception:
+                result = batch_error(line, exception)
+            output.write(result + '\n')
+            output.flush()
+
+    writer = threading.Thread(target=write_responses)
+    writer.start()
+    try:
+        with ProcessPoolExecutor(
+            workers, initializer=init_batch_worker, initargs=(config, index),
+        ) as executor:
+            for line in requests:
+                if not line.strip():
+                    continue
+                try:
+                    future = executor.submit(answer_batch_request, line)
+                except Exception as exception:
+                    future = Future()
+                    future.set_exception(exception)
+                responses.put((line, future))
+    finally:
+        responses.put(None)
+        writer.join()
+
+
+def verify_index(config):  # type: (Config) -> bool
+    """
+    Check that results answered from the ownership index match uncached
+    git output for the changed files and the whole repo, over the full
+    history.  The index counts every commit touching a file, while git log
+    simplifies history by default and leaves out side branches whose
+    changes a merge discarded, such as with git merge -s ours, so such
+    repositories are reported as mismatches.
+    """
+    config = copy.copy(config)
+    config.max_commits, config.since, config.revision_range = 0, '', ''
+    finder = FindArcCommitReviewers(config)
+    index = finder.build_index()
+    if index is None:
+        print("No ownership index available")
+        return False
+    trailer_finder = FindTrailerReviewers(config, index)
+    matches = True
+    for file_paths in [finder.get_file_paths(), []]:
+        indexed = [line.strip() for line in index.shortlog(file_paths)]
+        uncached = [line.strip() for line in finder.get_shortlog(file_paths)]
+        indexed += ['Reviewed By: %s %d' % x for x in
+                    index.reviewers(file_paths).items()]
+        uncached += ['Reviewed By: %s %d' % x for x in
+                     finder.get_message_reviewers(file_paths).items()]
+        indexed += ['Trailer: %s %d' % x for x in
+                    index.reviewers(file_paths, trailers=True).items()]
+        uncached += ['Trailer: %s %d' % x for x in
+                     trailer_finder.get_message_reviewers(file_paths).items()]
+        if sorted(indexed) == sorted(uncached):
+            continue
+        matches = False
+        print("Index mismatch for %s" % (file_paths or 'repository'))
+        for line in sorted(set(indexed) - set(uncached)):
+            print("index only: %s" % line)
+        for line in sorted(set(uncached) - set(indexed)):
+            print("git only: %s" % line)
+    if matches:
+        print("Ownership index matches git history")
+    else:
+        print(
+            "Commits on side branches which a merge discarded are only "
+            "counted by the index",
+        )
+    return matches
 
 
 class Config():
@@ -221,6 +2863,23 @@ class Config():
     JSON_DEFAULT = ''
     COPY_DEFAULT = None
     BASE_BRANCH_DEFAULT = 'master'
+    INDEX_DEFAULT = None
+    REBUILD_INDEX_DEFAULT = None
+    REFRESH_USERS_DEFAULT = None
+    PROFILE_DEFAULT = None
+    DAEMON_DEFAULT = None
+    MAX_COMMITS_DEFAULT = None
+    SINCE_DEFAULT = None
+    REVISION_RANGE_DEFAULT = None
+    ADAPTIVE_WINDOW_DEFAULT = None
+    FORMAT_DEFAULT = None
+    LIMIT_DEFAULT = None
+    FORMATS = ['text', 'json', 'jsonl', 'tsv']
+    BACKEND_DEFAULT = None
+    BACKENDS = ['git', 'native']
+    FOLLOW_RENAMES_DEFAULT = None
+    BLOBS_DEFAULT = None
+    BLOBS = ['auto', 'read', 'skip']
 
     def __init__(self) -> None:
         self.verbose = False
@@ -228,6 +2887,45 @@ class Config():
         self.json = ''
         self.copy = False
         self.base_branch = 'master'
+        self.index = False
+        self.rebuild_index = False
+        self.phabricator_concurrency = REVIEWERS_LIMIT
+        self.phabricator_batch_size = 100
+        self.user_cache_ttl = 7 * 24 * 60 * 60
+        self.user_cache_negative_ttl = 24 * 60 * 60
+        self.user_cache_size = 1000
+        self.refresh_users = False
+        self.blame_concurrency = 4
+        self.blame_cache_size = 16 * 1024 * 1024
+        self.half_life_days = 0.0
+        self.finder_weights: Dict[str, float] = {}
+        self.finders: Dict[str, bool] = {}
+        self.profile: Optional[str] = None
+        self.profiler: Optional[Profiler] = None
+        self.daemon = True
+        self.directory_threshold = 1000
+        self.directory_depth = 2
+        self.finder_timeout = 0.0
+        self.max_commits = 0
+        self.since = ''
+        self.revision_range = ''
+        self.adaptive_window = False
+        self.window_threshold = 2.0
+        self.changed_files: Optional[List[str]] = None
+        self.aliases: Dict[str, List[str]] = {}
+        self.identities: Optional[IdentityResolver] = None
+        self.head = ''
+        self.batch_concurrency = 0
+        self.output_format = 'text'
+        self.limit = 0
+        self.backend = 'git'
+        self.follow_renames = True
+        self.refresh_delay = 2.0
+        self.blobs = 'auto'
+
+    def reviewers_limit(self) -> int:
+        """ Return how many reviewers to suggest """
+        return self.limit or REVIEWERS_LIMIT
 
     @staticmethod
     def default_global_json():
@@ -235,7 +2933,7 @@ class Config():
         """
         Return the path to the default config file for the current user
         """
-        home_dir = str(pathlib.Path.home())
+        home_dir = os.path.expanduser('~')
         json_path = os.path.join(home_dir, Config.DEFAULT_GLOBAL_JSON)
         return json_path
 
@@ -263,6 +2961,61 @@ class Config():
         self.copy = config.get('copy', self.copy)
         self.ignores += config.get('ignore', self.ignores)
         self.base_branch = config.get('base_branch', self.base_branch)
+        self.index = config.get('index', self.index)
+        self.phabricator_concurrency = config.get(
+            'phabricator_concurrency', self.phabricator_concurrency,
+        )
+        self.phabricator_batch_size = config.get(
+            'phabricator_batch_size', self.phabricator_batch_size,
+        )
+        self.user_cache_ttl = config.get('user_cache_ttl', self.user_cache_ttl)
+        self.user_cache_negative_ttl = config.get(
+            'user_cache_negative_ttl', self.user_cache_negative_ttl,
+        )
+        self.user_cache_size = config.get(
+            'user_cache_size', self.user_cache_size,
+        )
+        self.blame_concurrency = config.get(
+            'blame_concurrency', self.blame_concurrency,
+        )
+        self.blame_cache_size = config.get(
+            'blame_cache_size', self.blame_cache_size,
+        )
+        self.half_life_days = config.get('half_life_days', self.half_life_days)
+        self.finder_weights.update(config.get('finder_weights', {}))
+        self.finders.update(config.get('finders', {}))
+        self.daemon = config.get('daemon', self.daemon)
+        self.directory_threshold = config.get(
+            'directory_threshold', self.directory_threshold,
+        )
+        self.directory_depth = config.get(
+            'directory_depth', self.directory_depth,
+        )
+        self.finder_timeout = config.get('finder_timeout', self.finder_timeout)
+        self.max_commits = config.get('max_commits', self.max_commits)
+        self.since = config.get('since', self.since)
+        self.revision_range = config.get(
+            'revision_range', self.revision_range,
+        )
+        self.adaptive_window = config.get(
+            'adaptive_window', self.adaptive_window,
+        )
+        self.window_threshold = config.get(
+            'window_threshold', self.window_threshold,
+        )
+        self.aliases.update(config.get('aliases', {}))
+        self.batch_concurrency = config.get(
+            'batch_concurrency', self.batch_concurrency,
+        )
+        self.output_format = config.get('format', self.output_format)
+        self.limit = config.get('limit', self.limit)
+        self.backend = config.get('backend', self.backend)
+        self.follow_renames = config.get(
+            'follow_renames', self.follow_renames,
+        )
+        self.refresh_delay = config.get('refresh_delay', self.refresh_delay)
+        self.blobs = config.get('blobs', self.blobs)
+        self.require_index()
 
     def read_from_args(self, args):
         # type: (argparse.Namespace) -> None
@@ -275,10 +3028,49 @@ class Config():
             self.ignores += args.ignore.split(',')
         if args.base_branch != Config.BASE_BRANCH_DEFAULT:
             self.base_branch = args.base_branch
+        if args.index != Config.INDEX_DEFAULT:
+            self.index = args.index
+        if args.rebuild_index != Config.REBUILD_INDEX_DEFAULT:
+            self.rebuild_index = args.rebuild_index
+        if args.refresh_users != Config.REFRESH_USERS_DEFAULT:
+            self.refresh_users = args.refresh_users
+        if args.profile != Config.PROFILE_DEFAULT:
+            self.profile = args.profile
+            self.profiler = Profiler()
+        if args.daemon != Config.DAEMON_DEFAULT:
+            self.daemon = args.daemon
+        if args.max_commits != Config.MAX_COMMITS_DEFAULT:
+            self.max_commits = args.max_commits
+        if args.since != Config.SINCE_DEFAULT:
+            self.since = args.since
+        if args.range != Config.REVISION_RANGE_DEFAULT:
+            self.revision_range = args.range
+        if args.adaptive_window != Config.ADAPTIVE_WINDOW_DEFAULT:
+            self.adaptive_window = args.adaptive_window
+        if args.format != Config.FORMAT_DEFAULT:
+            self.output_format = args.format
+        if args.limit != Config.LIMIT_DEFAULT:
+            self.limit = args.limit
+        if args.backend != Config.BACKEND_DEFAULT:
+            self.backend = args.backend
+        if args.follow_renames != Config.FOLLOW_RENAMES_DEFAULT:
+            self.follow_renames = args.follow_renames
+        if args.blobs != Config.BLOBS_DEFAULT:
+            self.blobs = args.blobs
+        self.require_index()
 
+    def require_index(self) -> None:
+        """
+        Turn on the ownership index if an option is set which only the index
+        can answer, so that the option is never silently ignored
+        """
+        if self.half_life_days or self.backend == 'native':
+            self.index = True
 
-def main() -> None:
-    """ Main entrypoint function to receive CLI arguments """
+
+def parse_args():  # type: () -> argparse.Namespace
+    """ Parse the command line arguments """
+    import argparse  # NOQA: PLC0415
     description = "Suggest reviewers for your diff.\n"
     description += "https://github.com/albertyw/git-reviewers"
     parser = argparse.ArgumentParser(description=description)
@@ -310,11 +3102,151 @@ def main() -> None:
         default=Config.BASE_BRANCH_DEFAULT,
         help='Compare against a base branch (default: master)',
     )
-    args = parser.parse_args()
+    parser.add_argument(
+        '--index',
+        default=Config.INDEX_DEFAULT, action='store_true',
+        help='Answer from an ownership index kept on disk',
+    )
+    parser.add_argument(
+        '--no-index',
+        dest='index', default=Config.INDEX_DEFAULT, action='store_false',
+        help='Do not use the on-disk ownership index',
+    )
+    parser.add_argument(
+        '--rebuild-index',
+        default=Config.REBUILD_INDEX_DEFAULT, action='store_true',
+        help='Rebuild the ownership index from scratch',
+    )
+    parser.add_argument(
+        '--verify-index',
+        action='store_true',
+        help='Check the ownership index against uncached git shortlog',
+    )
+    parser.add_argument(
+        '--refresh-users',
+        default=Config.REFRESH_USERS_DEFAULT, action='store_true',
+        help='Recheck phabricator users instead of using cached statuses',
+    )
+    parser.add_argument(
+        '--profile',
+        default=Config.PROFILE_DEFAULT, nargs='?', const='', metavar='JSON',
+        help='Print a timing report, or write it to a json file',
+    )
+    parser.add_argument(
+        '--max-commits',
+        default=Config.MAX_COMMITS_DEFAULT, type=int, metavar='N',
+        help='Only consider the N most recent commits to each set of files',
+    )
+    parser.add_argument(
+        '--since',
+        default=Config.SINCE_DEFAULT, metavar='DATE',
+        help='Only consider commits more recent than a date',
+    )
+    parser.add_argument(
+        '--range',
+        default=Config.REVISION_RANGE_DEFAULT, metavar='RANGE',
+        help='Only consider commits in a revision range, such as v1.0..HEAD',
+    )
+    parser.add_argument(
+        '--adaptive-window',
+        default=Config.ADAPTIVE_WINDOW_DEFAULT, action='store_true',
+        help='Widen the history considered until there are enough reviewers',
+    )
+    parser.add_argument(
+        '--no-daemon',
+        dest='daemon', default=Config.DAEMON_DEFAULT, action='store_false',
+        help='Do not ask a running daemon for reviewers',
+    )
+    parser.add_argument(
+        '--start-daemon',
+        action='store_true',
+        help='Serve reviewers for this repository until stopped',
+    )
+    parser.add_argument(
+        '--stop-daemon',
+        action='store_true',
+        help='Stop the daemon for this repository',
+    )
+    parser.add_argument(
+        '--format',
+        default=Config.FORMAT_DEFAULT, choices=Config.FORMATS,
+        help='Output format, with scores for all but text (default: text)',
+    )
+    parser.add_argument(
+        '--limit',
+        default=Config.LIMIT_DEFAULT, type=int, metavar='N',
+        help='Suggest up to N reviewers (default: %d)' % REVIEWERS_LIMIT,
+    )
+    parser.add_argument(
+        '--backend',
+        default=Config.BACKEND_DEFAULT, choices=Config.BACKENDS,
+        help='Read history by running git or from .git (default: git)',
+    )
+    parser.add_argument(
+        '--no-follow-renames',
+        dest='follow_renames', default=Config.FOLLOW_RENAMES_DEFAULT,
+        action='store_false',
+        help='Only look up the history of files at their current paths',
+    )
+    parser.add_argument(
+        '--blobs',
+        default=Config.BLOBS_DEFAULT, choices=Config.BLOBS,
+        help='Whether to read file contents, skipped in partial clones by '
+        'auto (default: auto)',
+    )
+    parser.add_argument(
+        '--batch',
+        action='store_true',
+        help='Answer json lines of base and head revisions read from stdin',
+    )
+    parser.add_argument(
+        '--refresh',
+        action='store_true',
+        help='Save reviewers for the current diff, as run by git hooks',
+    )
+    return parser.parse_args()
+
+
+def main() -> None:
+    """ Main entrypoint function to receive CLI arguments """
+    if sys.argv[1:] in (['-v'], ['--version']):
+        print(__version__)
+        return
     config = Config()
-    config.read_configs(args)
-    reviewers_list = get_reviewers(config)
-    show_reviewers(reviewers_list, config.copy)
+    if not sys.argv[1:]:
+        # Nothing to parse, so skip importing argparse and building a parser
+        config.read_from_json(Config.default_global_json())
+    else:
+        args = parse_args()
+        config.read_configs(args)
+        if args.verify_index:
+            sys.exit(0 if verify_index(config) else 1)
+        if args.start_daemon:
+            sys.exit(0 if run_daemon(config) else 1)
+        if args.stop_daemon:
+            stopped = query_daemon(config, {'command': 'stop'}) is not None
+            sys.exit(0 if stopped else 1)
+        if args.batch:
+            run_batch(config, sys.stdin, sys.stdout)
+            return
+        if args.refresh:
+            sys.exit(0 if refresh_snapshot(config) else 1)
+    ranking = get_snapshot_ranking(config)
+    if ranking is None:
+        ranking = get_daemon_ranking(config)
+    if ranking is None:
+        ranking = rank_reviewers(
+            config, files=config.output_format != 'text',
+        )
+    if config.output_format == 'text':
+        show_reviewers([x['reviewer'] for x in ranking], config.copy)
+    elif ranking or config.output_format != 'jsonl':
+        print(format_ranking(ranking, config.output_format))
+    if config.profiler is not None:
+        if config.profile:
+            config.profiler.write_json(config.profile)
+        else:
+            print(config.profiler.format_table(), file=sys.stderr)
 
 
 if __name__ == "__main__":
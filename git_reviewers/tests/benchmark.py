@@ -0,0 +1,515 @@
+"""
+Benchmarks for git-reviewers against synthetic repositories
+
+    python -m git_reviewers.tests.benchmark run --save baseline.json
+    python -m git_reviewers.tests.benchmark run --compare baseline.json
+    python -m git_reviewers.tests.benchmark memory --sizes 5000,20000,80000
+    python -m git_reviewers.tests.benchmark startup
+    python -m git_reviewers.tests.benchmark partial --commits 100000
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+
+from git_reviewers.tests.fixtures import write_fake_arc
+
+BASE_DIRECTORY = os.path.normpath(
+    os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..'),
+)
+EPOCH = 1500000000
+REVIEWERS_SCRIPT = os.path.join(
+    BASE_DIRECTORY, 'git_reviewers', 'reviewers.py',
+)
+STARTUP_EXCLUDED = [
+    'argparse', 'asyncio', 'concurrent.futures', 'git_reviewers.native',
+    'hashlib', 'mmap', 'native', 'queue', 'socket', 'socketserver', 'struct',
+    'zlib',
+]
+MODULES_CHILD = '''
+import json
+import runpy
+import sys
+sys.argv = sys.argv[1:]
+try:
+    if sys.argv:
+        runpy.run_path(sys.argv[0], run_name='__main__')
+    else:
+        import git_reviewers.reviewers
+finally:
+    sys.stderr.write(json.dumps(sorted(sys.modules)))
+'''
+
+MEMORY_CHILD = '''
+import resource
+import sys
+from git_reviewers import reviewers
+finder = reviewers.FindReviewers(reviewers.Config())
+command = ['git', 'log', '--all']
+if sys.argv[1] == 'buffered':
+    lines = len(finder.run_command(command))
+else:
+    lines = sum(1 for _ in finder.stream_command(command))
+print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+'''
+
+# Targets are a function or finder, optionally answered from the ownership
+# index, which is removed first for :cold runs and kept from the previous
+# run for :warm runs
+TARGETS = [
+    'get_reviewers',
+    'get_reviewers:index:cold',
+    'get_reviewers:index:warm',
+    'FindLogReviewers',
+    'FindHistoricalReviewers',
+    'FindBlameReviewers',
+    'FindArcCommitReviewers',
+    'FindTrailerReviewers',
+]
+RUN_CHILD = '''
+import json
+import resource
+import subprocess
+import sys
+import time
+from git_reviewers import reviewers
+subprocesses = [0]
+popen_init = subprocess.Popen.__init__
+def counting_init(self, *args, **kwargs):
+    subprocesses[0] += 1
+    popen_init(self, *args, **kwargs)
+subprocess.Popen.__init__ = counting_init
+target = sys.argv[1].split(':')[0]
+config = reviewers.Config()
+config.user_cache_ttl = 0
+for key, value in json.loads(sys.argv[2]).items():
+    setattr(config, key, value)
+if ':index' in sys.argv[1]:
+    config.index = True
+start = time.perf_counter()
+if target == 'get_reviewers':
+    reviewers.get_reviewers(config)
+else:
+    getattr(reviewers, target)(config).get_scores()
+wall_time = time.perf_counter() - start
+print(json.dumps({
+    'wall_time': wall_time,
+    'subprocesses': subprocesses[0],
+    'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    'children_peak_rss_kb':
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+}))
+'''
+
+
+def build_repository(
+    path: str, commits: int, files: int, authors: int,
+    message_lines: int = 5, seed: int = 0,
+) -> None:
+    """
+    Create a deterministic repository at path with a linear history of
+    commits by a set of authors, touching a set of files and carrying
+    "Reviewed By:" lines in their messages
+    """
+    subprocess.run(['git', 'init', '-q', path], check=True)
+    subprocess.run(
+        ['git', 'symbolic-ref', 'HEAD', 'refs/heads/master'],
+        cwd=path, check=True,
+    )
+    rand = random.Random(seed)
+    process = subprocess.Popen(
+        ['git', 'fast-import', '--quiet'], cwd=path, stdin=subprocess.PIPE,
+    )
+    assert process.stdin is not None
+    for i in range(commits):
+        author = rand.randrange(authors)
+        reviewer = rand.randrange(authors)
+        path_name = 'dir%d/file%d' % (rand.randrange(10), rand.randrange(files))
+        message = ['Commit %d' % i, '']
+        message += ['Filler line %d of commit %d' % (x, i)
+                    for x in range(message_lines)]
+        message += ['', 'Reviewed By: user%d' % reviewer, '']
+        message_data = '\n'.join(message).encode('utf-8')
+        content = ('content %d\n' % i).encode('utf-8')
+        timestamp = EPOCH + i * 3600
+        stream = b'commit refs/heads/master\n'
+        stream += b'mark :%d\n' % (i + 1)
+        stream += b'author User %d <user%d@example.com> %d +0000\n' % (
+            author, author, timestamp,
+        )
+        stream += b'committer Committer <c@example.com> %d +0000\n' % (
+            timestamp,
+        )
+        stream += b'data %d\n%s\n' % (len(message_data), message_data)
+        if i:
+            stream += b'from :%d\n' % i
+        stream += b'M 100644 inline %s\n' % path_name.encode('utf-8')
+        stream += b'data %d\n%s\n' % (len(content), content)
+        process.stdin.write(stream)
+    process.stdin.close()
+    if process.wait() != 0:
+        raise RuntimeError('git fast-import failed')
+
+
+def make_changes(repo: str, count: int) -> None:
+    """
+    Check out the synthetic repository and modify a number of its files
+    so that there is a diff against master
+    """
+    subprocess.run(['git', 'reset', '-q', '--hard'], cwd=repo, check=True)
+    tracked = subprocess.run(
+        ['git', 'ls-files'], cwd=repo, stdout=subprocess.PIPE, check=True,
+    ).stdout.decode('utf-8').split()
+    for file_path in sorted(tracked)[:count]:
+        with open(os.path.join(repo, file_path), 'a') as handle:
+            handle.write('changed\n')
+
+
+def child_environment(repo: str) -> Dict[str, str]:
+    """ Environment for benchmark processes, with a fake arc on the path """
+    bin_directory = os.path.join(repo, '.git', 'benchmark-bin')
+    if not os.path.isdir(bin_directory):
+        os.mkdir(bin_directory)
+        write_fake_arc(bin_directory)
+    env = dict(os.environ)
+    env['PYTHONPATH'] = BASE_DIRECTORY
+    env['PATH'] = bin_directory + os.pathsep + env['PATH']
+    env['FAKE_ARC_LOG'] = os.devnull
+    return env
+
+
+def clone_partial(source: str, path: str) -> None:
+    """
+    Make a blobless partial clone of a repository, which only has the blobs
+    of the files it checked out
+    """
+    subprocess.run(
+        ['git', 'config', 'uploadpack.allowFilter', 'true'],
+        cwd=source, check=True,
+    )
+    subprocess.run(
+        ['git', 'clone', '-q', '--filter=blob:none', 'file://' + source, path],
+        check=True,
+    )
+
+
+def missing_objects(repo: str) -> int:
+    """ Count the objects a partial clone has left out """
+    output = subprocess.run(
+        ['git', 'rev-list', '--objects', '--missing=print', '--all'],
+        cwd=repo, stdout=subprocess.PIPE, check=True,
+    ).stdout
+    return sum(1 for x in output.split(b'\n') if x.startswith(b'?'))
+
+
+def measure_target(
+    repo: str, target: str, settings: Optional[Dict[str, Any]] = None,
+) -> Dict[str, Any]:
+    """ Run a benchmark target once in a fresh process """
+    if target.endswith(':cold'):
+        cache = os.path.join(repo, '.git', 'reviewers-cache')
+        shutil.rmtree(cache, ignore_errors=True)
+    process = subprocess.run(
+        [sys.executable, '-c', RUN_CHILD, target, json.dumps(settings or {})],
+        cwd=repo, env=child_environment(repo),
+        stdout=subprocess.PIPE, check=True,
+    )
+    result = json.loads(process.stdout.decode('utf-8'))
+    assert isinstance(result, dict)
+    return result
+
+
+def run_benchmark(
+    repo: str, targets: List[str], repeat: int,
+    settings: Optional[Dict[str, Any]] = None,
+) -> Dict[str, Dict[str, Any]]:
+    """
+    Measure each target repeat times, keeping the fastest wall time and
+    the largest memory use
+    """
+    results = {}  # type: Dict[str, Dict[str, Any]]
+    for target in targets:
+        runs = [
+            measure_target(repo, target, settings) for _ in range(repeat)
+        ]
+        results[target] = {
+            'wall_time': min(x['wall_time'] for x in runs),
+            'subprocesses': max(x['subprocesses'] for x in runs),
+            'peak_rss_kb': max(x['peak_rss_kb'] for x in runs),
+            'children_peak_rss_kb':
+                max(x['children_peak_rss_kb'] for x in runs),
+        }
+    return results
+
+
+def compare_results(
+    baseline: Dict[str, Dict[str, Any]],
+    results: Dict[str, Dict[str, Any]],
+    tolerance: float,
+) -> List[str]:
+    """
+    Return descriptions of regressions against a baseline.  Wall time and
+    memory regress when they grow by more than the tolerance, subprocess
+    counts regress when they grow at all.
+    """
+    regressions = []
+    for target, result in sorted(results.items()):
+        if target not in baseline:
+            continue
+        old = baseline[target]
+        for metric in ['wall_time', 'peak_rss_kb']:
+            if result[metric] > old[metric] * (1 + tolerance):
+                regressions.append('%s %s: %s -> %s' % (
+                    target, metric, old[metric], result[metric],
+                ))
+        if result['subprocesses'] > old['subprocesses']:
+            regressions.append('%s subprocesses: %d -> %d' % (
+                target, old['subprocesses'], result['subprocesses'],
+            ))
+    return regressions
+
+
+def print_results(results: Dict[str, Dict[str, Any]]) -> None:
+    print('%-26s %10s %12s %12s %12s' % (
+        'target', 'wall (s)', 'processes', 'rss KB', 'git rss KB',
+    ))
+    for target, result in results.items():
+        print('%-26s %10.3f %12d %12d %12d' % (
+            target, result['wall_time'], result['subprocesses'],
+            result['peak_rss_kb'], result['children_peak_rss_kb'],
+        ))
+
+
+def measure_log_memory(repo: str, mode: str) -> int:
+    """ Return the peak RSS in KB of reading git log --all in a mode """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = BASE_DIRECTORY
+    process = subprocess.run(
+        [sys.executable, '-c', MEMORY_CHILD, mode],
+        cwd=repo, env=env, stdout=subprocess.PIPE, check=True,
+    )
+    return int(process.stdout.decode('utf-8').strip())
+
+
+def memory_benchmark(sizes: List[int], message_lines: int) -> None:
+    """ Compare peak RSS of buffered and streamed git log reads """
+    print('%10s %14s %14s' % ('commits', 'buffered KB', 'streamed KB'))
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as repo:
+            build_repository(repo, size, 100, 20, message_lines)
+            buffered = measure_log_memory(repo, 'buffered')
+            streamed = measure_log_memory(repo, 'streamed')
+        print('%10d %14d %14d' % (size, buffered, streamed))
+
+
+def measure_startup(
+    arguments: List[str], cwd: Optional[str] = None, repeat: int = 3,
+) -> Dict[str, Any]:
+    """
+    Run python -X importtime with arguments, after a first run to write
+    bytecode, and return the fastest wall time and import time of
+    git_reviewers.reviewers in seconds with the modules imported
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = BASE_DIRECTORY
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    results = []  # type: List[Dict[str, Any]]
+    with tempfile.TemporaryDirectory() as cache:
+        env['PYTHONPYCACHEPREFIX'] = cache
+        for _ in range(repeat + 1):
+            start = time.perf_counter()
+            process = subprocess.run(
+                [sys.executable, '-X', 'importtime'] + arguments, cwd=cwd,
+                env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                check=True,
+            )
+            wall_time = time.perf_counter() - start
+            modules = []
+            import_time = 0.0
+            for line in process.stderr.decode('utf-8').splitlines():
+                if not line.startswith('import time:') or 'self [us]' in line:
+                    continue
+                _, cumulative, name = line.split('|')
+                modules.append(name.strip())
+                if name.strip() in ['git_reviewers.reviewers', '__main__']:
+                    import_time = int(cumulative) / 1e6
+            results.append({
+                'wall_time': wall_time, 'import_time': import_time,
+                'modules': modules,
+                'output': process.stdout.decode('utf-8'),
+            })
+    return min(results[1:], key=lambda x: x['wall_time'])
+
+
+def loaded_modules(
+    arguments: List[str], cwd: Optional[str] = None,
+) -> Dict[str, Any]:
+    """
+    Run the reviewers script with arguments, or only import
+    git_reviewers.reviewers without any, and return the output and the
+    modules in sys.modules once it is done
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = BASE_DIRECTORY
+    process = subprocess.run(
+        [sys.executable, '-c', MODULES_CHILD] + arguments, cwd=cwd, env=env,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=False,
+    )
+    return {
+        'output': process.stdout.decode('utf-8'),
+        'modules': json.loads(process.stderr.decode('utf-8')),
+    }
+
+
+def startup_benchmark() -> None:
+    """ Compare startup time of importing and running git-reviewers """
+    print('%-40s %10s %10s' % ('command', 'wall (s)', 'modules'))
+    for arguments in [
+        ['-c', 'pass'],
+        ['-c', 'import git_reviewers.reviewers'],
+        ['-m', 'git_reviewers.reviewers', '--version'],
+        [REVIEWERS_SCRIPT, '--version'],
+        [os.path.dirname(REVIEWERS_SCRIPT), '--version'],
+    ]:
+        result = measure_startup(arguments)
+        print('%-40s %10.3f %10d' % (
+            ' '.join(os.path.basename(x) for x in arguments),
+            result['wall_time'], len(result['modules']),
+        ))
+
+
+def partial_benchmark(
+    commits: int, files: int, authors: int, changed_files: int, repeat: int,
+) -> int:
+    """
+    Time get_reviewers with the ownership index built by each backend in a
+    blobless partial clone of a large repository.  The repository it was
+    cloned from stays reachable, so that a fetch succeeds and is counted.
+    Returns the number of objects fetched, which should be 0.
+    """
+    targets = ['get_reviewers:index:cold', 'get_reviewers:index:warm']
+    results = {}  # type: Dict[str, Dict[str, Any]]
+    with tempfile.TemporaryDirectory() as directory:
+        source = os.path.join(directory, 'source')
+        repo = os.path.join(directory, 'clone')
+        build_repository(source, commits, files, authors)
+        clone_partial(source, repo)
+        make_changes(repo, changed_files)
+        missing = missing_objects(repo)
+        for backend in ['git', 'native']:
+            backend_results = run_benchmark(
+                repo, targets, repeat, {'backend': backend},
+            )
+            for target, result in backend_results.items():
+                results['%s %s' % (backend, target)] = result
+        fetched = missing - missing_objects(repo)
+    print_results(results)
+    print('Missing blobs: %d, fetched: %d' % (missing, fetched))
+    return fetched
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter,
+    )
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+    run = subparsers.add_parser(
+        'run', help='time get_reviewers and each finder',
+    )
+    run.add_argument('--commits', type=int, default=5000)
+    run.add_argument('--files', type=int, default=500)
+    run.add_argument('--authors', type=int, default=50)
+    run.add_argument(
+        '--changed-files', type=int, default=20,
+        help='number of files modified on the benchmarked branch',
+    )
+    run.add_argument('--repeat', type=int, default=3)
+    run.add_argument(
+        '--targets', default=','.join(TARGETS),
+        help='comma separated list of targets to run',
+    )
+    run.add_argument('--save', default='', help='write results to a file')
+    run.add_argument(
+        '--compare', default='',
+        help='baseline results file to check for regressions against',
+    )
+    run.add_argument(
+        '--tolerance', type=float, default=0.2,
+        help='allowed relative growth in wall time and memory',
+    )
+    memory = subparsers.add_parser(
+        'memory', help='peak RSS of reading history',
+    )
+    memory.add_argument(
+        '--sizes', default='5000,20000,80000',
+        help='comma separated list of history sizes in commits',
+    )
+    memory.add_argument(
+        '--message-lines', type=int, default=20,
+        help='lines of filler text in each commit message',
+    )
+    subparsers.add_parser(
+        'startup', help='time taken to start and import modules',
+    )
+    partial = subparsers.add_parser(
+        'partial', help='time get_reviewers offline in a blobless clone',
+    )
+    partial.add_argument('--commits', type=int, default=100000)
+    partial.add_argument('--files', type=int, default=20000)
+    partial.add_argument('--authors', type=int, default=200)
+    partial.add_argument('--changed-files', type=int, default=20)
+    partial.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    if args.benchmark == 'run':
+        parameters = {
+            'commits': args.commits, 'files': args.files,
+            'authors': args.authors, 'changed_files': args.changed_files,
+        }
+        with tempfile.TemporaryDirectory() as repo:
+            build_repository(repo, args.commits, args.files, args.authors)
+            make_changes(repo, args.changed_files)
+            results = run_benchmark(
+                repo, args.targets.split(','), args.repeat,
+            )
+        print_results(results)
+        if args.save:
+            with open(args.save, 'w') as handle:
+                json.dump(
+                    {'parameters': parameters, 'results': results},
+                    handle, indent=4, sort_keys=True,
+                )
+        if args.compare:
+            with open(args.compare, 'r') as handle:
+                baseline = json.load(handle)
+            if baseline['parameters'] != parameters:
+                print('Baseline was recorded with %s' % baseline['parameters'])
+                sys.exit(2)
+            regressions = compare_results(
+                baseline['results'], results, args.tolerance,
+            )
+            for regression in regressions:
+                print('Regression: %s' % regression)
+            if regressions:
+                sys.exit(1)
+    elif args.benchmark == 'memory':
+        sizes = [int(x) for x in args.sizes.split(',')]
+        memory_benchmark(sizes, args.message_lines)
+    elif args.benchmark == 'startup':
+        startup_benchmark()
+    elif args.benchmark == 'partial':
+        fetched = partial_benchmark(
+            args.commits, args.files, args.authors, args.changed_files,
+            args.repeat,
+        )
+        if fetched:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,8 @@
 import copy
 import json
+import os
+import subprocess
+import sys
 from typing import Dict, Any
 
 PHAB_DEFAULT: Dict[str, Dict[str, Any]] = {
@@ -9,13 +12,102 @@ PHAB_DEFAULT: Dict[str, Dict[str, Any]] = {
 }
 
 PHAB_ACTIVATED = copy.deepcopy(PHAB_DEFAULT)
-PHAB_ACTIVATED['response']['data'] = \
-    [{'fields': {'roles': ['activated']}}]
+PHAB_ACTIVATED['response']['data'] = [
+    {'fields': {'username': 'asdf', 'roles': ['activated']}},
+    {'fields': {'username': 'qwer', 'roles': ['activated']}},
+]
 
 PHAB_DISABLED = copy.deepcopy(PHAB_DEFAULT)
-PHAB_DISABLED['response']['data'] = \
-    [{'fields': {'roles': ['disabled']}}]
+PHAB_DISABLED['response']['data'] = [
+    {'fields': {'username': 'asdf', 'roles': ['disabled']}},
+    {'fields': {'username': 'qwer', 'roles': ['disabled']}},
+]
 
 PHAB_DEFAULT_DATA = json.dumps(PHAB_DEFAULT).encode("utf-8")
 PHAB_ACTIVATED_DATA = json.dumps(PHAB_ACTIVATED).encode("utf-8")
 PHAB_DISABLED_DATA = json.dumps(PHAB_DISABLED).encode("utf-8")
+
+
+def git(
+    repo: str, *args: str, email: str = 'author@example.com', date: str = '',
+    committer_date: str = '',
+) -> None:
+    """
+    Run a git command against a test repository, committing at date unless
+    a different committer_date is given
+    """
+    env = dict(os.environ)
+    env.update({
+        'GIT_AUTHOR_NAME': email.split('@', maxsplit=1)[0],
+        'GIT_AUTHOR_EMAIL': email,
+        'GIT_COMMITTER_NAME': 'committer',
+        'GIT_COMMITTER_EMAIL': 'committer@example.com',
+    })
+    if date:
+        env['GIT_AUTHOR_DATE'] = date
+        env['GIT_COMMITTER_DATE'] = date
+    if committer_date:
+        env['GIT_COMMITTER_DATE'] = committer_date
+    subprocess.run(
+        ['git'] + list(args), cwd=repo, env=env, check=True,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+
+
+def init_repo(repo: str) -> None:
+    """ Create an empty test repository with a master branch """
+    git(repo, 'init', '-q')
+    git(repo, 'symbolic-ref', 'HEAD', 'refs/heads/master')
+
+
+def commit(
+    repo: str, email: str, files: Dict[str, str], message: str = 'commit',
+    date: str = '', committer_date: str = '',
+) -> None:
+    """ Write files to a test repository and commit them as an author """
+    for name, contents in files.items():
+        path = os.path.join(repo, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as handle:
+            handle.write(contents)
+    git(repo, 'add', '-A')
+    git(
+        repo, 'commit', '-q', '-m', message, email=email, date=date,
+        committer_date=committer_date,
+    )
+
+
+FAKE_ARC = '''#!%s
+import json
+import os
+import sys
+import time
+request = json.loads(sys.stdin.read())
+usernames = request['constraints']['usernames']
+log = os.environ['FAKE_ARC_LOG']
+with open(log, 'a') as handle:
+    handle.write('start %%s\\n' %% ','.join(usernames))
+time.sleep(float(os.environ.get('FAKE_ARC_DELAY', '0')))
+disabled = os.environ.get('FAKE_ARC_DISABLED', '').split(',')
+data = [
+    {'fields': {
+        'username': username,
+        'roles': ['disabled' if username in disabled else 'activated'],
+    }}
+    for username in usernames
+]
+with open(log, 'a') as handle:
+    handle.write('end %%s\\n' %% ','.join(usernames))
+print(json.dumps({'response': {'data': data}}))
+''' % sys.executable
+
+
+def write_fake_arc(directory: str) -> None:
+    """
+    Write a fake arc executable which answers conduit user.search requests
+    from the FAKE_ARC_* environment variables
+    """
+    path = os.path.join(directory, 'arc')
+    with open(path, 'w') as handle:
+        handle.write(FAKE_ARC)
+    os.chmod(path, 0o755)
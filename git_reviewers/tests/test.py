@@ -1,25 +1,70 @@
+import asyncio
+import io
 from collections import Counter
 import os
 import json
+import shutil
+import subprocess
 import sys
 import tempfile
+import threading
+import time
 import typing  # NOQA
+from typing import List
 import unittest
 from unittest.mock import patch, MagicMock
 
 from git_reviewers import reviewers
+from git_reviewers.native import NativeRepository
+from git_reviewers.tests import benchmark
 from git_reviewers.tests.fixtures import \
     PHAB_DEFAULT_DATA, \
     PHAB_ACTIVATED_DATA, \
-    PHAB_DISABLED_DATA
+    PHAB_DISABLED_DATA, \
+    commit, \
+    git, \
+    init_repo, \
+    write_fake_arc
 
 directory = os.path.dirname(os.path.realpath(__file__))
 BASE_DIRECTORY = os.path.normpath(os.path.join(directory, '..', '..'))
 
 
+async def no_output(*args: typing.Any) -> List[str]:
+    """ Stand in for FindReviewers.run_command_async """
+    return []
+
+
+def exit_batch_worker(line: str) -> str:
+    """ Stand in for answer_batch_request which kills its worker """
+    os._exit(1)
+
+
+def index_config() -> reviewers.Config:
+    """ Config which keeps an ownership index on disk """
+    config = reviewers.Config()
+    config.index = True
+    return config
+
+
+class RepoTestCase(unittest.TestCase):
+    """ Base class for tests that run against a real git repository """
+    def setUp(self) -> None:
+        self.repo_dir = tempfile.TemporaryDirectory()
+        self.repo = self.repo_dir.name
+        self.cwd = os.getcwd()
+        init_repo(self.repo)
+        os.chdir(self.repo)
+
+    def tearDown(self) -> None:
+        os.chdir(self.cwd)
+        self.repo_dir.cleanup()
+
+
 class TestFindReviewers(unittest.TestCase):
     def setUp(self) -> None:
         self.finder = reviewers.FindReviewers(reviewers.Config())
+        self.finder.config.user_cache_ttl = 0
         self.orig_reviewers_limit = reviewers.REVIEWERS_LIMIT
 
     def tearDown(self) -> None:
@@ -41,6 +86,60 @@ class TestFindReviewers(unittest.TestCase):
         data = self.finder.run_command([':'])
         self.assertEqual(data, [])
 
+    def test_stream_command(self) -> None:
+        command = [sys.executable, '-c', 'print("a\\n\\nb")']
+        data = list(self.finder.stream_command(command))
+        self.assertEqual(data, ['a', '', 'b'])
+
+    def test_stream_command_input(self) -> None:
+        command = [
+            sys.executable, '-c',
+            'import sys; sys.stdout.write(sys.stdin.read().upper())',
+        ]
+        data = list(self.finder.stream_command(command, 'a\nb\n'))
+        self.assertEqual(data, ['A', 'B'])
+
+    def test_profile_commands(self) -> None:
+        self.finder.config.profiler = reviewers.Profiler()
+        records = []  # type: List[typing.Dict[str, typing.Any]]
+        self.finder.config.profiler.add_sink(records.append)
+        command = [sys.executable, '-c', 'print("a\\nbc")']
+        self.assertEqual(self.finder.run_command(command), ['a', 'bc'])
+        data = list(self.finder.stream_command(command))
+        self.assertEqual(data, ['a', 'bc'])
+        self.assertEqual(len(records), 2)
+        for record in records:
+            self.assertEqual(record['kind'], 'command')
+            self.assertEqual(record['finder'], 'FindReviewers')
+            self.assertEqual(record['command'], ' '.join(command))
+            self.assertEqual(record['bytes_read'], 5)
+            self.assertEqual(record['lines'], 2)
+            self.assertGreaterEqual(record['wall_time'], record['parse_time'])
+        self.assertEqual(self.finder.config.profiler.records, records)
+
+    def test_run_command_async(self) -> None:
+        command = [
+            sys.executable, '-c',
+            'import sys; sys.stdout.write(sys.stdin.read().upper())',
+        ]
+        data = asyncio.run(self.finder.run_command_async(command, 'a\nb\n'))
+        self.assertEqual(data, ['A', 'B'])
+
+    def test_run_command_async_cancelled(self) -> None:
+        command = [sys.executable, '-c', 'import time; time.sleep(10)']
+        start = time.time()
+        with self.assertRaises(asyncio.TimeoutError):
+            asyncio.run(asyncio.wait_for(
+                self.finder.run_command_async(command), 0.1,
+            ))
+        self.assertLess(time.time() - start, 5)
+
+    def test_stream_command_closed_early(self) -> None:
+        command = [sys.executable, '-c', 'while True: print("a")']
+        lines = self.finder.stream_command(command)
+        self.assertEqual(next(lines), 'a')
+        lines.close()  # type: ignore
+
     def check_extract_username(self, email: str, expected_user: str) -> None:
         user = self.finder.extract_username_from_email(email)
         self.assertEqual(user, expected_user)
@@ -54,7 +153,7 @@ class TestFindReviewers(unittest.TestCase):
     @patch('subprocess.Popen')
     def test_check_phabricator_activated(self, mock_popen: MagicMock) -> None:
         mock_popen().communicate.return_value = [PHAB_ACTIVATED_DATA, '']
-        activated = self.finder.check_phabricator_activated('asdf')
+        activated = self.finder.check_phabricator_activated(['asdf'])
         self.assertTrue(activated)
 
     @patch('subprocess.Popen')
@@ -62,24 +161,26 @@ class TestFindReviewers(unittest.TestCase):
         self, mock_popen: MagicMock,
     ) -> None:
         mock_popen().communicate.return_value = [PHAB_DEFAULT_DATA, '']
-        activated = self.finder.check_phabricator_activated('asdf')
+        activated = self.finder.check_phabricator_activated(['asdf'])
         self.assertTrue(activated)
 
     def test_filter_phabricator_activated(self) -> None:
         users = ['a', 'b', 'c', 'd']
         reviewers.REVIEWERS_LIMIT = 2
+        self.finder.config.phabricator_concurrency = 1
+        self.finder.config.phabricator_batch_size = 1
         self.mock_check_count = 0
 
-        def mock_check(u: str) -> int:
-            self.assertEqual(u, users[self.mock_check_count])
+        def mock_check(u: List[str]) -> int:
+            self.assertEqual(u, [users[self.mock_check_count]])
             self.mock_check_count += 1
             return self.mock_check_count - 1
         self.mock_parse_count = 0
 
-        def mock_parse(u: str, p: int) -> str:
-            self.assertEqual(u, users[self.mock_parse_count])
+        def mock_parse(u: List[str], p: int) -> List[str]:
+            self.assertEqual(u, [users[self.mock_parse_count]])
             self.assertEqual(p, self.mock_parse_count)
-            parse_return = ''
+            parse_return = []  # type: List[str]
             if self.mock_parse_count in [0, 2]:
                 parse_return = u
             self.mock_parse_count += 1
@@ -91,6 +192,168 @@ class TestFindReviewers(unittest.TestCase):
         self.assertEqual(self.mock_parse_count, 3)
         self.assertEqual(filtered_usernames, ['a', 'c'])
 
+    def test_parse_phabricator_batch(self) -> None:
+        process = MagicMock()
+        process.returncode = 0
+        process.communicate.return_value = [PHAB_DISABLED_DATA, b'']
+        usernames = ['zxcv', 'ASDF', 'qwer']
+        parsed = self.finder.parse_phabricator(usernames, process)
+        self.assertEqual(parsed, ['zxcv'])
+
+    def test_parse_phabricator_failure(self) -> None:
+        process = MagicMock()
+        process.returncode = 1
+        process.communicate.return_value = [b'', b'error']
+        with patch('builtins.print'):
+            with self.assertRaises(RuntimeError):
+                self.finder.parse_phabricator(['asdf'], process)
+
+
+class FakeArcTestCase(unittest.TestCase):
+    """ Base class for tests that call a fake arc executable """
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        write_fake_arc(self.directory.name)
+        self.log = os.path.join(self.directory.name, 'log')
+        path = self.directory.name + os.pathsep + os.environ['PATH']
+        self.environ = patch.dict(os.environ, {
+            'PATH': path, 'FAKE_ARC_LOG': self.log,
+        })
+        self.environ.start()
+        self.finder = reviewers.FindReviewers(reviewers.Config())
+        self.finder.config.user_cache_ttl = 0
+        self.orig_reviewers_limit = reviewers.REVIEWERS_LIMIT
+
+    def tearDown(self) -> None:
+        reviewers.REVIEWERS_LIMIT = self.orig_reviewers_limit
+        self.environ.stop()
+        self.directory.cleanup()
+
+    def read_log(self) -> List[str]:
+        with open(self.log) as handle:
+            return handle.read().split('\n')[:-1]
+
+
+class TestFakeArc(FakeArcTestCase):
+    def test_single_request(self) -> None:
+        os.environ['FAKE_ARC_DISABLED'] = 'u1'
+        users = ['u%d' % i for i in range(20)]
+        usernames = self.finder.filter_phabricator_activated(users)
+        self.assertEqual(usernames, ['u0'] + users[2:8])
+        self.assertEqual(self.read_log(), [
+            'start %s' % ','.join(users), 'end %s' % ','.join(users),
+        ])
+
+    def test_batches_stop_early(self) -> None:
+        reviewers.REVIEWERS_LIMIT = 3
+        self.finder.config.phabricator_concurrency = 1
+        self.finder.config.phabricator_batch_size = 3
+        os.environ['FAKE_ARC_DISABLED'] = 'u1'
+        users = ['u%d' % i for i in range(20)]
+        usernames = self.finder.filter_phabricator_activated(users)
+        self.assertEqual(usernames, ['u0', 'u2', 'u3'])
+        self.assertEqual(self.read_log(), [
+            'start u0,u1,u2', 'end u0,u1,u2', 'start u3,u4,u5', 'end u3,u4,u5',
+        ])
+
+    def test_preserves_rank_order(self) -> None:
+        reviewers.REVIEWERS_LIMIT = 3
+        self.finder.config.phabricator_batch_size = 1
+        self.finder.config.phabricator_concurrency = 2
+        os.environ['FAKE_ARC_DISABLED'] = 'u1'
+        users = ['u%d' % i for i in range(20)]
+        usernames = self.finder.filter_phabricator_activated(users)
+        self.assertEqual(usernames, ['u0', 'u2', 'u3'])
+        starts = [x for x in self.read_log() if x.startswith('start')]
+        self.assertLessEqual(len(starts), 5)
+
+    def test_concurrency_limit(self) -> None:
+        self.finder.config.phabricator_batch_size = 1
+        self.finder.config.phabricator_concurrency = 3
+        os.environ['FAKE_ARC_DELAY'] = '0.2'
+        users = ['u%d' % i for i in range(7)]
+        usernames = self.finder.filter_phabricator_activated(users)
+        self.assertEqual(usernames, users)
+        in_flight = 0
+        max_in_flight = 0
+        for line in self.read_log():
+            in_flight += 1 if line.startswith('start') else -1
+            max_in_flight = max(max_in_flight, in_flight)
+        self.assertLessEqual(max_in_flight, 3)
+        self.assertGreater(max_in_flight, 1)
+
+
+class TestUserCache(FakeArcTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.cwd = os.getcwd()
+        self.repo = os.path.join(self.directory.name, 'repo')
+        os.mkdir(self.repo)
+        init_repo(self.repo)
+        os.chdir(self.repo)
+        self.finder.config.user_cache_ttl = 100
+        self.finder.config.user_cache_negative_ttl = 10
+        os.environ['FAKE_ARC_DISABLED'] = 'u1'
+        self.users = ['u%d' % i for i in range(4)]
+        self.usernames = self.finder.filter_phabricator_activated(self.users)
+        os.remove(self.log)
+
+    def tearDown(self) -> None:
+        os.chdir(self.cwd)
+        super().tearDown()
+
+    def test_warm_run(self) -> None:
+        usernames = self.finder.filter_phabricator_activated(self.users)
+        self.assertEqual(usernames, ['u0', 'u2', 'u3'])
+        self.assertEqual(usernames, self.usernames)
+        self.assertFalse(os.path.exists(self.log))
+
+    def test_only_unknown_users_checked(self) -> None:
+        users = self.users + ['u4']
+        usernames = self.finder.filter_phabricator_activated(users)
+        self.assertEqual(usernames, ['u0', 'u2', 'u3', 'u4'])
+        self.assertEqual(self.read_log(), ['start u4', 'end u4'])
+
+    def test_no_check_past_limit(self) -> None:
+        reviewers.REVIEWERS_LIMIT = 2
+        users = self.users + ['u4']
+        usernames = self.finder.filter_phabricator_activated(users)
+        self.assertEqual(usernames, ['u0', 'u2'])
+        self.assertFalse(os.path.exists(self.log))
+
+    def test_refresh_users(self) -> None:
+        self.finder.config.refresh_users = True
+        os.environ['FAKE_ARC_DISABLED'] = 'u2'
+        usernames = self.finder.filter_phabricator_activated(self.users)
+        self.assertEqual(usernames, ['u0', 'u1', 'u3'])
+        self.assertEqual(len(self.read_log()), 2)
+
+    def test_expiry(self) -> None:
+        os.environ['FAKE_ARC_DISABLED'] = ''
+        with patch('time.time', return_value=time.time() + 50):
+            usernames = self.finder.filter_phabricator_activated(self.users)
+        self.assertEqual(usernames, self.users)
+        self.assertEqual(self.read_log(), ['start u1', 'end u1'])
+
+    def test_eviction(self) -> None:
+        git_dir = os.path.join(self.repo, '.git')
+        path = reviewers.UserCache.cache_path(git_dir)
+        cache = reviewers.UserCache.load(path, self.finder.config)
+        self.assertEqual(len(cache.users), 4)
+        cache.set('u9', True, time.time() + 1)
+        self.finder.config.user_cache_size = 2
+        cache.save(path)
+        cache = reviewers.UserCache.load(path, self.finder.config)
+        self.assertEqual(len(cache.users), 2)
+        self.assertIn('u9', cache.users)
+
+    def test_invalid_cache(self) -> None:
+        path = os.path.join(self.repo, 'users.json')
+        with open(path, 'w') as handle:
+            handle.write('[]')
+        cache = reviewers.UserCache.load(path, self.finder.config)
+        self.assertEqual(cache.users, {})
+
 
 class TestFindLogReviewers(unittest.TestCase):
     def setUp(self) -> None:
@@ -165,29 +428,1449 @@ class TestHistoricalReviewers(unittest.TestCase):
         self.assertEqual(counter, reviewers)
 
 
+class TestOwnershipIndex(RepoTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        commit(self.repo, 'a@example.com', {'a': '1', 'b': '1'})
+        commit(self.repo, 'b@example.com', {'b': '2'})
+        git(self.repo, 'checkout', '-q', '-b', 'side')
+        commit(self.repo, 'c@example.com', {'a': 'side'})
+        git(self.repo, 'checkout', '-q', 'master')
+        commit(self.repo, 'a@example.com', {'a': 'master'})
+        with self.assertRaises(subprocess.CalledProcessError):
+            git(self.repo, 'merge', '-q', 'side')
+        commit(self.repo, 'd@example.com', {'a': 'merged'}, 'merge')
+        git(self.repo, 'checkout', '-q', '-b', 'unmerged')
+        message = 'Summary\n\nReviewed By: e, f\n'
+        commit(self.repo, 'e@example.com', {'b': 'unmerged'}, message)
+        git(self.repo, 'checkout', '-q', 'master')
+        commit(self.repo, 'f@example.com', {'c': '1'}, 'Reviewed By: e\n')
+        self.finder = reviewers.FindArcCommitReviewers(index_config())
+
+    def check_matches_shortlog(self, index: reviewers.OwnershipIndex) -> None:
+        for file_paths in [['a'], ['b'], ['a', 'b'], ['c'], ['d'], []]:
+            indexed = [x.strip() for x in index.shortlog(file_paths)]
+            uncached = self.finder.get_shortlog(file_paths)
+            uncached = [x.strip() for x in uncached]
+            self.assertEqual(indexed, uncached)
+            self.assertEqual(
+                index.reviewers(file_paths),
+                self.finder.get_message_reviewers(file_paths),
+            )
+
+    def test_ingest(self) -> None:
+        index = reviewers.OwnershipIndex()
+        index.ingest([
+            '\x001 0\x002 3\x00A <a@x>\x00C <c@x>\x1fd', '', 'M\ta', 'A\tb',
+            '\x000\x001 1\x00B <b@x>\x00', '', 'A\ta',
+        ])
+        index.ingest_reviews(
+            ['\x001', 'subject', '', 'Reviewed By: e', '\x002', 'subject'], 0,
+        )
+        index.update_reachability('1', ['1'])
+        self.assertEqual(index.parents, [[1], []])
+        self.assertEqual(index.times.tolist(), [2, 1])
+        self.assertEqual(index.commit_times.tolist(), [3, 1])
+        self.assertEqual(
+            index.shortlog(['a', 'b']),
+            ['     1\tA <a@x>', '     1\tB <b@x>'],
+        )
+        self.assertEqual(index.shortlog(['b']), ['     1\tA <a@x>'])
+        self.assertEqual(len(index.shortlog([])), 2)
+        self.assertEqual(index.reviewers(['a']), Counter({'e': 1}))
+        self.assertEqual(
+            index.reviewers(['a'], trailers=True), Counter({'c@x': 1, 'd': 1}),
+        )
+
+    def test_scores(self) -> None:
+        index = reviewers.OwnershipIndex()
+        day = 24 * 60 * 60
+        index.ingest([
+            '\x001 0\x00%d 0\x00A <a@x>\x00c' % (10 * day), '', 'M\ta',
+            '\x000\x00%d 0\x00B <b@x>\x00c' % (8 * day), '', 'A\ta',
+        ])
+        index.update_reachability('1', ['1'])
+        weights = index.commit_weights(2, 10 * day)
+        self.assertEqual(weights.tolist(), [1.0, 0.5])
+        self.assertEqual(
+            index.author_scores(['a'], weights),
+            {'A <a@x>': 1.0, 'B <b@x>': 0.5},
+        )
+        self.assertEqual(index.reviewer_scores([], weights), {})
+        self.assertEqual(
+            index.reviewer_scores([], weights, trailers=True), {'c': 1.5},
+        )
+
+    def test_ingest_skips_known_commits(self) -> None:
+        index = reviewers.OwnershipIndex()
+        index.ingest(['\x000\x001 1\x00A <a@x>\x00', '', 'A\ta'])
+        index.ingest(['\x000\x001 1\x00A <a@x>\x00', '', 'A\ta'])
+        self.assertEqual(index.authors.tolist(), [0])
+        self.assertEqual(index.paths, {'a': [0]})
+
+    def test_reachability(self) -> None:
+        index = self.finder.get_index()
+        assert index is not None
+        self.assertEqual(len(index.outside_head), 1)
+        self.assertEqual(index.outside_refs, [])
+        self.assertEqual(index.reviewers([]), Counter({'e': 2, 'f': 1}))
+
+    def test_matches_shortlog(self) -> None:
+        index = self.finder.build_index()
+        assert index is not None
+        self.check_matches_shortlog(index)
+
+    def test_incremental_update(self) -> None:
+        index = self.finder.build_index()
+        assert index is not None
+        old_head = index.head
+        commit(self.repo, 'e@example.com', {'d': '1'})
+        self.finder.stream_command = MagicMock(  # type: ignore
+            side_effect=self.finder.stream_command,
+        )
+        index = self.finder.build_index()
+        assert index is not None
+        self.assertNotEqual(index.head, old_head)
+        command, exclude = self.finder.stream_command.call_args[0]
+        self.assertIn('--stdin', command)
+        self.assertIn('^%s' % old_head, exclude)
+        self.assertEqual(len(index.authors), 8)
+        self.check_matches_shortlog(index)
+
+    def test_trailers(self) -> None:
+        self.finder.build_index()
+        message = 'Summary\n\nReviewed By: g\n\nTest plan\n\n' + \
+            'Reviewed-by: R <r@example.com>\nApproved-by: s\n' + \
+            'Co-authored-by: T <t@example.com>\nSigned-off-by: u\n'
+        commit(self.repo, 'e@example.com', {'d': '1'}, message)
+        index = self.finder.build_index()
+        assert index is not None
+        self.assertEqual(index.reviewers(['d']), Counter({'g': 1}))
+        self.assertEqual(index.reviewers(['d'], trailers=True), Counter({
+            'r@example.com': 1, 's': 1, 't@example.com': 1,
+        }))
+        self.check_matches_shortlog(index)
+
+    def test_renames(self) -> None:
+        lines = ''.join('line %d\n' % x for x in range(10))
+        commit(self.repo, 'a@example.com', {'b': lines})
+        self.finder.build_index()
+        git(self.repo, 'mv', 'b', 'd')
+        commit(self.repo, 'g@example.com', {'d': lines + 'moved\n'}, 'move')
+        git(self.repo, 'mv', 'd', 'e')
+        commit(self.repo, 'h@example.com', {}, 'move again')
+        index = self.finder.build_index()
+        assert index is not None
+        self.assertEqual(index.lineage('e'), ['e', 'd', 'b'])
+        # The unmerged commit to b is not an ancestor of its rename
+        unmerged = index.sha_ids[self.finder.run_command(
+            ['git', 'rev-parse', 'unmerged'],
+        )[0]]
+        self.assertEqual(
+            index.lineage_commits('e'),
+            set(index.paths['e'] + index.paths['d'] + index.paths['b']) -
+            {unmerged},
+        )
+        index_path = reviewers.OwnershipIndex.index_path(
+            os.path.join(self.repo, '.git'),
+        )
+        loaded = reviewers.OwnershipIndex.load(index_path)
+        assert loaded is not None
+        self.assertEqual(loaded.renames, index.renames)
+        self.assertEqual(
+            {x: [y for y, _ in z] for x, z in loaded.renames.items()},
+            {'d': ['b'], 'e': ['d']},
+        )
+        self.check_matches_shortlog(index)
+
+        config = index_config()
+        config.changed_files = ['e']
+        finder = reviewers.FindLogReviewers(config)
+        self.assertEqual(finder.get_file_paths(), ['e'])
+        self.assertEqual(finder.get_reviewers(), Counter({
+            'a@example.com': 2, 'b@example.com': 1, 'g@example.com': 1,
+            'h@example.com': 1,
+        }))
+        # e and f only reviewed the unmerged change to b
+        self.assertEqual(finder.get_matched_files(), Counter({
+            'a@example.com': 1, 'b@example.com': 1, 'g@example.com': 1,
+            'h@example.com': 1,
+        }))
+        config.follow_renames = False
+        self.assertEqual(
+            finder.get_reviewers(), Counter({'h@example.com': 1}),
+        )
+
+    def test_renamed_path_reused(self) -> None:
+        commit(self.repo, 'g@example.com', {'d': 'old\n'})
+        git(self.repo, 'mv', 'd', 'e')
+        commit(self.repo, 'h@example.com', {}, 'move')
+        commit(self.repo, 'i@example.com', {'d': 'unrelated\n'})
+        index = self.finder.build_index()
+        assert index is not None
+        self.assertEqual(index.lineage('e'), ['e', 'd'])
+        commits = index.lineage_commits('e')
+        self.assertEqual(
+            {index.identities[index.authors[x]] for x in commits},
+            {'g <g@example.com>', 'h <h@example.com>'},
+        )
+
+        config = index_config()
+        config.changed_files = ['e']
+        finder = reviewers.FindLogReviewers(config)
+        self.assertNotIn('i@example.com', finder.get_reviewers())
+        self.assertIn('g@example.com', finder.get_reviewers())
+
+    def test_unchanged_refs(self) -> None:
+        self.finder.build_index()
+        finder = reviewers.FindLogReviewers(index_config())
+        finder.run_command = MagicMock(  # type: ignore
+            side_effect=finder.run_command,
+        )
+        finder.build_index()
+        self.assertEqual(finder.run_command.call_count, 2)
+
+    def test_deleted_branch(self) -> None:
+        self.finder.build_index()
+        git(self.repo, 'branch', '-q', '-D', 'unmerged')
+        index = self.finder.build_index()
+        assert index is not None
+        self.assertEqual(len(index.outside_refs), 1)
+        self.check_matches_shortlog(index)
+
+    def test_in_memory_index(self) -> None:
+        config = reviewers.Config()
+        finder = reviewers.FindLogReviewers(config)
+        self.assertIsNone(finder.get_index())
+        self.assertIsNotNone(finder.build_index())
+        cache = os.path.join(self.repo, '.git', reviewers.CACHE_DIRECTORY)
+        self.assertFalse(os.path.exists(cache))
+
+    def test_rewritten_history(self) -> None:
+        self.finder.build_index()
+        git(self.repo, 'reset', '-q', '--hard', 'HEAD~1')
+        commit(self.repo, 'e@example.com', {'c': '1'})
+        index = self.finder.build_index()
+        assert index is not None
+        self.check_matches_shortlog(index)
+
+    def test_rebuild_index(self) -> None:
+        index = self.finder.build_index()
+        assert index is not None
+        self.finder.config.rebuild_index = True
+        rebuilt = self.finder.build_index()
+        self.finder.config.rebuild_index = False
+        assert rebuilt is not None
+        self.assertIsNot(index, rebuilt)
+        self.assertEqual(index.authors, rebuilt.authors)
+
+    def test_load_invalid(self) -> None:
+        path = os.path.join(self.repo, 'index.json')
+        self.assertIsNone(reviewers.OwnershipIndex.load(path))
+        with open(path, 'w') as handle:
+            handle.write('[]')
+        self.assertIsNone(reviewers.OwnershipIndex.load(path))
+
+    def test_no_repository(self) -> None:
+        with tempfile.TemporaryDirectory() as directory:
+            os.chdir(directory)
+            self.assertIsNone(self.finder.build_index())
+
+    @patch('builtins.print')
+    def test_verify_index(self, mock_print: MagicMock) -> None:
+        self.assertTrue(reviewers.verify_index(index_config()))
+        index = self.finder.build_index()
+        assert index is not None
+        index.authors[0] = index.authors[1]
+        git_dir = os.path.join(self.repo, '.git')
+        index.save(reviewers.OwnershipIndex.index_path(git_dir))
+        self.assertFalse(reviewers.verify_index(index_config()))
+
+    @patch('builtins.print')
+    def test_verify_discarded_branch(self, mock_print: MagicMock) -> None:
+        git(self.repo, 'checkout', '-q', '-b', 'discarded')
+        commit(self.repo, 'side@example.com', {'a': 'discarded\n'})
+        git(self.repo, 'checkout', '-q', 'master')
+        git(self.repo, 'merge', '-q', '-s', 'ours', 'discarded', '-m', 'merge')
+        config = index_config()
+        config.changed_files = ['a']
+        self.assertFalse(reviewers.verify_index(config))
+        printed = [x[0][0] for x in mock_print.call_args_list]
+        self.assertIn('index only: 1\tside <side@example.com>', printed)
+        self.assertIn(
+            'Commits on side branches which a merge discarded are only '
+            'counted by the index', printed,
+        )
+
+
+class TestNativeRepository(RepoTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        commit(self.repo, 'a@example.com', {'a': '1', 'dir/b': '1'})
+        git(self.repo, 'checkout', '-q', '-b', 'side')
+        commit(self.repo, 'c@example.com', {'a': 'side'})
+        git(self.repo, 'checkout', '-q', 'master')
+        commit(self.repo, 'b@example.com', {'dir/b': '2', 'café': '1'})
+        git(self.repo, 'merge', '-q', '--no-edit', 'side')
+        git(self.repo, 'tag', '-a', '-m', 'release', 'v1')
+        git(self.repo, 'mv', 'dir', 'moved')
+        message = 'Move\n\nReviewed By: e\n\nReviewed-by: R <r@example.com>\n'
+        commit(self.repo, 'd@example.com', {'.mailmap': (
+            'Dee <dee@example.com> <d@example.com>\n'
+        )}, message)
+        self.git_config = reviewers.Config()
+        self.git_config.index = False
+        self.native_config = reviewers.Config()
+        self.native_config.index = False
+        self.native_config.backend = 'native'
+
+    def normalize(self, index: reviewers.OwnershipIndex) -> typing.Any:
+        commits = {}  # type: typing.Dict[str, typing.Any]
+        for i, sha in enumerate(index.shas):
+            commits[sha] = [
+                sorted(index.shas[x] for x in index.parents[i]),
+                index.identities[index.authors[i]], index.times[i],
+                index.commit_times[i],
+                sorted(index.reviews.get(i, [])), [],
+            ]
+        for path, ids in index.paths.items():
+            for i in ids:
+                commits[index.shas[i]][5].append(path)
+        for data in commits.values():
+            data[5].sort()
+        renames = {
+            path: [(x, index.shas[y]) for x, y in renamed_from]
+            for path, renamed_from in index.renames.items()
+        }
+        return commits, index.head, index.tips, renames
+
+    def check_matches_git(self) -> None:
+        expected = reviewers.FindReviewers(self.git_config).build_index()
+        native = reviewers.FindReviewers(self.native_config).build_index()
+        assert expected is not None and native is not None
+        self.assertEqual(self.normalize(native), self.normalize(expected))
+
+    def test_loose_objects(self) -> None:
+        native = NativeRepository.open(self.repo)
+        head, _ = native.head_and_tips()
+        expected = subprocess.check_output(['git', 'rev-parse', 'HEAD'])
+        self.assertEqual(head, expected.decode('utf-8').strip())
+        self.check_matches_git()
+
+    def test_packed_objects(self) -> None:
+        git(self.repo, 'gc', '-q', '--aggressive')
+        self.check_matches_git()
+
+    def test_incremental_update(self) -> None:
+        self.native_config.index = True
+        reviewers.FindReviewers(self.native_config).build_index()
+        git(self.repo, 'gc', '-q')
+        commit(self.repo, 'e@example.com', {'moved/b': '3'})
+        self.check_matches_git()
+
+    def test_unsupported(self) -> None:
+        git(self.repo, 'config', 'log.showRoot', 'false')
+        with self.assertRaises(ValueError):
+            NativeRepository.open(self.repo)
+        self.check_matches_git()
+
+    def test_native_failure(self) -> None:
+        with patch.object(
+            NativeRepository, 'ingest', side_effect=ValueError,
+        ):
+            self.check_matches_git()
+
+    def test_quote_path(self) -> None:
+        self.assertEqual(reviewers.quote_path(b'a b'), 'a b')
+        self.assertEqual(
+            reviewers.quote_path('café\t"'.encode('utf-8')),
+            '"caf\\303\\251\\t\\""',
+        )
+
+    def test_parse_trailers(self) -> None:
+        self.assertEqual(reviewers.parse_trailers(
+            'Title\n\nBody\n\nAcked-by: a\nReviewed-by: b\n  c\n',
+        ), [('Acked-by', 'a'), ('Reviewed-by', 'b c')])
+        self.assertEqual(reviewers.parse_trailers('Acked-by: a\n'), [])
+        self.assertEqual(reviewers.parse_trailers(
+            'Title\n\nNot a trailer\nAcked-by: a\n',
+        ), [])
+        self.assertEqual(reviewers.parse_trailers(
+            'Title\n\nAcked-by: a\n---\nNotes: b\n',
+        ), [('Acked-by', 'a')])
+
+
+class TestPartialClone(RepoTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        lines = ''.join('line %d\n' % x for x in range(10))
+        commit(self.repo, 'a@example.com', {'a': lines, 'b': lines + '1\n'})
+        commit(self.repo, 'b@example.com', {'a': lines + '2\n'})
+        git(self.repo, 'mv', 'b', 'c')
+        commit(self.repo, 'c@example.com', {'c': lines + '3\n'})
+        git(self.repo, 'mv', 'a', 'd')
+        commit(self.repo, 'd@example.com', {})
+        self.clone_dir = tempfile.TemporaryDirectory()
+        self.clone = os.path.join(self.clone_dir.name, 'clone')
+        benchmark.clone_partial(self.repo, self.clone)
+        os.chdir(self.clone)
+        self.config = reviewers.Config()
+        self.config.user_cache_ttl = 0
+
+    def tearDown(self) -> None:
+        self.clone_dir.cleanup()
+        super().tearDown()
+
+    def test_resolve_blobs(self) -> None:
+        reviewers.resolve_blobs(self.config)
+        self.assertEqual(self.config.blobs, 'skip')
+        git(self.clone, 'config', 'remote.origin.partialclonefilter', 'tree:0')
+        config = reviewers.Config()
+        reviewers.resolve_blobs(config)
+        self.assertEqual(config.blobs, 'read')
+        config.blobs = 'auto'
+        os.chdir(self.cwd)
+        reviewers.resolve_blobs(config)
+        self.assertEqual(config.blobs, 'read')
+
+    def test_no_blob_reads(self) -> None:
+        missing = benchmark.missing_objects(self.clone)
+        with open(os.path.join(self.clone, 'c'), 'a') as handle:
+            handle.write('changed\n')
+        self.config.finders = {'FindBlameReviewers': True}
+        ranking = reviewers.rank_reviewers(self.config)
+        self.assertEqual(
+            [x['reviewer'] for x in ranking],
+            ['c@example.com', 'a@example.com', 'b@example.com',
+             'd@example.com'],
+        )
+        for reviewer in ranking:
+            self.assertNotIn('FindBlameReviewers', reviewer['finders'])
+        index = reviewers.FindReviewers(self.config).build_index()
+        assert index is not None
+        self.assertEqual(
+            {x: [y for y, _ in z] for x, z in index.renames.items()},
+            {'d': ['a']},
+        )
+        self.assertEqual(benchmark.missing_objects(self.clone), missing)
+
+    def test_no_lazy_fetch(self) -> None:
+        missing = benchmark.missing_objects(self.clone)
+        self.config.blobs = 'skip'
+        finder = reviewers.FindReviewers(self.config)
+        blob = finder.run_command(['git', 'rev-parse', 'HEAD~3:a'])
+        command = ['git', 'cat-file', 'blob'] + blob
+        process = subprocess.run(
+            command, env=finder.get_environment(),
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False,
+        )
+        self.assertNotEqual(process.returncode, 0)
+        self.assertEqual(benchmark.missing_objects(self.clone), missing)
+        subprocess.run(command, stdout=subprocess.DEVNULL, check=True)
+        self.assertEqual(benchmark.missing_objects(self.clone), missing - 1)
+
+
+class TestDirectoryRollup(RepoTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        commit(self.repo, 'a@example.com', {
+            'x/y/1': '1', 'x/y/2': '1', 'x/z/3': '1', 'w/4': '1', 'r': '1',
+        })
+        commit(self.repo, 'b@example.com', {'x/y/1': '2'})
+        commit(self.repo, 'c@example.com', {'x/z/3': '2', 'w/4': '2'})
+        commit(self.repo, 'd@example.com', {'x/y/2': '2'}, 'Reviewed By: e\n')
+        self.config = reviewers.Config()
+        self.config.changed_files = ['x/y/1', 'x/z/3', 'r', 'x/y/2']
+        self.finder = reviewers.FindArcCommitReviewers(self.config)
+        self.index = typing.cast(
+            reviewers.OwnershipIndex, self.finder.build_index(),
+        )
+
+    def test_directory_trie(self) -> None:
+        trie = reviewers.DirectoryTrie.build(self.index.paths, 2)
+        x = typing.cast(reviewers.DirectoryTrie, trie.find('x/'))
+        self.assertEqual(x.commits, {0, 1, 2, 3})
+        y = typing.cast(reviewers.DirectoryTrie, trie.find('x/y/'))
+        authors = [self.index.identities[self.index.authors[x]]
+                   for x in sorted(y.commits)]
+        self.assertEqual(authors, [
+            'd <d@example.com>', 'b <b@example.com>', 'a <a@example.com>',
+        ])
+        self.assertIsNone(trie.find('q/'))
+        self.assertIsNone(trie.find('r/'))
+        shallow = reviewers.DirectoryTrie.build(self.index.paths, 1)
+        self.assertIsNone(shallow.find('x/y/'))
+        deep = self.index.directory_trie(2)
+        self.assertIs(self.index.directory_trie(1), deep)
+
+    def test_directory_history(self) -> None:
+        pathspecs = [['x/'], ['x/y/'], ['x/z/', 'w/'], ['x/y/', 'r'], ['q/']]
+        for file_paths in pathspecs:
+            indexed = [x.strip() for x in self.index.shortlog(file_paths)]
+            uncached = self.finder.get_shortlog(file_paths)
+            self.assertEqual(indexed, [x.strip() for x in uncached])
+            self.assertEqual(
+                self.index.reviewers(file_paths),
+                self.finder.get_message_reviewers(file_paths),
+            )
+
+    def test_message_reviewers_single_log(self) -> None:
+        stream_command = self.finder.stream_command
+        with patch.object(
+            self.finder, 'stream_command', side_effect=stream_command,
+        ) as mock_stream_command:
+            reviews = self.finder.get_message_reviewers(['x/'])
+        self.assertEqual(reviews, self.index.reviewers(['x/']))
+        self.assertEqual(mock_stream_command.call_count, 1)
+
+    def test_get_file_paths(self) -> None:
+        self.assertEqual(
+            self.finder.get_file_paths(), self.config.changed_files,
+        )
+        self.config.directory_threshold = 2
+        self.assertEqual(
+            self.finder.get_file_paths(), ['x/y/', 'x/z/', 'r'],
+        )
+        self.config.directory_depth = 1
+        self.assertEqual(self.finder.get_file_paths(), ['x/', 'r'])
+
+    def test_rolled_up_reviewers(self) -> None:
+        self.config.directory_threshold = 2
+        self.config.directory_depth = 1
+        finder = reviewers.FindLogReviewers(self.config, self.index)
+        self.assertEqual(finder.get_reviewers(), Counter({
+            'a@example.com': 1, 'b@example.com': 1, 'c@example.com': 1,
+            'd@example.com': 1,
+        }))
+        self.config.index = False
+        finder = reviewers.FindLogReviewers(self.config)
+        self.assertEqual(len(finder.get_reviewers()), 4)
+
+    def test_stdin_pathspecs(self) -> None:
+        file_paths = ['x/y/1', 'w/', 'missing']
+        expected = self.finder.get_shortlog(file_paths)
+        expected_reviewers = self.finder.get_message_reviewers(['x/'])
+        with patch('git_reviewers.reviewers.PATHSPEC_ARGV_LIMIT', 0):
+            shortlog = self.finder.get_shortlog(file_paths)
+            message_reviewers = self.finder.get_message_reviewers(['x/'])
+        self.assertEqual(
+            [x.strip() for x in shortlog], [x.strip() for x in expected],
+        )
+        self.assertEqual(message_reviewers, expected_reviewers)
+        self.assertEqual(message_reviewers, Counter({'e': 1}))
+
+
+class TestHistoryWindow(RepoTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        dates = ['%d-01-01T00:00:00' % year for year in range(2020, 2024)]
+        commit(self.repo, 'a@example.com', {'a': '1'}, date=dates[0])
+        git(self.repo, 'tag', 'v1')
+        commit(self.repo, 'b@example.com', {'a': '2'}, date=dates[1])
+        message = 'Summary\n\nReviewed By: r1\n'
+        commit(self.repo, 'c@example.com', {'a': '3'}, message, dates[2])
+        message = 'Summary\n\nReviewed By: r2\n'
+        commit(self.repo, 'd@example.com', {'b': '1'}, message, dates[3])
+        self.config = reviewers.Config()
+        self.config.user_cache_ttl = 0
+        self.finder = reviewers.FindArcCommitReviewers(self.config)
+        self.index = typing.cast(
+            reviewers.OwnershipIndex, self.finder.build_index(),
+        )
+        self.finder.index = self.index
+
+    def check_matches_git(self, expected: List[List[str]]) -> None:
+        window = self.finder.get_window()
+        for file_paths, emails in zip([['a'], ['b'], []], expected):
+            shortlog = self.index.shortlog(file_paths, window)
+            self.assertEqual(
+                [x.strip() for x in shortlog],
+                [x.strip() for x in self.finder.get_shortlog(file_paths)],
+            )
+            self.assertEqual(
+                [x[x.find('<') + 1:-1] for x in shortlog], emails,
+            )
+            self.assertEqual(
+                self.index.reviewers(file_paths, window),
+                self.finder.get_message_reviewers(file_paths),
+            )
+
+    def test_no_window(self) -> None:
+        self.assertIsNone(self.finder.get_window())
+        self.assertEqual(self.finder.get_window_arguments('HEAD'), ['HEAD'])
+
+    def test_max_commits(self) -> None:
+        self.config.max_commits = 2
+        self.assertEqual(
+            self.finder.get_window_arguments('--all'),
+            ['--max-count=2', '--all'],
+        )
+        self.check_matches_git([
+            ['b@example.com', 'c@example.com'],
+            ['d@example.com'],
+            ['c@example.com', 'd@example.com'],
+        ])
+
+    def test_since(self) -> None:
+        self.config.since = '2021-06-01'
+        self.check_matches_git([
+            ['c@example.com'], ['d@example.com'],
+            ['c@example.com', 'd@example.com'],
+        ])
+
+    def test_commit_time(self) -> None:
+        commit(
+            self.repo, 'e@example.com', {'b': '2'},
+            date='2010-01-01T00:00:00', committer_date='2024-01-01T00:00:00',
+        )
+        self.index = typing.cast(
+            reviewers.OwnershipIndex, self.finder.build_index(self.index),
+        )
+        self.config.since = '2023-06-01'
+        self.check_matches_git([[], ['e@example.com'], ['e@example.com']])
+
+    def test_revision_range(self) -> None:
+        self.config.revision_range = 'v1..HEAD'
+        self.config.max_commits = 1
+        self.check_matches_git([
+            ['c@example.com'], ['d@example.com'], ['d@example.com'],
+        ])
+        window = typing.cast(reviewers.HistoryWindow, self.finder.get_window())
+        self.assertIs(self.finder.get_window(), window)
+        self.assertEqual(sum(typing.cast(bytearray, window.included)), 3)
+
+    def test_adaptive_window(self) -> None:
+        self.config.adaptive_window = True
+        self.config.window_threshold = 1
+        finders = [reviewers.FindLogReviewers]  # type: typing.Any
+        self.config.changed_files = ['a']
+        with patch('git_reviewers.reviewers.ADAPTIVE_WINDOW_START', 1), \
+                patch('git_reviewers.reviewers.REVIEWERS_LIMIT', 2):
+            results = asyncio.run(reviewers.run_window_finders(
+                self.config, finders, self.index,
+            ))
+            self.assertEqual(results[0][1], Counter({
+                'b@example.com': 1, 'c@example.com': 1,
+            }))
+            self.config.window_threshold = 5
+            results = asyncio.run(reviewers.run_window_finders(
+                self.config, finders, self.index,
+            ))
+            self.assertEqual(len(typing.cast(Counter[str], results[0][1])), 3)
+
+
+class TestRecencyScores(RepoTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        message = 'old\n\nReviewed By: old\n'
+        for i in range(3):
+            commit(
+                self.repo, 'old@example.com', {'f': str(i)}, message,
+                '2000-01-0%d 00:00:00' % (i + 1),
+            )
+        commit(self.repo, 'new@example.com', {'f': 'new'}, 'Reviewed By: new')
+        git(self.repo, 'checkout', '-q', '-b', 'feature')
+        commit(self.repo, 'me@example.com', {'f': 'changed'})
+        self.config = reviewers.Config()
+        self.config.blame_cache_size = 0
+        self.config.user_cache_ttl = 0
+        bin_directory = os.path.join(self.repo, '.git', 'bin')
+        os.mkdir(bin_directory)
+        write_fake_arc(bin_directory)
+        self.environ = patch.dict(os.environ, {
+            'PATH': bin_directory + os.pathsep + os.environ['PATH'],
+            'FAKE_ARC_LOG': os.path.join(bin_directory, 'log'),
+        })
+        self.environ.start()
+
+    def tearDown(self) -> None:
+        self.environ.stop()
+        super().tearDown()
+
+    def test_raw_counts(self) -> None:
+        ranked = reviewers.get_reviewers(self.config)
+        self.assertEqual(ranked[0], 'old@example.com')
+        self.assertLess(ranked.index('old'), ranked.index('new'))
+
+    def test_decayed_scores(self) -> None:
+        self.config.index = True
+        self.config.finders = {'FindBlameReviewers': True}
+        self.config.half_life_days = 30
+        ranked = reviewers.get_reviewers(self.config)
+        self.assertEqual(ranked[0], 'new@example.com')
+        self.assertGreater(ranked.index('old@example.com'), 2)
+        self.assertLess(ranked.index('new'), ranked.index('old'))
+        finder = reviewers.FindLogReviewers(self.config)
+        scores = finder.get_scores()
+        self.assertEqual(len(scores), 3)
+        self.assertLess(scores['old@example.com'], 0.01)
+
+    def test_commit_weights(self) -> None:
+        index = reviewers.OwnershipIndex()
+        index.times.append(0)
+        day = reviewers.WEIGHTS_PERIOD
+        weights = index.commit_weights(1, 10 * day)
+        self.assertIs(index.commit_weights(1, 10 * day + 100), weights)
+        self.assertAlmostEqual(weights[0], 2 ** -10)
+        later = index.commit_weights(1, 11 * day)
+        self.assertAlmostEqual(later[0], 2 ** -11)
+        self.assertEqual(list(index.weights), [(1, 11)])
+
+    def test_finder_weights(self) -> None:
+        self.config.finder_weights = {
+            'FindLogReviewers': 0,
+            'FindHistoricalReviewers': 0,
+            'FindBlameReviewers': 0,
+        }
+        ranked = reviewers.get_reviewers(self.config)
+        self.assertEqual(ranked[:2], ['old', 'new'])
+
+
+class TestIdentityResolver(RepoTestCase):
+    def test_parse_mailmap(self) -> None:
+        mailmap = reviewers.IdentityResolver.parse_mailmap([
+            '# <comment@x> <ignored@x>',
+            'Name <name-only@x>',
+            '<a@x> <A.Old@x>',
+            'A <a@x> Old A <a2@x>  # comment',
+        ])
+        self.assertEqual(mailmap, {'a.old@x': 'a@x', 'a2@x': 'a@x'})
+
+    def test_resolve(self) -> None:
+        resolver = reviewers.IdentityResolver(
+            {'a': ['a@x', 'phab-a']}, {'old@x': 'a@x', 'b@x': 'b@uber.com'},
+        )
+        resolver.canonicalize = MagicMock(  # type: ignore
+            side_effect=resolver.canonicalize,
+        )
+        self.assertEqual(resolver.resolve('OLD@x'), 'a')
+        self.assertEqual(resolver.resolve('phab-a'), 'a')
+        self.assertEqual(resolver.resolve('b@x'), 'b')
+        self.assertEqual(resolver.resolve('c@x'), 'c@x')
+        self.assertEqual(resolver.resolve('OLD@x'), 'a')
+        self.assertEqual(resolver.canonicalize.call_count, 4)
+
+    def test_merge_finders(self) -> None:
+        with open(os.path.join(self.repo, '.mailmap'), 'w') as handle:
+            handle.write('<a@example.com> <a@old.example.com>\n')
+        commit(self.repo, 'a@example.com', {'f': '1'})
+        commit(self.repo, 'b@example.com', {'f': '2'})
+        commit(self.repo, 'b@example.com', {'f': '3'})
+        message = 'Change\n\nReviewed By: phab-a\n\n' + \
+            'Reviewed-by: A <a@old.example.com>\nApproved-by: phab-a\n'
+        commit(self.repo, 'c@example.com', {'f': '4'}, message)
+        git(self.repo, 'checkout', '-q', '-b', 'feature')
+        commit(self.repo, 'me@example.com', {'f': 'changed'})
+        config = reviewers.Config()
+        config.aliases = {'a@example.com': ['phab-a']}
+        config.finders = {'FindBlameReviewers': False}
+        finder = reviewers.FindArcCommitReviewers(config)
+        self.assertEqual(finder.get_reviewers(), Counter({'a@example.com': 1}))
+        finder = reviewers.FindTrailerReviewers(config)
+        self.assertEqual(finder.get_reviewers(), Counter({'a@example.com': 2}))
+        config.user_cache_ttl = 0
+        bin_directory = os.path.join(self.repo, '.git', 'bin')
+        os.mkdir(bin_directory)
+        write_fake_arc(bin_directory)
+        with patch.dict(os.environ, {
+            'PATH': bin_directory + os.pathsep + os.environ['PATH'],
+            'FAKE_ARC_LOG': os.path.join(bin_directory, 'log'),
+        }):
+            config.finders['FindArcCommitReviewers'] = False
+            ranked = reviewers.get_reviewers(config)
+            self.assertEqual(ranked[0], 'b@example.com')
+            config.finders['FindArcCommitReviewers'] = True
+            ranked = reviewers.get_reviewers(config)
+            self.assertEqual(ranked[0], 'a@example.com')
+
+    def test_trailers_without_arc(self) -> None:
+        commit(self.repo, 'a@example.com', {'f': '1'})
+        message = 'Change\n\nCo-authored-by: Bob <bob@example.com>\n'
+        commit(self.repo, 'a@example.com', {'f': '2'}, message)
+        git(self.repo, 'checkout', '-q', '-b', 'feature')
+        commit(self.repo, 'me@example.com', {'f': 'changed'})
+        bin_directory = os.path.join(self.repo, '.git', 'bin')
+        os.mkdir(bin_directory)
+        git_path = shutil.which('git')
+        assert git_path is not None
+        os.symlink(git_path, os.path.join(bin_directory, 'git'))
+        config = reviewers.Config()
+        config.user_cache_ttl = 0
+        with patch.dict(os.environ, {'PATH': bin_directory}):
+            ranked = reviewers.get_reviewers(config)
+        self.assertIn('bob@example.com', ranked)
+
+
+class TestFindBlameReviewers(RepoTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        lines = ''.join('%d\n' % i for i in range(1, 11))
+        commit(self.repo, 'alice@uber.com', {'f': lines})
+        lines += ''.join('%d\n' % i for i in range(11, 21))
+        commit(self.repo, 'bob@example.com', {'f': lines, 'g': 'g\n'})
+        self.finder = reviewers.FindBlameReviewers(reviewers.Config())
+
+    def test_get_changed_hunks(self) -> None:
+        diff = [
+            'diff --git a/f b/f', '--- a/f', '+++ b/f',
+            '@@ -3 +3 @@', '-3', '+three',
+            '@@ -15,2 +15,2 @@', '@@ -0,0 +1 @@',
+            'diff --git a/n b/n', '--- /dev/null', '+++ b/n', '@@ -0,0 +1 @@',
+        ]
+        self.finder.stream_command = MagicMock(  # type: ignore
+            return_value=iter(diff),
+        )
+        hunks = self.finder.get_changed_hunks()
+        self.assertEqual(hunks, {'f': [(3, 3), (15, 16), (1, 1)]})
+
+    def test_get_changed_hunks_quoted(self) -> None:
+        commit(self.repo, 'carol@example.com', {'a b': '1\n', 'é': '1\n'})
+        git(self.repo, 'checkout', '-q', '-b', 'feature')
+        commit(self.repo, 'me@example.com', {'a b': '2\n', 'é': '2\n'})
+        hunks = self.finder.get_changed_hunks()
+        self.assertEqual(hunks, {'a b': [(1, 1)], 'é': [(1, 1)]})
+        self.assertEqual(
+            sorted(self.finder.get_blob_shas(sorted(hunks))), ['a b', 'é'],
+        )
+        self.assertEqual(
+            self.finder.get_reviewers(), Counter({'carol@example.com': 2}),
+        )
+
+    def test_parse_blame(self) -> None:
+        sha_a = 'a' * 40
+        sha_b = 'b' * 40
+        blame = [
+            '%s 1 1 2' % sha_a, 'author-mail <alice@uber.com>', '\tline',
+            '%s 2 2' % sha_a, '\tline',
+            '%s 3 5 1' % sha_b, 'author-mail <bob@example.com>', '\tline',
+            '%s 4 6 1' % reviewers.FindBlameReviewers.ZERO_SHA,
+            'author-mail <not.committed.yet>', '\tline',
+        ]
+        lines = self.finder.parse_blame(blame)
+        self.assertEqual(lines, {
+            1: 'alice@uber.com', 2: 'alice@uber.com',
+            5: 'bob@example.com', 6: '',
+        })
+
+    def test_get_reviewers(self) -> None:
+        git(self.repo, 'checkout', '-q', '-b', 'feature')
+        lines = ''.join('%d\n' % i for i in range(1, 21))
+        lines = lines.replace('3\n', 'three\n', 1).replace('15\n16\n', '')
+        commit(self.repo, 'c@example.com', {'f': lines, 'n': 'new\n'})
+        self.finder.config.blame_concurrency = 2
+        counts = self.finder.get_reviewers()
+        self.assertEqual(counts, Counter({'alice': 1, 'bob@example.com': 2}))
+
+    def test_no_changes(self) -> None:
+        self.assertEqual(self.finder.get_reviewers(), Counter())
+
+    def test_blame_cache(self) -> None:
+        git(self.repo, 'checkout', '-q', '-b', 'feature')
+        lines = ''.join('%d\n' % i for i in range(1, 21))
+        first_change = lines.replace('\n3\n', '\n')
+        second_change = lines.replace('\n13\n', '\n')
+        commit(self.repo, 'c@example.com', {'f': first_change})
+        counts = self.finder.get_reviewers()
+        cache = self.finder.blame_cache
+        assert cache is not None
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+        commit(self.repo, 'c@example.com', {'f': second_change})
+        self.finder.get_reviewers()
+        cache = self.finder.blame_cache
+        assert cache is not None
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+        self.finder.stream_command = MagicMock(  # type: ignore
+            side_effect=self.finder.stream_command,
+        )
+        commit(self.repo, 'c@example.com', {'f': first_change})
+        self.assertEqual(self.finder.get_reviewers(), counts)
+        cache = self.finder.blame_cache
+        assert cache is not None
+        self.assertEqual((cache.hits, cache.misses), (1, 0))
+        calls = self.finder.stream_command.call_args_list
+        commands = [x[0][0][:2] for x in calls]
+        self.assertNotIn(['git', 'blame'], commands)
+
+    def test_blame_cache_eviction(self) -> None:
+        directory = os.path.join(self.repo, 'cache')
+        cache = reviewers.BlameCache(directory, 100)
+        for i in range(10):
+            cache.save('%040d' % i, 'f', {1: 'a@example.com'})
+            entry = cache.entry_path('%040d' % i, 'f')
+            os.utime(entry, (i, i))
+        cache.load('%040d' % 0, 'f')
+        cache.evict()
+        remaining = [
+            os.path.join(directory, x) for x in os.listdir(directory)
+        ]
+        self.assertLess(len(remaining), 10)
+        self.assertIn(cache.entry_path('0' * 40, 'f'), remaining)
+        self.assertNotIn(cache.entry_path('%040d' % 1, 'f'), remaining)
+
+    def test_blame_cache_disabled(self) -> None:
+        self.finder.config.blame_cache_size = 0
+        self.assertIsNone(self.finder.get_blame_cache())
+
+
 class TestFindArcCommitReviewers(unittest.TestCase):
     def setUp(self) -> None:
-        self.finder = reviewers.FindArcCommitReviewers(reviewers.Config())
+        config = reviewers.Config()
+        config.index = False
+        self.finder = reviewers.FindArcCommitReviewers(config)
 
     def test_no_reviewers(self) -> None:
         log = ['asdf']
-        self.finder.run_command = MagicMock(return_value=log)  # type: ignore
+        self.finder.stream_command = MagicMock(  # type: ignore
+            return_value=iter(log),
+        )
         reviewers = self.finder.get_log_reviewers_from_file(['file'])
         self.assertEqual(reviewers, Counter())
 
     def test_reviewers(self) -> None:
         log = ['asdf', ' Reviewed By: asdf, qwer']
-        self.finder.run_command = MagicMock(return_value=log)  # type: ignore
+        self.finder.stream_command = MagicMock(  # type: ignore
+            return_value=iter(log),
+        )
         reviewers = self.finder.get_log_reviewers_from_file(['file'])
         self.assertEqual(reviewers, Counter({'asdf': 1, 'qwer': 1}))
 
     def test_multiple_reviews(self) -> None:
         log = ['asdf', ' Reviewed By: asdf, qwer', 'Reviewed By: asdf']
-        self.finder.run_command = MagicMock(return_value=log)  # type: ignore
+        self.finder.stream_command = MagicMock(  # type: ignore
+            return_value=iter(log),
+        )
         reviewers = self.finder.get_log_reviewers_from_file(['file'])
         self.assertEqual(reviewers, Counter({'asdf': 2, 'qwer': 1}))
 
 
+class TestBenchmark(unittest.TestCase):
+    def test_build_repository(self) -> None:
+        with tempfile.TemporaryDirectory() as repo:
+            benchmark.build_repository(repo, 20, 5, 3)
+            benchmark.make_changes(repo, 2)
+            count = subprocess.run(
+                ['git', 'rev-list', '--count', 'HEAD'],
+                cwd=repo, stdout=subprocess.PIPE, check=True,
+            ).stdout.decode('utf-8').strip()
+            diff = subprocess.run(
+                ['git', 'diff', '--name-only'],
+                cwd=repo, stdout=subprocess.PIPE, check=True,
+            ).stdout.decode('utf-8').split()
+        self.assertEqual(count, '20')
+        self.assertEqual(len(diff), 2)
+
+    def test_compare_results(self) -> None:
+        baseline = {'a': {
+            'wall_time': 1.0, 'subprocesses': 3, 'peak_rss_kb': 100,
+        }}
+        results = {
+            'a': {'wall_time': 1.1, 'subprocesses': 3, 'peak_rss_kb': 100},
+            'b': {'wall_time': 9.0, 'subprocesses': 9, 'peak_rss_kb': 900},
+        }
+        regressions = benchmark.compare_results(baseline, results, 0.2)
+        self.assertEqual(regressions, [])
+        results['a'] = {
+            'wall_time': 1.5, 'subprocesses': 4, 'peak_rss_kb': 100,
+        }
+        regressions = benchmark.compare_results(baseline, results, 0.2)
+        self.assertEqual(len(regressions), 2)
+
+    def test_startup_modules(self) -> None:
+        result = benchmark.loaded_modules([])
+        self.assertIn('git_reviewers.reviewers', result['modules'])
+        self.assertFalse(
+            set(benchmark.STARTUP_EXCLUDED) & set(result['modules']),
+        )
+        result = benchmark.loaded_modules(
+            [benchmark.REVIEWERS_SCRIPT, '--version'],
+        )
+        self.assertEqual(result['output'], reviewers.__version__ + '\n')
+        self.assertFalse(
+            set(benchmark.STARTUP_EXCLUDED) & set(result['modules']),
+        )
+
+
+class TestDaemon(RepoTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        commit(self.repo, 'a@example.com', {'a': '1\n', 'b': '1\n'})
+        commit(self.repo, 'b@example.com', {'b': '2\n'})
+        git(self.repo, 'checkout', '-q', '-b', 'feature')
+        with open(os.path.join(self.repo, 'a'), 'w') as handle:
+            handle.write('2\n')
+        self.config = reviewers.Config()
+        self.config.user_cache_ttl = 0
+        self.socket_path = reviewers.daemon_socket_path('.git')
+        self.thread = threading.Thread(
+            target=reviewers.run_daemon, args=(self.config,),
+        )
+        with patch('builtins.print'):
+            self.thread.start()
+        for _ in range(500):
+            if os.path.exists(self.socket_path):
+                break
+            time.sleep(0.01)
+
+    def tearDown(self) -> None:
+        reviewers.query_daemon(self.config, {'command': 'stop'})
+        self.thread.join()
+        super().tearDown()
+
+    def test_get_daemon_reviewers(self) -> None:
+        expected = reviewers.get_reviewers(self.config)
+        self.assertEqual(expected, ['a@example.com', 'b@example.com'])
+        daemon_reviewers = reviewers.get_daemon_reviewers(self.config)
+        self.assertEqual(daemon_reviewers, expected)
+
+    def test_head_moves(self) -> None:
+        reviewers.get_daemon_reviewers(self.config)
+        commit(self.repo, 'c@example.com', {'a': '3\n'})
+        with open(os.path.join(self.repo, 'a'), 'w') as handle:
+            handle.write('4\n')
+        daemon_reviewers = reviewers.get_daemon_reviewers(self.config)
+        self.assertEqual(
+            daemon_reviewers, reviewers.get_reviewers(self.config),
+        )
+        self.assertIn(
+            'c@example.com', typing.cast(List[str], daemon_reviewers),
+        )
+
+    def test_ignores(self) -> None:
+        self.config.ignores = ['a@example.com']
+        daemon_reviewers = reviewers.get_daemon_reviewers(self.config)
+        self.assertEqual(daemon_reviewers, ['b@example.com'])
+
+    def test_config_mismatch(self) -> None:
+        config = reviewers.Config()
+        config.user_cache_ttl = 0
+        config.finder_weights = {'FindLogReviewers': 2}
+        self.assertIsNone(reviewers.get_daemon_reviewers(config))
+        self.assertEqual(config.changed_files, ['a'])
+        request = reviewers.ranking_request(config)
+        response = reviewers.query_daemon(config, request)
+        self.assertEqual(
+            response, {'error': 'Config does not match the daemon'},
+        )
+        config.finder_weights = {}
+        self.assertEqual(
+            reviewers.get_daemon_reviewers(config),
+            ['a@example.com', 'b@example.com'],
+        )
+
+    def test_follows_index(self) -> None:
+        config = reviewers.Config()
+        config.user_cache_ttl = 0
+        daemon = reviewers.ReviewersDaemon(config)
+        response = daemon.answer(reviewers.ranking_request(config))
+        self.assertIsNone(daemon.index)
+        self.assertEqual(response['ranking'], reviewers.rank_reviewers(config))
+        config.index = True
+        daemon = reviewers.ReviewersDaemon(config)
+        response = daemon.answer(reviewers.ranking_request(config))
+        self.assertIsNotNone(daemon.index)
+        self.assertEqual(response['ranking'], reviewers.rank_reviewers(config))
+        self.assertIsNone(reviewers.get_daemon_reviewers(config))
+
+    def test_no_daemon(self) -> None:
+        self.config.daemon = False
+        self.assertIsNone(reviewers.get_daemon_reviewers(self.config))
+        self.config.daemon = True
+        reviewers.query_daemon(self.config, {'command': 'stop'})
+        self.thread.join()
+        self.assertFalse(os.path.exists(self.socket_path))
+        ranking_request = 'git_reviewers.reviewers.ranking_request'
+        with patch(ranking_request) as mock_ranking_request:
+            self.assertIsNone(reviewers.get_daemon_reviewers(self.config))
+        self.assertFalse(mock_ranking_request.called)
+
+    def test_startup(self) -> None:
+        result = benchmark.loaded_modules(
+            [benchmark.REVIEWERS_SCRIPT], self.repo,
+        )
+        self.assertEqual(result['output'], 'a@example.com, b@example.com\n')
+        self.assertIn('socket', result['modules'])
+        self.assertEqual(
+            set(benchmark.STARTUP_EXCLUDED) & set(result['modules']),
+            {'socket'},
+        )
+
+    @patch('builtins.print')
+    def test_already_running(self, mock_print: MagicMock) -> None:
+        self.assertFalse(reviewers.run_daemon(self.config))
+        self.assertTrue(os.path.exists(self.socket_path))
+
+    @patch('builtins.print')
+    def test_no_unix_sockets(self, mock_print: MagicMock) -> None:
+        available = 'git_reviewers.reviewers.unix_sockets_available'
+        with patch(available, return_value=False):
+            self.assertFalse(reviewers.run_daemon(self.config))
+            self.assertIsNone(reviewers.get_daemon_reviewers(self.config))
+            self.assertEqual(
+                reviewers.get_reviewers(self.config),
+                ['a@example.com', 'b@example.com'],
+            )
+        script = (
+            'import socket; del socket.AF_UNIX; '
+            'from git_reviewers import reviewers; '
+            'print(reviewers.unix_sockets_available())'
+        )
+        process = subprocess.run(
+            [sys.executable, '-c', script], cwd=BASE_DIRECTORY,
+            stdout=subprocess.PIPE, check=True,
+        )
+        self.assertEqual(process.stdout, b'False\n')
+
+
+class TestSnapshot(RepoTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        commit(self.repo, 'a@example.com', {'a': '1\n', 'b': '1\n'})
+        commit(self.repo, 'b@example.com', {'b': '2\n'})
+        git(self.repo, 'checkout', '-q', '-b', 'feature')
+        commit(self.repo, 'c@example.com', {'a': '2\n'})
+        self.config = reviewers.Config()
+        self.config.user_cache_ttl = 0
+        self.config.refresh_delay = 0
+        self.cache = os.path.join(self.repo, '.git', reviewers.CACHE_DIRECTORY)
+
+    def test_refresh_snapshot(self) -> None:
+        self.assertIsNone(reviewers.get_snapshot_ranking(self.config))
+        self.assertTrue(reviewers.refresh_snapshot(self.config))
+        self.assertFalse(os.path.exists(
+            os.path.join(self.cache, reviewers.REFRESH_PENDING),
+        ))
+        ranking = reviewers.get_snapshot_ranking(self.config)
+        self.assertEqual(ranking, reviewers.rank_reviewers(self.config))
+        self.config.limit = 1
+        self.assertIsNone(reviewers.get_snapshot_ranking(self.config))
+        self.config.limit = 0
+        self.config.finder_weights = {'FindLogReviewers': 2}
+        self.assertIsNone(reviewers.get_snapshot_ranking(self.config))
+        self.config.finder_weights = {}
+        self.config.half_life_days = 30
+        self.assertIsNone(reviewers.get_snapshot_ranking(self.config))
+        self.config.half_life_days = 0
+        self.assertEqual(reviewers.get_snapshot_ranking(self.config), ranking)
+        with open(os.path.join(self.repo, 'b'), 'w') as handle:
+            handle.write('3\n')
+        self.assertIsNone(reviewers.get_snapshot_ranking(self.config))
+        commit(self.repo, 'c@example.com', {})
+        self.assertIsNone(reviewers.get_snapshot_ranking(self.config))
+
+    def test_refresh_locked(self) -> None:
+        import fcntl  # NOQA: PLC0415
+        os.makedirs(self.cache)
+        lock_path = os.path.join(self.cache, reviewers.REFRESH_LOCK)
+        with open(lock_path, 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self.assertTrue(reviewers.refresh_snapshot(self.config))
+        self.assertTrue(os.path.exists(
+            os.path.join(self.cache, reviewers.REFRESH_PENDING),
+        ))
+        self.assertIsNone(reviewers.get_snapshot_ranking(self.config))
+
+    @patch('builtins.print')
+    def test_main_snapshot(self, mock_print: MagicMock) -> None:
+        reviewers.refresh_snapshot(self.config)
+        rank_reviewers = 'git_reviewers.reviewers.rank_reviewers'
+        with patch.object(sys, 'argv', ['reviewers.py']):
+            with patch(rank_reviewers) as mock_rank:
+                reviewers.main()
+        self.assertFalse(mock_rank.called)
+        mock_print.assert_called_with(
+            'a@example.com, c@example.com, b@example.com',
+        )
+
+    def test_install_hooks(self) -> None:
+        hooks = os.path.join(self.repo, '.git', 'hooks')
+        os.makedirs(hooks, exist_ok=True)
+        with open(os.path.join(hooks, 'post-merge'), 'w') as handle:
+            handle.write('#!/bin/sh\necho existing\n')
+        env = dict(os.environ)
+        env['HOME'] = self.repo
+        subprocess.run(
+            ['bash', os.path.join(BASE_DIRECTORY, 'install.sh'), '--hooks'],
+            cwd=self.repo, env=env, stdout=subprocess.DEVNULL, check=True,
+        )
+        with open(os.path.join(hooks, 'post-commit'), 'r') as handle:
+            self.assertIn('--refresh', handle.read())
+        self.assertTrue(os.access(
+            os.path.join(hooks, 'reference-transaction'), os.X_OK,
+        ))
+        with open(os.path.join(hooks, 'post-merge'), 'r') as handle:
+            self.assertNotIn('--refresh', handle.read())
+
+
+class TestBatch(RepoTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        commit(self.repo, 'a@example.com', {'a': '1\n'})
+        commit(self.repo, 'b@example.com', {'b': '1\n'})
+        for branch, changed in [('feature-a', 'a'), ('feature-b', 'b')]:
+            git(self.repo, 'checkout', '-q', '-b', branch, 'master')
+            commit(self.repo, 'me@example.com', {changed: '2\n'})
+        git(self.repo, 'checkout', '-q', 'master')
+        self.config = reviewers.Config()
+        self.config.user_cache_ttl = 0
+        self.config.batch_concurrency = 2
+        self.config.finders = {'FindHistoricalReviewers': False}
+
+    def test_run_batch(self) -> None:
+        requests = [
+            json.dumps({'id': 1, 'base': 'master', 'head': 'feature-a'}),
+            '',
+            json.dumps({'id': 2, 'base': 'master', 'head': 'feature-b'}),
+            '[]',
+            json.dumps({'id': 3, 'head': 'feature-b', 'ignores': ['b']}),
+            json.dumps({'id': 4, 'head': 'missing'}),
+        ]
+        output = io.StringIO()
+        reviewers.run_batch(self.config, requests, output)
+        responses = [json.loads(x) for x in output.getvalue().splitlines()]
+        self.assertEqual(responses, [
+            {'id': 1, 'base': 'master', 'head': 'feature-a',
+             'reviewers': ['a@example.com', 'me@example.com']},
+            {'id': 2, 'base': 'master', 'head': 'feature-b',
+             'reviewers': ['b@example.com', 'me@example.com']},
+            {'error': 'Request is not an object'},
+            {'id': 3, 'head': 'feature-b',
+             'reviewers': ['b@example.com', 'me@example.com']},
+            {'id': 4, 'head': 'missing', 'error': 'Unknown head missing'},
+        ])
+
+    def test_broken_pool(self) -> None:
+        requests = [json.dumps({'id': x}) for x in range(5)]
+        output = io.StringIO()
+        with patch.object(
+            reviewers, 'answer_batch_request', new=exit_batch_worker,
+        ):
+            reviewers.run_batch(self.config, requests, output)
+        responses = [json.loads(x) for x in output.getvalue().splitlines()]
+        self.assertEqual([x['id'] for x in responses], list(range(5)))
+        self.assertTrue(all(x['error'] for x in responses))
+
+    def test_matches_checkout(self) -> None:
+        output = io.StringIO()
+        request = {'head': 'feature-a'}
+        reviewers.run_batch(self.config, [json.dumps(request)], output)
+        git(self.repo, 'checkout', '-q', 'feature-a')
+        self.assertEqual(
+            json.loads(output.getvalue())['reviewers'],
+            reviewers.get_reviewers(self.config),
+        )
+
+
+class TestGetReviewersAsync(RepoTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        commit(self.repo, 'a@example.com', {'a': '1\n'})
+        commit(self.repo, 'b@example.com', {'b': '1\n'})
+        git(self.repo, 'checkout', '-q', '-b', 'feature')
+        with open(os.path.join(self.repo, 'a'), 'w') as handle:
+            handle.write('2\n')
+        self.config = reviewers.Config()
+        self.config.user_cache_ttl = 0
+
+    def slow_scores(self, delay: float) -> typing.Callable[..., typing.Any]:
+        def get_scores(finder: reviewers.FindReviewers) -> typing.Any:
+            time.sleep(delay)
+            return {'slow@example.com': 100}
+        return get_scores
+
+    def test_get_reviewers_async(self) -> None:
+        coroutine = reviewers.get_reviewers_async(self.config)
+        reviewers_list = asyncio.run(coroutine)
+        self.assertEqual(reviewers_list, ['a@example.com', 'b@example.com'])
+
+    @patch('builtins.print')
+    def test_verbose_order(self, mock_print: MagicMock) -> None:
+        self.config.verbose = True
+        self.config.finders = {'FindBlameReviewers': True}
+        get_scores = (
+            'git_reviewers.reviewers.FindHistoricalReviewers.get_scores'
+        )
+        with patch(get_scores, new=self.slow_scores(0.3)):
+            reviewers_list = reviewers.get_reviewers(self.config)
+        self.assertEqual(reviewers_list[0], 'slow@example.com')
+        printed = [x[0][0].split(':')[0] for x in mock_print.call_args_list]
+        self.assertEqual(printed, [
+            'Reviewers from FindLogReviewers',
+            'Reviewers from FindHistoricalReviewers',
+            'Reviewers from FindBlameReviewers',
+            'Blame cache for FindBlameReviewers',
+            'Reviewers from FindArcCommitReviewers',
+            'Reviewers from FindTrailerReviewers',
+        ])
+
+    def test_skip_empty_source(self) -> None:
+        self.config.index = True
+        get_scores = (
+            'git_reviewers.reviewers.FindArcCommitReviewers.get_scores'
+        )
+        with patch(get_scores) as mock_get_scores:
+            reviewers.get_reviewers(self.config)
+        self.assertFalse(mock_get_scores.called)
+
+    def test_skip_empty_source_without_index(self) -> None:
+        log_finder = reviewers.FindLogReviewers(self.config)
+        arc_finder = reviewers.FindArcCommitReviewers(self.config)
+        self.assertTrue(log_finder.has_source())
+        self.assertFalse(arc_finder.has_source())
+        get_scores = (
+            'git_reviewers.reviewers.FindArcCommitReviewers.get_scores'
+        )
+        with patch(get_scores) as mock_get_scores:
+            reviewers.get_reviewers(self.config)
+        self.assertFalse(mock_get_scores.called)
+        commit(
+            self.repo, 'c@example.com', {'c': '1\n'},
+            'commit\n\nreviewed-by: D <d@example.com>',
+        )
+        self.assertFalse(arc_finder.has_source())
+        trailer_finder = reviewers.FindTrailerReviewers(self.config)
+        self.assertTrue(trailer_finder.has_source())
+        empty = tempfile.TemporaryDirectory()
+        self.addCleanup(empty.cleanup)
+        init_repo(empty.name)
+        os.chdir(empty.name)
+        self.assertEqual(reviewers.get_reviewers(self.config), [])
+
+    def test_source_in_thread(self) -> None:
+        threads = []
+
+        def has_source(finder: reviewers.FindReviewers) -> bool:
+            threads.append(threading.current_thread())
+            return True
+
+        finder = reviewers.FindFileLogReviewers
+        with patch.object(finder, 'has_source', has_source):
+            reviewers.get_reviewers(self.config)
+        self.assertTrue(threads)
+        self.assertNotIn(threading.main_thread(), threads)
+
+    def test_plugin_finder(self) -> None:
+        entry_point = MagicMock()
+        entry_point.name = 'PluginFinder'
+        entry_point.load.return_value = PluginFinder
+        entry_points = 'git_reviewers.reviewers.finder_entry_points'
+        with patch(entry_points) as mock_entry_points:
+            mock_entry_points.return_value = [entry_point]
+            reviewers_list = reviewers.get_reviewers(self.config)
+            self.assertEqual(reviewers_list[0], 'plugin@example.com')
+            self.config.finder_weights = {'PluginFinder': 0.1}
+            reviewers_list = reviewers.get_reviewers(self.config)
+            self.assertEqual(reviewers_list[-1], 'plugin@example.com')
+
+    @patch('builtins.print')
+    def test_finder_timeout(self, mock_print: MagicMock) -> None:
+        self.config.verbose = True
+        self.config.finder_timeout = 0.2
+        self.config.finders = {'FindBlameReviewers': True}
+        get_scores = 'git_reviewers.reviewers.FindBlameReviewers.get_scores'
+        start = time.time()
+        with patch(get_scores, new=self.slow_scores(3)):
+            reviewers_list = reviewers.get_reviewers(self.config)
+        self.assertLess(time.time() - start, 2)
+        self.assertEqual(reviewers_list, ['a@example.com', 'b@example.com'])
+        printed = [x[0][0] for x in mock_print.call_args_list]
+        self.assertIn('Timed out waiting for FindBlameReviewers', printed)
+
+    def test_finder_timeout_exit(self) -> None:
+        script = '''
+import sys
+from git_reviewers import reviewers
+def blame_lines(self, file_path, line_ranges):
+    command = [sys.executable, '-c', 'import time; time.sleep(10)']
+    return self.parse_blame(self.stream_command(command))
+reviewers.FindBlameReviewers.blame_lines = blame_lines
+config = reviewers.Config()
+config.user_cache_ttl = 0
+config.finder_timeout = 0.5
+config.finders = {'FindBlameReviewers': True}
+print(', '.join(reviewers.get_reviewers(config)))
+'''
+        env = dict(os.environ)
+        env['PYTHONPATH'] = BASE_DIRECTORY
+        start = time.time()
+        process = subprocess.run(
+            [sys.executable, '-c', script], env=env, stdout=subprocess.PIPE,
+            check=True,
+        )
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(process.stdout, b'a@example.com, b@example.com\n')
+
+
+class PluginFinder(reviewers.FindReviewers):
+    def get_reviewers(self):  # type: () -> typing.Counter[str]
+        return Counter({'plugin@example.com': 5})
+
+
+class TestFinderRegistry(unittest.TestCase):
+    def setUp(self) -> None:
+        self.config = reviewers.Config()
+
+    def entry_point(self, name: str) -> MagicMock:
+        entry_point = MagicMock()
+        entry_point.name = name
+        entry_point.load.return_value = PluginFinder
+        return entry_point
+
+    def test_default_finders(self) -> None:
+        self.assertEqual(reviewers.get_finders(self.config), [
+            reviewers.FindLogReviewers,
+            reviewers.FindHistoricalReviewers,
+            reviewers.FindArcCommitReviewers,
+            reviewers.FindTrailerReviewers,
+        ])
+        self.config.finders = {'FindBlameReviewers': True}
+        self.assertEqual(reviewers.get_finders(self.config), [
+            reviewers.FindLogReviewers,
+            reviewers.FindHistoricalReviewers,
+            reviewers.FindBlameReviewers,
+            reviewers.FindArcCommitReviewers,
+            reviewers.FindTrailerReviewers,
+        ])
+
+    def test_disabled_finders(self) -> None:
+        self.config.finders = {'FindBlameReviewers': False}
+        self.config.finder_weights = {'FindHistoricalReviewers': 0}
+        self.assertEqual(reviewers.get_finders(self.config), [
+            reviewers.FindLogReviewers, reviewers.FindArcCommitReviewers,
+            reviewers.FindTrailerReviewers,
+        ])
+
+    def test_entry_points(self) -> None:
+        enabled = self.entry_point('PluginFinder')
+        disabled = self.entry_point('DisabledFinder')
+        builtin = self.entry_point('FindLogReviewers')
+        self.config.finders = {'DisabledFinder': False}
+        entry_points = 'git_reviewers.reviewers.finder_entry_points'
+        with patch(entry_points) as mock_entry_points:
+            mock_entry_points.return_value = [enabled, disabled, builtin]
+            finders = reviewers.get_finders(self.config)
+        self.assertEqual(finders[-1], PluginFinder)
+        self.assertEqual(len(finders), 5)
+        self.assertTrue(enabled.load.called)
+        self.assertFalse(disabled.load.called)
+        self.assertFalse(builtin.load.called)
+
+    def test_has_source(self) -> None:
+        index = reviewers.OwnershipIndex()
+        log_finder = reviewers.FindLogReviewers(self.config, index)
+        arc_finder = reviewers.FindArcCommitReviewers(self.config, index)
+        self.assertFalse(log_finder.has_source())
+        self.assertFalse(arc_finder.has_source())
+        index.shas = ['a' * 40]
+        self.assertTrue(log_finder.has_source())
+        self.assertFalse(arc_finder.has_source())
+        index.reviews = {0: ['asdf']}
+        self.assertTrue(arc_finder.has_source())
+        trailer_finder = reviewers.FindTrailerReviewers(self.config, index)
+        self.assertFalse(trailer_finder.has_source())
+        index.trailers = {0: ['asdf@example.com']}
+        self.assertTrue(trailer_finder.has_source())
+
+
 class TestShowReviewers(unittest.TestCase):
     @patch('builtins.print')
     def test_show_reviewers(self, mock_print: MagicMock) -> None:
@@ -219,9 +1902,14 @@ class TestGetReviewers(unittest.TestCase):
             'FindFileLogReviewers.get_reviewers'
         )
         run_command = 'git_reviewers.reviewers.FindReviewers.run_command'
+        run_command_async = run_command + '_async'
+        has_source = patch.object(
+            reviewers.FindArcCommitReviewers, 'has_source', return_value=True,
+        )
         with patch.object(sys, 'argv', ['reviewers.py', '--verbose']):
-            with patch(get_reviewers) as mock_get_reviewers:
-                with patch(run_command) as mock_run_command:
+            with patch(get_reviewers) as mock_get_reviewers, has_source:
+                with patch(run_command) as mock_run_command, \
+                        patch(run_command_async, new=no_output):
                     with patch('subprocess.Popen') as mock_popen:
                         mock_popen().returncode = 0
                         mock_popen().communicate.return_value = \
@@ -229,14 +1917,139 @@ class TestGetReviewers(unittest.TestCase):
                         mock_run_command.return_value = []
                         mock_get_reviewers.return_value = counter
                         reviewers.get_reviewers(config)
-        self.assertEqual(len(mock_print.call_args), 2)
-        self.assertEqual(
-            mock_print.call_args[0][0],
+        printed = [x[0][0] for x in mock_print.call_args_list]
+        self.assertIn(
             'Reviewers from FindArcCommitReviewers: %s' %
             "{'asdf': 1, 'qwer': 1}",
+            printed,
         )
 
 
+class TestRanking(RepoTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        commit(self.repo, 'a@example.com', {'a': '0\n'})
+        commit(self.repo, 'a@example.com', {'a': '1\n', 'b': '1\n'})
+        commit(self.repo, 'b@example.com', {'b': '2\n'})
+        commit(self.repo, 'c@example.com', {'c': '1\n'})
+        git(self.repo, 'checkout', '-q', '-b', 'feature')
+        with open(os.path.join(self.repo, 'a'), 'w') as handle:
+            handle.write('2\n')
+        with open(os.path.join(self.repo, 'b'), 'a') as handle:
+            handle.write('3\n')
+        self.config = reviewers.Config()
+        self.config.daemon = False
+        self.config.finder_weights = {'FindHistoricalReviewers': 0.5}
+        self.config.finders = {'FindBlameReviewers': True}
+
+    def test_rank_reviewers(self) -> None:
+        ranking = reviewers.rank_reviewers(self.config)
+        self.assertEqual(ranking[0], {
+            'reviewer': 'a@example.com', 'score': 4.0, 'files': 2,
+            'finders': {
+                'FindLogReviewers': 2, 'FindHistoricalReviewers': 1.0,
+                'FindBlameReviewers': 1,
+            },
+        })
+        self.assertEqual(
+            [(x['reviewer'], x['score'], x['files']) for x in ranking[1:]],
+            [('b@example.com', 2.5, 1), ('c@example.com', 0.5, 0)],
+        )
+        self.config.index = True
+        self.assertEqual(reviewers.rank_reviewers(self.config), ranking)
+        matched_files = (
+            'git_reviewers.reviewers.FindLogReviewers.get_matched_files'
+        )
+        with patch(matched_files) as mock_matched_files:
+            unmatched = reviewers.rank_reviewers(self.config, files=False)
+        self.assertFalse(mock_matched_files.called)
+        for described in ranking:
+            del described['files']
+        self.assertEqual(unmatched, ranking)
+        self.config.limit = 1
+        ranking = reviewers.rank_reviewers(self.config)
+        self.assertEqual([x['reviewer'] for x in ranking], ['a@example.com'])
+
+    def test_format_ranking(self) -> None:
+        ranking = [
+            {'reviewer': 'a', 'score': 2.5, 'files': 2,
+             'finders': {'FindLogReviewers': 2, 'FindBlameReviewers': 0.5}},
+            {'reviewer': 'b', 'score': 1, 'files': 0,
+             'finders': {'FindHistoricalReviewers': 1}},
+        ]
+        output = reviewers.format_ranking(ranking, 'json')
+        self.assertEqual(json.loads(output), {'reviewers': ranking})
+        output = reviewers.format_ranking(ranking, 'jsonl')
+        self.assertEqual([json.loads(x) for x in output.split('\n')], ranking)
+        output = reviewers.format_ranking(ranking, 'tsv')
+        self.assertEqual(output.split('\n'), [
+            'reviewer\tscore\tfiles\tFindLogReviewers\tFindBlameReviewers\t'
+            'FindHistoricalReviewers',
+            'a\t2.5\t2\t2\t0.5\t0',
+            'b\t1\t0\t0\t0\t1',
+        ])
+
+    @patch('builtins.print')
+    def test_main_format(self, mock_print: MagicMock) -> None:
+        argv = ['reviewers.py', '--no-daemon', '--format', 'jsonl']
+        with patch.object(sys, 'argv', argv + ['--limit', '2']):
+            reviewers.main()
+        lines = mock_print.call_args[0][0].split('\n')
+        self.assertEqual(
+            [json.loads(x)['reviewer'] for x in lines],
+            ['a@example.com', 'b@example.com'],
+        )
+
+
+class TestProfiler(RepoTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.profiler = reviewers.Profiler()
+        self.profiler.record('finder', 'FindLogReviewers', 0.5)
+        self.profiler.record(
+            'command', 'FindLogReviewers', 0.25, command='git log ' + 'a' * 60,
+            bytes_read=10, lines=2, parse_time=0.125,
+        )
+
+    def test_format_table(self) -> None:
+        lines = self.profiler.format_table().split('\n')
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[0].startswith('kind'))
+        self.assertEqual(
+            lines[1].split(), ['finder', 'FindLogReviewers', '0.500'],
+        )
+        self.assertEqual(
+            lines[2].split()[:6],
+            ['command', 'FindLogReviewers', '0.250', '10', '2', '0.125'],
+        )
+        self.assertTrue(lines[2].endswith('...'))
+
+    def test_write_json(self) -> None:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, 'profile.json')
+            self.profiler.write_json(path)
+            with open(path) as handle:
+                self.assertEqual(json.load(handle), self.profiler.records)
+
+    @patch('builtins.print')
+    def test_profile_get_reviewers(self, mock_print: MagicMock) -> None:
+        config = index_config()
+        config.profiler = self.profiler
+        with patch('git_reviewers.reviewers.FindReviewers.run_command') as \
+                mock_run_command:
+            mock_run_command.return_value = []
+            reviewers.get_reviewers(config)
+        finders = [
+            x['finder'] for x in self.profiler.records[2:]
+            if x['kind'] != 'command'
+        ]
+        self.assertEqual(finders[0], 'FindReviewers')
+        self.assertEqual(sorted(finders[1:]), [
+            'FindArcCommitReviewers', 'FindHistoricalReviewers',
+            'FindLogReviewers', 'FindTrailerReviewers',
+        ])
+
+
 class TestConfig(unittest.TestCase):
     def setUp(self) -> None:
         self.config = reviewers.Config()
@@ -293,20 +2106,55 @@ class TestConfig(unittest.TestCase):
         self.config.read_configs(self.mock_args)
         self.assertEqual(set(self.config.ignores), set(['a', 'b']))
 
+    def test_index_only_options(self) -> None:
+        self.config_file.write(json.dumps({'half_life_days': 30}))
+        self.config_file.flush()
+        self.config.read_from_json(self.config_file.name)
+        self.assertTrue(self.config.index)
+        config = reviewers.Config()
+        self.mock_args.backend = 'native'
+        config.read_from_args(self.mock_args)
+        self.assertTrue(config.index)
+        config = reviewers.Config()
+        self.mock_args.backend = None
+        self.mock_args.index = None
+        config.read_from_args(self.mock_args)
+        self.assertFalse(config.index)
+
+
+class TestMain(RepoTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        commit(self.repo, 'a@example.com', {'a': '1\n'})
+        git(self.repo, 'checkout', '-q', '-b', 'feature')
+        commit(self.repo, 'b@example.com', {'a': '2\n'})
 
-class TestMain(unittest.TestCase):
     @patch('builtins.print')
     def test_main(self, mock_print: MagicMock) -> None:
         with patch.object(sys, 'argv', ['reviewers.py']):
             reviewers.main()
         self.assertTrue(mock_print.called)
 
-    @patch('argparse.ArgumentParser._print_message')
+    @patch('builtins.print')
+    def test_profile(self, mock_print: MagicMock) -> None:
+        with patch.object(sys, 'argv', ['reviewers.py', '--profile']):
+            reviewers.main()
+        self.assertTrue(
+            mock_print.call_args[0][0].startswith('kind'),
+        )
+        self.assertEqual(mock_print.call_args[1]['file'], sys.stderr)
+
+    @patch('builtins.print')
     def test_version(self, mock_print: MagicMock) -> None:
         with patch.object(sys, 'argv', ['reviewers.py', '-v']):
+            reviewers.main()
+        mock_print.assert_called_once_with(reviewers.__version__)
+
+    @patch('argparse.ArgumentParser._print_message')
+    def test_version_with_flags(self, mock_print: MagicMock) -> None:
+        with patch.object(sys, 'argv', ['reviewers.py', '--verbose', '-v']):
             with self.assertRaises(SystemExit):
                 reviewers.main()
-        self.assertTrue(mock_print.called)
         version = reviewers.__version__ + "\n"
         self.assertEqual(mock_print.call_args[0][0], version)
 
@@ -318,9 +2166,14 @@ class TestMain(unittest.TestCase):
             'FindFileLogReviewers.get_reviewers'
         )
         run_command = 'git_reviewers.reviewers.FindReviewers.run_command'
+        run_command_async = run_command + '_async'
+        has_source = patch.object(
+            reviewers.FindArcCommitReviewers, 'has_source', return_value=True,
+        )
         with patch.object(sys, 'argv', ['reviewers.py', '-i', 'asdf']):
-            with patch(get_reviewers) as mock_get_reviewers:
-                with patch(run_command) as mock_run_command:
+            with patch(get_reviewers) as mock_get_reviewers, has_source:
+                with patch(run_command) as mock_run_command, \
+                        patch(run_command_async, new=no_output):
                     with patch('subprocess.Popen') as mock_popen:
                         mock_popen().returncode = 0
                         mock_popen().communicate.return_value = \
@@ -340,9 +2193,14 @@ class TestMain(unittest.TestCase):
             'FindFileLogReviewers.get_reviewers'
         )
         run_command = 'git_reviewers.reviewers.FindReviewers.run_command'
+        run_command_async = run_command + '_async'
+        has_source = patch.object(
+            reviewers.FindArcCommitReviewers, 'has_source', return_value=True,
+        )
         with patch.object(sys, 'argv', ['reviewers.py']):
-            with patch(get_reviewers) as mock_get_reviewers:
-                with patch(run_command) as mock_run_command:
+            with patch(get_reviewers) as mock_get_reviewers, has_source:
+                with patch(run_command) as mock_run_command, \
+                        patch(run_command_async, new=no_output):
                     with patch('subprocess.Popen') as mock_popen:
                         mock_popen().returncode = 0
                         mock_popen().communicate.return_value = \
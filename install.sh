@@ -1,7 +1,8 @@
 #!/bin/bash
 
 # Installs this repository so that you can run `git reviewers` from anywhere in
-# your filesystem
+# your filesystem.  With --hooks, also installs git hooks into the current
+# repository which refresh suggested reviewers in the background.
 
 # Check if python 3 is installed
 if ! command -v python3 > /dev/null 2>&1; then
@@ -10,6 +11,12 @@ if ! command -v python3 > /dev/null 2>&1; then
     echo "On Ubuntu/Debian, use 'sudo apt install python3'"
 fi
 
+INSTALL_HOOKS=""
+if [ "$1" = "--hooks" ]; then
+  INSTALL_HOOKS=1
+  shift
+fi
+
 if [ -z "$1" ]; then
   BROWSE_PY_LOCATION="$( cd "$( dirname "${BASH_SOURCE[0]}" )" && pwd )"
   BROWSE_PY_LOCATION="$BROWSE_PY_LOCATION"/git_reviewers
@@ -18,6 +25,42 @@ else
   BROWSE_PY_LOCATION=$1
 fi
 
+# Running the package directory instead of reviewers.py lets python reuse
+# compiled bytecode rather than compiling reviewers.py on every run
+if [ -f "$BROWSE_PY_LOCATION/__main__.py" ]; then
+  REVIEWERS_COMMAND="python3 $BROWSE_PY_LOCATION"
+else
+  REVIEWERS_COMMAND="$BROWSE_PY_LOCATION/reviewers.py"
+fi
+
 git config --global \
     alias.reviewers \
-    "!$BROWSE_PY_LOCATION/reviewers.py"
+    "!$REVIEWERS_COMMAND"
+
+if [ -z "$INSTALL_HOOKS" ]; then
+  exit 0
+fi
+
+HOOKS_DIRECTORY="$(git rev-parse --git-path hooks)" || exit 1
+HOOK_MARKER="# Installed by git-reviewers"
+mkdir -p "$HOOKS_DIRECTORY"
+for HOOK in post-commit post-merge post-checkout post-rewrite \
+    reference-transaction; do
+  HOOK_PATH="$HOOKS_DIRECTORY/$HOOK"
+  if [ -e "$HOOK_PATH" ] && ! grep -q "$HOOK_MARKER" "$HOOK_PATH"; then
+    echo "Not replacing existing hook $HOOK_PATH"
+    continue
+  fi
+  {
+    echo "#!/bin/sh"
+    echo "$HOOK_MARKER"
+    if [ "$HOOK" = "reference-transaction" ]; then
+      # Refs updated by fetches and pushes, once they are committed
+      echo "cat > /dev/null"
+      echo "[ \"\$1\" = committed ] || exit 0"
+    fi
+    echo "unset GIT_INDEX_FILE"
+    echo "$REVIEWERS_COMMAND --refresh < /dev/null > /dev/null 2>&1 &"
+  } > "$HOOK_PATH"
+  chmod +x "$HOOK_PATH"
+done